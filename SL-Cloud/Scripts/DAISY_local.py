@@ -0,0 +1,616 @@
+import numpy as np
+import pandas as pd
+from scipy import stats
+from scipy.special import ndtr
+from statsmodels.stats.multitest import multipletests
+
+
+def RankData(data, chunk_size=2048):
+    '''
+    Description: Ranks every column of a samples x genes matrix in ascending order, tied values get the
+    average of their ranks (same as RANK() + (ties-1)/2 in the DAISY SQL). Missing values stay missing.
+    Inputs:
+        data:2D numpy array, samples x genes, missing values are np.nan
+        chunk_size:integer, number of columns ranked at a time, bounds the size of the temporary index arrays
+    Output:
+        A float32 array of 1-based ranks with the same shape as data
+    '''
+    data=np.asarray(data, dtype=np.float32)
+    n_rows, n_cols=data.shape
+    ranks=np.full(data.shape, np.nan, dtype=np.float32)
+    positions=np.arange(n_rows)[:, None]
+
+    for start in range(0, n_cols, chunk_size):
+        block=data[:, start:start+chunk_size]
+        order=np.argsort(block, axis=0, kind='mergesort')
+        sorted_block=np.take_along_axis(block, order, axis=0)
+
+        # a tie group starts where the sorted value changes and ends right before the next start
+        group_start=np.ones(sorted_block.shape, dtype=bool)
+        group_start[1:]=sorted_block[1:]!=sorted_block[:-1]
+        group_end=np.ones(sorted_block.shape, dtype=bool)
+        group_end[:-1]=group_start[1:]
+
+        first=np.maximum.accumulate(np.where(group_start, positions, 0), axis=0)
+        last=np.minimum.accumulate(np.where(group_end, positions, n_rows)[::-1], axis=0)[::-1]
+        sorted_ranks=(first+last)/2.0+1
+        sorted_ranks[np.isnan(sorted_block)]=np.nan
+
+        block_ranks=np.empty(block.shape, dtype=np.float32)
+        np.put_along_axis(block_ranks, order, sorted_ranks, axis=0)
+        ranks[:, start:start+chunk_size]=block_ranks
+
+    return ranks
+
+
+def SubsetRanks(data, order, rows):
+    '''
+    Description: Same ranks as RankData(data[rows]), read from the precomputed sort order of the columns of data over all of its rows.
+    The selected rows are picked along the order in one linear pass, nothing is sorted again.
+    Inputs:
+        data:2D numpy array, all samples x genes, missing values are np.nan
+        order:2D integer array, the stable argsort of every column of data (missing values last)
+        rows:1D integer array, the distinct row positions of the subset
+    Output:
+        A float32 array of 1-based ranks, len(rows) x genes
+    '''
+    data=np.asarray(data, dtype=np.float32)
+    order=np.asarray(order)
+    position=np.full(data.shape[0], -1, dtype=np.int64)
+    position[rows]=np.arange(len(rows))
+
+    sorted_block=np.take_along_axis(data, order, axis=0)
+    sorted_position=position[order]
+    selected=sorted_position>=0
+    # the number of selected rows up to every sorted position, i.e. the rank of a selected row without ties
+    count=np.cumsum(selected, axis=0)
+
+    group_start=np.ones(sorted_block.shape, dtype=bool)
+    group_start[1:]=sorted_block[1:]!=sorted_block[:-1]
+    group_end=np.ones(sorted_block.shape, dtype=bool)
+    group_end[:-1]=group_start[1:]
+
+    # the selected rows of a tie group are ranked from the count before the group + 1 to the count at its end
+    before=np.maximum.accumulate(np.where(group_start, count-selected, 0), axis=0)
+    last=np.minimum.accumulate(np.where(group_end, count, len(rows))[::-1], axis=0)[::-1]
+    sorted_ranks=(before+1+last)/2.0
+    sorted_ranks[np.isnan(sorted_block)]=np.nan
+
+    ranks=np.full((len(rows), data.shape[1]), np.nan, dtype=np.float32)
+    columns=np.broadcast_to(np.arange(data.shape[1]), order.shape)
+    ranks[sorted_position[selected], columns[selected]]=sorted_ranks[selected]
+    return ranks
+
+
+def CorrelationMatrix(x, y):
+    '''
+    Description: Pearson correlations between every column of x and every column of y, using only the rows
+    where both columns are observed. Applied to ranks this gives Spearman correlations.
+    Inputs:
+        x:2D numpy array, samples x genes (query genes), missing values are np.nan
+        y:2D numpy array, samples x genes (all genes), missing values are np.nan
+    Output:
+        correlation:2D float32 array, x genes x y genes
+        n:2D int32 array, the number of samples each correlation is computed on
+    '''
+    x_mask=~np.isnan(x)
+    y_mask=~np.isnan(y)
+
+    if x_mask.all() and y_mask.all():
+        # complete data: standardize once, then a single matrix product gives every correlation
+        n_samples=x.shape[0]
+        x_std=_Standardize(x)
+        y_std=_Standardize(y)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            correlation=(x_std.T @ y_std).astype(np.float32)
+        n=np.full(correlation.shape, n_samples, dtype=np.int32)
+        return correlation, n
+
+    # incomplete data: pairwise complete sums, accumulated in float64 on column-centered values
+    x_val=np.where(x_mask, x-np.nanmean(x, axis=0), 0).astype(np.float64)
+    y_val=np.where(y_mask, y-np.nanmean(y, axis=0), 0).astype(np.float64)
+    x_obs=x_mask.astype(np.float64)
+    y_obs=y_mask.astype(np.float64)
+
+    n=x_obs.T @ y_obs
+    sum_x=x_val.T @ y_obs
+    sum_y=x_obs.T @ y_val
+    sum_xx=(x_val**2).T @ y_obs
+    sum_yy=x_obs.T @ (y_val**2)
+    sum_xy=x_val.T @ y_val
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cov=n*sum_xy-sum_x*sum_y
+        var_x=n*sum_xx-sum_x**2
+        var_y=n*sum_yy-sum_y**2
+        correlation=cov/np.sqrt(var_x*var_y)
+    return correlation.astype(np.float32), n.astype(np.int32)
+
+
+def _Standardize(data):
+    centered=data-data.mean(axis=0, dtype=np.float64)
+    norm=np.sqrt((centered**2).sum(axis=0))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (centered/norm).astype(np.float32)
+
+
+def CorrelationPValue(correlation, n):
+    '''
+    Description: Two sided p values of the correlations, computed the same way as the tscore_to_p UDF
+    used by the BigQuery engine, jStat.ttest(tscore, n-2, 2) which evaluates the t distribution with n-3 degrees of freedom.
+    Inputs:
+        correlation:numpy array of correlations
+        n:numpy array of sample counts
+    Output:
+        A numpy array of p values
+    '''
+    correlation=np.asarray(correlation, dtype=np.float64)
+    n=np.asarray(n, dtype=np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        tscore=np.abs(correlation)*np.sqrt((n-2)/((1+correlation)*(1-correlation)))
+    return 2*stats.t.sf(tscore, n-3)
+
+
+def CoexpressionPairs(ranks, genes, input_genes, min_samples=20, all_partners=False):
+    '''
+    Description: Local equivalent of the BigQuery coexpression query, correlates the input genes against every gene.
+    Inputs:
+        ranks:2D float32 array, samples x genes ranks (output of RankData)
+        genes:list of strings, the gene symbols of the columns of ranks
+        input_genes:list of strings, the genes whose partners are seeked
+        min_samples:integer, pairs need more than min_samples samples
+        all_partners:boolean, if True every input gene is paired with every other gene, including the other input genes,
+            so the partners of a gene do not depend on the input gene list (used by the result cache)
+    Output:
+        A dataframe with the columns symbol1, symbol2, n, correlation, pvalue, ordered like the BigQuery output
+    '''
+    genes=np.asarray(genes, dtype=object)
+    input_set=set(input_genes)
+    is_input=np.array([g in input_set for g in genes], dtype=bool)
+    query_idx=np.flatnonzero(is_input)
+    if len(query_idx)==0:
+        return pd.DataFrame(columns=['symbol1', 'symbol2', 'n', 'correlation', 'pvalue'])
+
+    correlation, n=CorrelationMatrix(ranks[:, query_idx], ranks)
+
+    # input genes are paired with every non input gene, and with each other once (symbol1 < symbol2)
+    query_genes=genes[query_idx]
+    if all_partners:
+        keep=query_genes[:, None]!=genes[None, :]
+    else:
+        keep=np.repeat(~is_input[None, :], len(query_idx), axis=0)
+        keep|=is_input[None, :] & (query_genes[:, None]<genes[None, :])
+    keep&=(n>min_samples) & ~np.isnan(correlation)
+
+    rows, cols=np.nonzero(keep)
+    results=pd.DataFrame({'symbol1':query_genes[rows],
+                          'symbol2':genes[cols],
+                          'n':n[rows, cols].astype(np.int64),
+                          'correlation':correlation[rows, cols].astype(np.float64)})
+    results['pvalue']=CorrelationPValue(results['correlation'].values, results['n'].values)
+    results=results.sort_values(['symbol1', 'correlation'], ascending=[True, False], kind='mergesort')
+    return results.reset_index(drop=True)
+
+
+def TieTerms(ranks):
+    '''
+    Description: The tie term sum(t^3-t) of every column, t being the sizes of the groups of tied values.
+    Inputs:
+        ranks:2D array, samples x genes ranks or values, missing values are np.nan
+    Output:
+        A float64 array with one tie term per column
+    '''
+    sorted_ranks=np.sort(np.asarray(ranks), axis=0)
+    n_rows, n_cols=sorted_ranks.shape
+    group_start=np.ones(sorted_ranks.shape, dtype=bool)
+    group_start[1:]=sorted_ranks[1:]!=sorted_ranks[:-1]
+    group_id=np.cumsum(group_start, axis=0)-1+np.arange(n_cols)[None, :]*n_rows
+    observed=~np.isnan(sorted_ranks)
+    sizes=np.bincount(group_id[observed], minlength=n_rows*n_cols).astype(np.float64)
+    return (sizes**3-sizes).reshape(n_cols, n_rows).sum(axis=1)
+
+
+def RankSumStatistics(inactive, ranks, tie_correction=True):
+    '''
+    Description: Mann-Whitney statistics of the ranks of every gene, comparing the inactive samples of every input gene against the rest.
+    All rank sums are obtained with one matrix product, inactive^T x ranks.
+    Inputs:
+        inactive:2D boolean array, samples x input genes, True where the input gene is inactive in the sample
+        ranks:2D array, samples x genes ranks (output of RankData), missing values are np.nan
+        tie_correction:boolean, if True (default) the variance of U is corrected for ties, False reproduces the DAISY SQL
+    Output:
+        n1:2D float64 array, input genes x genes, the number of inactive samples with a rank
+        n:1D float64 array, the number of ranked samples of every gene
+        U1:2D float64 array, the U statistic of the inactive samples
+        den:2D float64 array, the standard deviation of U1 under the null hypothesis
+    '''
+    inactive=np.asarray(inactive, dtype=np.float64)
+    observed=~np.isnan(ranks)
+    n=observed.sum(axis=0).astype(np.float64)
+    n1=inactive.T @ observed.astype(np.float64)
+    sumx_1=inactive.T @ np.where(observed, ranks, 0).astype(np.float64)
+    U1=sumx_1-n1*(n1+1)/2.0
+    variance=n1*(n-n1)*(n+1)/12.0
+    if tie_correction:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            variance=variance-n1*(n-n1)*TieTerms(ranks)/(12.0*n*(n-1))
+    return n1, n, U1, np.sqrt(np.maximum(variance, 0))
+
+
+def MannWhitneyPairs(inactive, ranks, input_genes, genes, alternative='greater', min_samples=20, min_inactive=5, tie_correction=True):
+    '''
+    Description: Local equivalent of the rank sum part of the SurvivalOfFittest and FunctionalExamination queries.
+    Inputs:
+        inactive:2D boolean array, samples x input genes, True where the input gene is inactive in the sample
+        ranks:2D array, samples x genes ranks (output of RankData), missing values are np.nan
+        input_genes:list of strings, the gene symbols of the columns of inactive
+        genes:list of strings, the gene symbols of the columns of ranks
+        alternative:string, "greater" tests whether the inactive samples have higher ranks (z=(n1n2/2-U1)/den, as in SurvivalOfFittest),
+                    "less" whether they have lower ranks (z=(U1-n1n2/2)/den, as in FunctionalExamination)
+        min_samples:integer, genes need more than min_samples ranked samples
+        min_inactive:integer, pairs need more than min_inactive inactive samples
+        tie_correction:boolean, if True (default) the variance of U is corrected for ties
+    Output:
+        A dataframe with the columns symbol1, symbol2, n1, n, U1, pvalue, ordered by p value
+    '''
+    n1, n, U1, den=RankSumStatistics(inactive, ranks, tie_correction)
+    n=np.broadcast_to(n[None, :], n1.shape)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if alternative=='greater':
+            zscore=(n1*(n-n1)/2.0-U1)/den
+        else:
+            zscore=(U1-n1*(n-n1)/2.0)/den
+
+    rows, cols=np.nonzero((n>min_samples) & (n1>min_inactive) & (den>0))
+    results=pd.DataFrame({'symbol1':np.asarray(input_genes, dtype=object)[rows],
+                          'symbol2':np.asarray(genes, dtype=object)[cols],
+                          'n1':n1[rows, cols].astype(np.int64),
+                          'n':n[rows, cols].astype(np.int64),
+                          'U1':U1[rows, cols],
+                          'pvalue':ndtr(zscore[rows, cols])})
+    results=results.sort_values('pvalue', kind='mergesort')
+    return results.reset_index(drop=True)
+
+
+def SweepOrder(thresholds, SL_or_SDL):
+    '''
+    Description: Orders the thresholds of a sweep so that the values passing them are nested: ascending for SL, where the values
+    below the threshold pass, descending for SDL, where the values above it pass.
+    Inputs:
+        thresholds:list of numbers
+        SL_or_SDL:string, valid values: 'SL', 'SDL'
+    Output:
+        The distinct thresholds in the sweep order, as a float64 array
+    '''
+    ordered=np.unique(np.asarray(thresholds, dtype=np.float64))
+    return ordered if SL_or_SDL=="SL" else ordered[::-1]
+
+
+def PercentRank(groups, values):
+    '''
+    Description: PERCENT_RANK() of every value within its group, (rank-1)/(group size-1) with tied values getting their lowest rank,
+    0 in groups of a single value.
+    Inputs:
+        groups:1D array, the group (e.g. gene symbol) of every value
+        values:1D array of numbers
+    Output:
+        A float64 array
+    '''
+    by_group=pd.Series(np.asarray(values, dtype=np.float64)).groupby(np.asarray(groups), sort=False)
+    counts=by_group.transform('size').values
+    ranks=by_group.rank(method='min').values
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts>1, (ranks-1)/(counts-1), 0.0)
+
+
+class InactivityIndex:
+    '''
+    Description: Bit-packed inactivity calls of a set of genes over a set of samples. Every condition a sample can meet for a gene,
+    expression percentile or copy number below (SL) or above (SDL) a threshold and mutated with a variant class, is stored as
+    one np.packbits row per gene over the sample axis. The rows of a condition are built the first time it is asked for and kept,
+    so the inactive samples of any threshold and mutation class combination are a couple of bitwise operations on packed rows.
+    The expression percentiles are PERCENT_RANK()s within the samples of the index, as in the SurvivalOfFittest query.
+    Inputs:
+        expression:dataframe with the symbol, Barcode, data columns, the expression rows of the genes
+        cn:dataframe with the symbol, Barcode, data columns, the copy number rows of the genes
+        mutation:dataframe with the symbol, Barcode, Variant_Classification columns, the mutation rows of the genes, or None
+        samples:list of sample ids, the sample axis, rows of samples outside of it are ignored
+        genes:list of gene symbols, the gene axis
+    '''
+
+    def __init__(self, expression, cn, mutation, samples, genes):
+        self.samples=list(pd.unique(np.asarray(samples, dtype=object)))
+        self.genes=list(pd.unique(np.asarray(genes, dtype=object)))
+        self._sample_position={self.samples[i]:i for i in range(len(self.samples))}
+        self._gene_position={self.genes[i]:i for i in range(len(self.genes))}
+        expression=self._Positions(expression)
+        expression['data']=PercentRank(expression['symbol'].values, expression['data'].values)
+        self._values={'expression':expression, 'cn':self._Positions(cn)}
+        self._mutation=None if mutation is None else self._Positions(mutation)
+        self._rows={}
+
+    def _Positions(self, rows):
+        # the rows of the index samples and genes, with the gene and sample positions
+        rows=rows[rows['Barcode'].isin(self._sample_position.keys()) & rows['symbol'].isin(self._gene_position.keys())].copy()
+        rows['gene']=rows['symbol'].map(self._gene_position).values.astype(np.int64)
+        rows['sample']=rows['Barcode'].map(self._sample_position).values.astype(np.int64)
+        return rows
+
+    def _Pack(self, rows):
+        # one packed row of the given (gene, sample) rows per gene
+        bits=np.zeros((len(self.genes), len(self.samples)), dtype=bool)
+        bits[rows['gene'].values, rows['sample'].values]=True
+        return np.packbits(bits, axis=1)
+
+    def Condition(self, kind, SL_or_SDL, threshold):
+        '''
+        Description: The samples whose expression percentile (kind "expression", threshold in [0, 1]) or copy number (kind "cn")
+        is below (SL) or above (SDL) the threshold
+        Output:
+            A uint8 array, genes x ceil(samples/8), the packed rows of the genes
+        '''
+        key=(kind, SL_or_SDL, float(threshold))
+        if key not in self._rows:
+            rows=self._values[kind]
+            passing=rows['data'].values<threshold if SL_or_SDL=="SL" else rows['data'].values>threshold
+            self._rows[key]=self._Pack(rows.loc[passing])
+        return self._rows[key]
+
+    def Mutated(self, mutation_classes):
+        '''
+        Description: The samples with a mutation of one of the variant classes
+        Output:
+            A uint8 array, genes x ceil(samples/8), the packed rows of the genes
+        '''
+        packed=np.zeros((len(self.genes), (len(self.samples)+7)//8), dtype=np.uint8)
+        if self._mutation is None:
+            return packed
+        for mutation_class in mutation_classes:
+            key=('mutation', str(mutation_class))
+            if key not in self._rows:
+                self._rows[key]=self._Pack(self._mutation.loc[self._mutation['Variant_Classification']==mutation_class])
+            packed=packed | self._rows[key]
+        return packed
+
+    def Inactive(self, SL_or_SDL, percentile_threshold, cn_threshold, mutation_classes=None):
+        '''
+        Description: The inactive (SL) or overactive (SDL) samples of every gene: expression percentile and copy number both past
+        their thresholds, or mutated with one of the mutation classes
+        Inputs:
+            SL_or_SDL:string, valid values: 'SL', 'SDL'
+            percentile_threshold:double, the expression percentile threshold, in percent as in SurvivalOfFittest
+            cn_threshold:double, the copy number threshold
+            mutation_classes:list of strings, optional, the variant classes that make a gene inactive
+        Output:
+            A uint8 array, genes x ceil(samples/8), the packed rows of the genes
+        '''
+        packed=self.Condition('expression', SL_or_SDL, percentile_threshold/100) & self.Condition('cn', SL_or_SDL, cn_threshold)
+        if mutation_classes is not None:
+            packed=packed | self.Mutated(mutation_classes)
+        return packed
+
+    def Counts(self, packed):
+        '''
+        Description: The number of samples set in every packed row
+        '''
+        return np.unpackbits(packed, axis=1, count=len(self.samples)).sum(axis=1)
+
+    def Mask(self, packed, row_samples=None):
+        '''
+        Description: Unpacks the packed rows into the samples x genes boolean matrix taken by RankSumStatistics and MannWhitneyPairs
+        Inputs:
+            packed:the output of Inactive, Condition or Mutated, or several of them stacked with np.vstack
+            row_samples:list of sample ids, optional, the rows of the matrix (e.g. the rows of the ranks), samples outside of the index
+                are never inactive. By default the samples of the index.
+        Output:
+            A 2D boolean array, samples x genes
+        '''
+        mask=np.unpackbits(packed, axis=1, count=len(self.samples)).astype(bool).T
+        if row_samples is None:
+            return mask
+        positions=np.array([self._sample_position.get(x, -1) for x in row_samples], dtype=np.int64)
+        rows=np.zeros((len(positions), packed.shape[0]), dtype=bool)
+        rows[positions>=0]=mask[positions[positions>=0]]
+        return rows
+
+
+def CoexpressionTopPairs(ranks, genes, input_genes, top_k, top_by='correlation', min_samples=20, tile_size=1024):
+    '''
+    Description: Genome-wide variant of CoexpressionPairs that keeps only the top_k partners of every input gene.
+    The gene pairs are processed in tiles of tile_size x tile_size genes and every input gene keeps a bounded buffer of its
+    top_k best partners, so the memory needed does not depend on the number of genes.
+    Inputs:
+        ranks:2D float32 array, samples x genes ranks (output of RankData)
+        genes:list of strings, the gene symbols of the columns of ranks
+        input_genes:list of strings, the genes whose partners are seeked
+        top_k:integer, the number of partners kept per input gene
+        top_by:string, "correlation" keeps the largest absolute correlations, "FDR" the smallest p values
+            (every p value adjustment is monotone in the p value, so they are also the smallest FDRs)
+        min_samples:integer, pairs need more than min_samples samples
+        tile_size:integer, the number of genes per tile
+    Output:
+        A dataframe with the columns symbol1, symbol2, n, correlation, pvalue, ordered like the output of CoexpressionPairs,
+        and n_tests, the number of pairs of symbol1 before the top_k selection (needed to adjust the p values)
+    '''
+    genes=np.asarray(genes, dtype=object)
+    input_set=set(input_genes)
+    is_input=np.array([g in input_set for g in genes], dtype=bool)
+    query_idx=np.flatnonzero(is_input)
+    columns=['symbol1', 'symbol2', 'n', 'correlation', 'pvalue', 'n_tests']
+    if len(query_idx)==0:
+        return pd.DataFrame(columns=columns)
+
+    results=[]
+    for q_start in range(0, len(query_idx), tile_size):
+        q_idx=query_idx[q_start:q_start+tile_size]
+        q_genes=genes[q_idx]
+        best_score=np.full((len(q_idx), 0), -np.inf)
+        best_col=np.zeros((len(q_idx), 0), dtype=np.int64)
+        best_n=np.zeros((len(q_idx), 0), dtype=np.int64)
+        best_corr=np.zeros((len(q_idx), 0), dtype=np.float64)
+        n_tests=np.zeros(len(q_idx), dtype=np.int64)
+
+        for p_start in range(0, len(genes), tile_size):
+            p_idx=np.arange(p_start, min(p_start+tile_size, len(genes)))
+            correlation, n=CorrelationMatrix(ranks[:, q_idx], ranks[:, p_idx])
+            keep=~is_input[None, p_idx] | (q_genes[:, None]<genes[None, p_idx])
+            keep&=(n>min_samples) & ~np.isnan(correlation)
+            n_tests+=keep.sum(axis=1)
+            correlation=correlation.astype(np.float64)
+            if top_by=='correlation':
+                score=np.abs(correlation)
+            else:
+                score=-CorrelationPValue(correlation, n)
+            score=np.where(keep, score, -np.inf)
+
+            # merge the tile into the buffers, keeping the top_k scores of every row
+            score=np.concatenate([best_score, score], axis=1)
+            col=np.concatenate([best_col, np.broadcast_to(p_idx[None, :], correlation.shape)], axis=1)
+            n=np.concatenate([best_n, n], axis=1)
+            correlation=np.concatenate([best_corr, correlation], axis=1)
+            if score.shape[1]>top_k:
+                top=np.argpartition(-score, top_k-1, axis=1)[:, :top_k]
+            else:
+                top=np.broadcast_to(np.arange(score.shape[1])[None, :], score.shape)
+            best_score=np.take_along_axis(score, top, axis=1)
+            best_col=np.take_along_axis(col, top, axis=1)
+            best_n=np.take_along_axis(n, top, axis=1)
+            best_corr=np.take_along_axis(correlation, top, axis=1)
+
+        rows, slots=np.nonzero(best_score>-np.inf)
+        results.append(pd.DataFrame({'symbol1':q_genes[rows],
+                                     'symbol2':genes[best_col[rows, slots]],
+                                     'n':best_n[rows, slots],
+                                     'correlation':best_corr[rows, slots],
+                                     'n_tests':n_tests[rows]}))
+
+    results=pd.concat(results, ignore_index=True)
+    results.insert(4, 'pvalue', CorrelationPValue(results['correlation'].values, results['n'].values))
+    results=results.sort_values(['symbol1', 'correlation'], ascending=[True, False], kind='mergesort')
+    return results.reset_index(drop=True)
+
+
+def GroupedMultipleTests(pvalues, groups, method, ntests=None):
+    '''
+    Description: Adjusts the p values within every group, giving the same values as calling statsmodels multipletests
+    on each group separately. The p values are sorted once by (group, p value); bonferroni, sidak, holm, holm-sidak,
+    simes-hochberg, fdr_bh and fdr_by are then computed for all groups together, the other methods
+    (hommel, fdr_tsbh, fdr_tsbky) call multipletests on each sorted group.
+    Inputs:
+        pvalues:1D array of p values
+        groups:1D array of group labels, p values with a missing label are not adjusted (their result is nan)
+        method:string, p value correction method, valid values: bonferroni, sidak, holm-sidak, holm, simes-hochberg, hommel, fdr_bh, fdr_by, fdr_tsbh, fdr_tsbky
+        ntests:1D array, optional, the number of tests of the group of every p value when only the smallest p values of
+            the groups are given (e.g. top-k partners). The missing p values are taken as 1, which gives the exact
+            adjustment for bonferroni, sidak, holm and holm-sidak and an upper bound for the step-up methods.
+    Output:
+        A float64 array of adjusted p values in the order of pvalues
+    '''
+    pvalues=np.asarray(pvalues, dtype=np.float64)
+    codes, uniques=pd.factorize(np.asarray(groups, dtype=object))
+    adjusted=np.full(len(pvalues), np.nan)
+    labelled=np.flatnonzero(codes>=0)
+    if len(labelled)==0:
+        return adjusted
+
+    order=labelled[np.lexsort((pvalues[labelled], codes[labelled]))]
+    sorted_p=pvalues[order]
+    sorted_codes=codes[order]
+
+    # position of every p value inside its group, and the size of its group
+    starts=np.flatnonzero(np.r_[True, sorted_codes[1:]!=sorted_codes[:-1]])
+    sizes=np.diff(np.r_[starts, len(sorted_p)])
+    if ntests is None:
+        ntests=np.repeat(sizes, sizes)
+    else:
+        ntests=np.maximum(np.asarray(ntests, dtype=np.int64)[order], np.repeat(sizes, sizes))
+    rank=np.arange(len(sorted_p))-np.repeat(starts, sizes)
+    method=method.lower()
+
+    if method in ['b', 'bonf', 'bonferroni']:
+        corrected=sorted_p*ntests.astype(np.float64)
+    elif method in ['s', 'sidak']:
+        with np.errstate(divide='ignore'):
+            corrected=-np.expm1(ntests*np.log1p(-sorted_p))
+    elif method in ['hs', 'holm-sidak']:
+        with np.errstate(divide='ignore'):
+            corrected=_GroupCumulative(-np.expm1((ntests-rank)*np.log1p(-sorted_p)), sorted_codes, 'cummax')
+    elif method in ['h', 'holm']:
+        corrected=_GroupCumulative(sorted_p*(ntests-rank), sorted_codes, 'cummax')
+    elif method in ['sh', 'simes-hochberg']:
+        corrected=_GroupCumulative((ntests-rank)*sorted_p, sorted_codes, 'cummin', reverse=True)
+    elif method in ['fdr_bh', 'fdr_i', 'fdr_p', 'fdri', 'fdrp']:
+        ecdffactor=(rank+1)/ntests.astype(np.float64)
+        corrected=_GroupCumulative(sorted_p/ecdffactor, sorted_codes, 'cummin', reverse=True)
+    elif method in ['fdr_by', 'fdr_n', 'fdr_c', 'fdrn', 'fdrcorr']:
+        harmonic={n:np.sum(1./np.arange(1, n+1)) for n in np.unique(ntests)}
+        cm=np.array([harmonic[n] for n in ntests])
+        ecdffactor=(rank+1)/ntests.astype(np.float64)/cm
+        corrected=_GroupCumulative(sorted_p/ecdffactor, sorted_codes, 'cummin', reverse=True)
+    else:
+        corrected=np.empty(len(sorted_p))
+        for start, size in zip(starts, sizes):
+            padding=np.ones(ntests[start]-size)
+            group_p=np.concatenate([sorted_p[start:start+size], padding])
+            corrected[start:start+size]=multipletests(group_p, method=method, is_sorted=True)[1][:size]
+
+    corrected[corrected>1]=1
+    adjusted[order]=corrected
+    return adjusted
+
+
+def _GroupCumulative(values, codes, function, reverse=False):
+    if reverse:
+        values, codes=values[::-1], codes[::-1]
+    result=np.array(getattr(pd.Series(values).groupby(codes, sort=False), function)())
+    return result[::-1].copy() if reverse else result
+
+
+def MergePairKeys(keys, how='outer'):
+    '''
+    Description: Joins several lists of integer pair keys in one sort-merge pass, the equivalent of chaining pd.merge on the pairs.
+    The keys of all inputs are sorted together once, so the rows of every input sharing a key end up next to each other.
+    A key found more than once in an input is joined with every row of it, as pd.merge does.
+    Inputs:
+        keys:list of 1D int64 arrays, the pair keys of the rows of every input
+        how:string, valid values: 'outer' (keys of any input), 'inner' (keys of every input)
+    Output:
+        merged:int64 array, the key of every output row, in ascending key order
+        rows:list of int64 arrays, for every input the row joined to every output row, -1 where the input does not have the key
+    '''
+    sizes=[len(x) for x in keys]
+    all_keys=np.concatenate([np.asarray(x, dtype=np.int64) for x in keys] + [np.zeros(0, dtype=np.int64)])
+    source=np.repeat(np.arange(len(keys)), sizes)
+    # a stable sort keeps the rows of a key ordered by input, then by row
+    order=np.argsort(all_keys, kind='stable')
+    sorted_keys=all_keys[order]
+    first=np.append(True, sorted_keys[1:]!=sorted_keys[:-1]) if len(sorted_keys)>0 else np.zeros(0, dtype=bool)
+    group=np.cumsum(first)-1
+    unique=sorted_keys[first]
+    group_start=np.flatnonzero(first)
+    counts=[np.bincount(group[source[order]==i], minlength=len(unique)) for i in range(len(keys))]
+    offsets=np.cumsum([np.zeros(len(unique), dtype=np.int64)] + counts[:-1], axis=0) if len(keys)>0 else []
+    if how=='inner':
+        found=np.logical_and.reduce([count>0 for count in counts]) if len(counts)>0 else np.zeros(0, dtype=bool)
+        unique, group_start=unique[found], group_start[found]
+        counts=[count[found] for count in counts]
+        offsets=[offset[found] for offset in offsets]
+
+    # every key gives the product of its row counts, a missing key counting as one row of -1
+    widths=[np.maximum(count, 1) for count in counts]
+    repeats=np.prod(np.vstack(widths), axis=0) if len(widths)>0 else np.zeros(0, dtype=np.int64)
+    merged=np.repeat(unique, repeats)
+    position=np.arange(len(merged))-np.repeat(np.cumsum(repeats)-repeats, repeats)
+    starts=np.cumsum([0] + sizes[:-1])
+    rows=[None]*len(keys)
+    stride=np.ones(len(merged), dtype=np.int64)
+    # the first input varies slowest within a key, as in chained merges
+    for i in reversed(range(len(keys))):
+        width=np.repeat(widths[i], repeats)
+        within=(position//stride)%width
+        stride=stride*width
+        found=np.repeat(counts[i], repeats)>0
+        sorted_position=np.repeat(group_start+offsets[i], repeats)+within
+        rows[i]=np.full(len(merged), -1, dtype=np.int64)
+        rows[i][found]=order[sorted_position[found]]-starts[i]
+    return merged, rows
@@ -1,4 +1,13 @@
+import os
 import sys
+import time
+import json
+import inspect
+import logging
+import threading
+import contextlib
+import copy
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
 import numpy as np
 import pandas as pd
 from statsmodels.sandbox.stats.multicomp import multipletests
@@ -6,9 +15,10 @@ from scipy import stats
 from google.cloud import bigquery
 import helper
 from helper import *
+import DAISY_local
 
 
-def ProcessGeneAlias (client, input_gene_list, database):
+def ProcessGeneAlias (client, input_gene_list, database, gene_index=None):
     '''
     Description:Enables to use  all aliases of the given gene list.
     
@@ -16,11 +26,15 @@ def ProcessGeneAlias (client, input_gene_list, database):
         client:BigQueryClient, the BigQuery client that will run the function.
         input_gene_list:list of strings, the list of gene whose SL partners are seeked
        database:string, the data resource that will be used,  valid values: "PanCancerAtlas", "DepMap"
+       gene_index:GeneIndex, optional, if given the mapping is done on the local gene index instead of BigQuery
 
     Output:
          A dictionary that maps gene symbosl in the given database to the input gene list
     
     '''
+    if gene_index is not None:
+        return(gene_index.MapGenes(database, list(input_gene_list)))
+
     pancanceratlas_genes_query="""SELECT DISTINCT Gene_Symbol from `isb-cgc-bq.pancancer_atlas.Filtered_all_CNVR_data_by_gene`
     UNION DISTINCT  
     SELECT DISTINCT Symbol from  `isb-cgc-bq.pancancer_atlas.Filtered_EBpp_AdjustPANCAN_IlluminaHiSeq_RNASeqV2_genExp`
@@ -75,7 +89,7 @@ def GetTCGASubtypes(client):
     all_tissues=client.query(query).result().to_dataframe()
     return(list(all_tissues['TCGA_subtype']))
 
-def RetrieveSamples(client, data_resource, method, tissues):
+def RetrieveSamples(client, data_resource, method, tissues, sample_index=None):
     '''
     Description:Retrieve the sample ids according to input parameters
     Inputs:
@@ -83,25 +97,33 @@ def RetrieveSamples(client, data_resource, method, tissues):
         data_source:string, valid values: "PanCancerAtlas", "CCLE" 
         method:one of DAISY inference procedures, valid values: "correlation", "sof", "func_ex"
         tissues: list of strings, the tissue type(s) that we are seeking SL pairs in.Could be one or more tissues. 
+        sample_index:SampleAvailability, optional, if given the samples are selected from the local sample availability matrix
     Output:
         A dataframe of sample ids and tissue type
     
     '''
+    if sample_index is not None:
+        return sample_index.Select(data_resource, method, tissues)
+
     min_sample_size=20;
-    input_tissues= ["'"+ str(x) + "'" for x in tissues]
-    input_tissues= ','.join(input_tissues)
+    job_config=None
+    tissue_config=bigquery.QueryJobConfig(
+    query_parameters=[
+            bigquery.ArrayQueryParameter("tissues", "STRING", [str(x) for x in tissues])
+        ]
+        )
 
     if data_resource=='PanCancerAtlas' and method=='correlation':
-        tissue_query= " AND Study in (__TISSUE__)"
+        tissue_query= " AND Study in UNNEST(@tissues)"
         sample_selection_sql='''SELECT distinct SampleBarcode FROM `isb-cgc-bq.pancancer_atlas.Filtered_EBpp_AdjustPANCAN_IlluminaHiSeq_RNASeqV2_genExp` 
     WHERE SampleType not like '%Normal%' and Study is not null '''
         if tissues.count('pancancer')==0:          
             sample_selection_sql=sample_selection_sql + tissue_query
-            sample_selection_sql= sample_selection_sql.replace('__TISSUE__', input_tissues)
-        selected_samples= list(client.query(sample_selection_sql).result().to_dataframe()['SampleBarcode'])
+            job_config=tissue_config
+        selected_samples= list(client.query(sample_selection_sql, job_config=job_config).result().to_dataframe()['SampleBarcode'])
 
     elif data_resource=='PanCancerAtlas' and method=='sof':
-        tissue_query= " WHERE  TS.Study  in (__TISSUE__)"
+        tissue_query= " WHERE  TS.Study  in UNNEST(@tissues)"
         sample_selection_sql= '''SELECT distinct SampleBarcode, Study FROM 
                 (SELECT distinct SampleBarcode, Study FROM `isb-cgc-bq.pancancer_atlas.Filtered_EBpp_AdjustPANCAN_IlluminaHiSeq_RNASeqV2_genExp`
 		WHERE SampleType not like '%Normal%'and Study is not null
@@ -114,23 +136,23 @@ def RetrieveSamples(client, data_resource, method, tissues):
 
         if tissues.count('pancancer')==0:
             sample_selection_sql=sample_selection_sql + tissue_query
-            sample_selection_sql= sample_selection_sql.replace('__TISSUE__', input_tissues)
-        selected_samples= list(client.query(sample_selection_sql).result().to_dataframe()['SampleBarcode'])
+            job_config=tissue_config
+        selected_samples= list(client.query(sample_selection_sql, job_config=job_config).result().to_dataframe()['SampleBarcode'])
 
  
     elif data_resource=='CCLE' and method=='correlation':
-        tissue_query= " AND ST.TCGA_subtype in (__TISSUE__) "
+        tissue_query= " AND ST.TCGA_subtype in UNNEST(@tissues) "
         sample_selection_sql= ''' SELECT  distinct ST.DepMap_ID FROM  `isb-cgc-bq.synthetic_lethality.sample_info_TCGAlabels_DepMapPublic_20Q3` ST,
         `isb-cgc-bq.DEPMAP.CCLE_gene_expression_DepMapPublic_current` E  
          WHERE ST.primary_disease 
         not in ('Non-Cancerous','Unknown','Engineered','Immortalized') AND E.DepMap_ID=ST.DepMap_ID '''
         if tissues.count('pancancer')==0:
             sample_selection_sql=sample_selection_sql + tissue_query
-            sample_selection_sql=sample_selection_sql.replace('__TISSUE__', input_tissues)
-        selected_samples= list(client.query(sample_selection_sql).result().to_dataframe()['DepMap_ID'])
+            job_config=tissue_config
+        selected_samples= list(client.query(sample_selection_sql, job_config=job_config).result().to_dataframe()['DepMap_ID'])
 
     elif data_resource=='CCLE' and method=='sof':
-        tissue_query=  " WHERE TS.TCGA_subtype in (__TISSUE__) "
+        tissue_query=  " WHERE TS.TCGA_subtype in UNNEST(@tissues) "
         sample_selection_sql= '''SELECT distinct DepMap_ID, TCGA_subtype FROM
                 (SELECT  distinct ST.DepMap_ID  AS DepMap_ID, ST.TCGA_subtype as TCGA_subtype
                 FROM  `isb-cgc-bq.synthetic_lethality.sample_info_TCGAlabels_DepMapPublic_20Q3` ST,
@@ -147,13 +169,13 @@ def RetrieveSamples(client, data_resource, method, tissues):
   		in ('Non-Cancerous','Unknown','Engineered','Immortalized') AND M.DepMap_ID=ST.DepMap_ID ) TS'''
         if tissues.count('pancancer')==0:
             sample_selection_sql=sample_selection_sql+ tissue_query
-            sample_selection_sql=sample_selection_sql.replace('__TISSUE__', input_tissues)
+            job_config=tissue_config
 
-        selected_samples= list(client.query(sample_selection_sql).result().to_dataframe()['DepMap_ID'])
+        selected_samples= list(client.query(sample_selection_sql, job_config=job_config).result().to_dataframe()['DepMap_ID'])
 
         
     elif data_resource=='CRISPR' and method=='func_ex':
-        tissue_query=  " WHERE TS.TCGA_subtype in (__TISSUE__) "
+        tissue_query=  " WHERE TS.TCGA_subtype in UNNEST(@tissues) "
         sample_selection_sql= '''SELECT distinct DepMap_ID, TCGA_subtype FROM
         (SELECT  distinct ST.DepMap_ID AS DepMap_ID , ST.TCGA_subtype AS TCGA_subtype FROM `isb-cgc-bq.synthetic_lethality.sample_info_TCGAlabels_DepMapPublic_20Q3` ST,     `isb-cgc-bq.DEPMAP.CCLE_gene_expression_DepMapPublic_current` E  WHERE  ST.primary_disease not
       in ('Non-Cancerous','Unknown','Engineered','Immortalized') AND E.DepMap_ID=ST.DepMap_ID 
@@ -171,12 +193,12 @@ def RetrieveSamples(client, data_resource, method, tissues):
       in ('Non-Cancerous','Unknown','Engineered','Immortalized') AND A.DepMap_ID=ST.DepMap_ID)  TS'''
         if tissues.count('pancancer')==0:
             sample_selection_sql=sample_selection_sql+ tissue_query
-            sample_selection_sql=sample_selection_sql.replace('__TISSUE__', input_tissues)
-        selected_samples= list(client.query(sample_selection_sql).result().to_dataframe()['DepMap_ID'])
+            job_config=tissue_config
+        selected_samples= list(client.query(sample_selection_sql, job_config=job_config).result().to_dataframe()['DepMap_ID'])
 
 
     elif data_resource=='shRNA' and method=='func_ex':
-        tissue_query="WHERE TS.TCGA_subtype in (__TISSUE__)"
+        tissue_query="WHERE TS.TCGA_subtype in UNNEST(@tissues)"
         sample_selection_sql= '''SELECT CCLE_Name, DepMap_ID FROM
       (SELECT distinct ST.CCLE_Name AS CCLE_Name, ST.DepMap_ID  AS DepMap_ID, ST.TCGA_subtype AS TCGA_subtype  FROM
      `isb-cgc-bq.synthetic_lethality.sample_info_TCGAlabels_DepMapPublic_20Q3` ST,
@@ -205,30 +227,761 @@ def RetrieveSamples(client, data_resource, method, tissues):
 
         if tissues.count('pancancer')==0:
             sample_selection_sql=sample_selection_sql+ tissue_query
-            sample_selection_sql=sample_selection_sql.replace('__TISSUE__', input_tissues)
-        selected_samples= client.query(sample_selection_sql).result().to_dataframe()
+            job_config=tissue_config
+        selected_samples= client.query(sample_selection_sql, job_config=job_config).result().to_dataframe()
 
 
     return selected_samples
 
-def CoexpressionAnalysis(client, SL_or_SDL, data_resource, input_genes, adj_method, fdr_level, tissues):
+def LoadExpressionMatrix(client, table_name, gene_col_name, exp_name, sample_barcode, selected_samples, snapshot=None):
+    '''
+    Description: Loads the expression values of the selected samples as a dense samples x genes matrix,
+    replicates are averaged as in the coexpression query.
+    Inputs:
+        client:BigQueryClient, the BigQuery client that will run the function.
+        table_name:string, the expression table
+        gene_col_name:string, the gene symbol column of the table
+        exp_name:string, the expression column of the table
+        sample_barcode:string, the sample id column of the table
+        selected_samples:list of strings, the samples that will be loaded
+        snapshot:SnapshotStore, optional, if given the values are read from the local snapshot of the table instead of BigQuery
+    Output:
+        A tuple of (float32 samples x genes matrix, list of sample ids, list of gene symbols), missing values are np.nan
+    '''
+    sql_expression='''
+    SELECT __GENE_SYMBOL__ AS symbol, __SAMPLE_ID__ AS ParticipantBarcode, AVG(__EXP_NAME__) AS data
+    FROM `__TABLE_NAME__`
+    WHERE __GENE_SYMBOL__ IS NOT NULL AND __EXP_NAME__ IS NOT NULL AND __SAMPLE_ID__ in UNNEST(@samples)
+    GROUP BY ParticipantBarcode, symbol '''
+
+    if snapshot is not None:
+        long_table=snapshot.Read(table_name, columns=[gene_col_name, sample_barcode, exp_name],
+                                 filters={sample_barcode:[str(x) for x in selected_samples]})
+        long_table=long_table.dropna()
+        long_table=long_table.groupby([sample_barcode, gene_col_name], as_index=False, observed=True)[exp_name].mean()
+        return(_LongToMatrix(long_table, sample_barcode, gene_col_name, exp_name))
+
+    job_config = bigquery.QueryJobConfig(
+    query_parameters=[
+            bigquery.ArrayQueryParameter("samples", "STRING", [str(x) for x in selected_samples])
+        ]
+        )
+
+    sql_expression = sql_expression.replace('__TABLE_NAME__', table_name)
+    sql_expression = sql_expression.replace('__GENE_SYMBOL__', gene_col_name)
+    sql_expression = sql_expression.replace('__EXP_NAME__', exp_name)
+    sql_expression = sql_expression.replace('__SAMPLE_ID__', sample_barcode)
+
+    long_table= ReadResults(client, sql_expression, job_config, symbol_columns=['symbol', 'ParticipantBarcode'])
+    return(_LongToMatrix(long_table, 'ParticipantBarcode', 'symbol', 'data'))
+
+
+def _LongToMatrix(long_table, sample_col, gene_col, value_col):
+    samples=pd.Categorical(long_table[sample_col])
+    genes=pd.Categorical(long_table[gene_col])
+    matrix=np.full((len(samples.categories), len(genes.categories)), np.nan, dtype=np.float32)
+    matrix[samples.codes, genes.codes]=long_table[value_col].to_numpy(dtype=np.float32)
+    return(matrix, list(samples.categories), list(genes.categories))
+
+
+def _LocalCoexpression(expression_data, sample_groups, input_genes, top_k=None, top_by='correlation', all_partners=False):
+    matrix, samples, genes= expression_data
+    sample_rows={samples[i]:i for i in range(len(samples))}
+    results=[]
+    for grp in range(len(sample_groups)):
+        rows=[sample_rows[x] for x in pd.unique(np.asarray(sample_groups[grp], dtype=object)) if x in sample_rows]
+        ranks=DAISY_local.RankData(matrix[rows, :])
+        if top_k is None:
+            pairs=DAISY_local.CoexpressionPairs(ranks, genes, input_genes, min_samples=20, all_partners=all_partners)
+        else:
+            pairs=DAISY_local.CoexpressionTopPairs(ranks, genes, input_genes, top_k, top_by, min_samples=20)
+        pairs.insert(0, 'grp', grp)
+        results.append(pairs)
+    return(pd.concat(results, ignore_index=True))
+
+
+# the (grp, Barcode) rows of the sample groups, passed as two parallel array parameters (see _SampleGroupsParameters)
+SAMPLE_GROUPS_SQL="""SELECT grp, Barcode FROM UNNEST(@group_ids) AS grp WITH OFFSET AS grp_position
+    INNER JOIN UNNEST(@group_barcodes) AS Barcode WITH OFFSET AS barcode_position
+    ON grp_position = barcode_position"""
+
+
+def _SampleGroupsParameters(sample_groups):
+    group_ids=[]
+    group_barcodes=[]
+    for grp in range(len(sample_groups)):
+        for x in pd.unique(np.asarray(sample_groups[grp], dtype=object)):
+            group_ids.append(grp)
+            group_barcodes.append(str(x))
+    return([bigquery.ArrayQueryParameter("group_ids", "INT64", group_ids),
+            bigquery.ArrayQueryParameter("group_barcodes", "STRING", group_barcodes)])
+
+
+def _PancancerSamples(client, data_resource, method, tissue_groups, sample_groups, sample_index, metrics, procedure_name):
+    # the samples of the pancancer selection the rank tables are built over, reused when one of the groups selects them
+    for grp in range(len(tissue_groups)):
+        if 'pancancer' in tissue_groups[grp]:
+            return(sample_groups[grp])
+    return(_Traced(metrics, 'sample selection', procedure_name, RetrieveSamples, client, data_resource, method, ['pancancer'], sample_index))
+
+
+def _FullGroups(sample_groups, pancancer_samples):
+    # the groups selecting every sample of the rank table, whose ranks are those of the table
+    universe=set(str(x) for x in pancancer_samples)
+    return([grp for grp in range(len(sample_groups)) if len(universe)>0 and universe<=set(str(x) for x in sample_groups[grp])])
+
+
+def _RankTableCTE(name, sample_column, gene_filter, n_groups, full_groups):
+    # the CTE of the ranks of the selected samples read from a rank table (see RankTables): the groups in full_groups take
+    # rnk + (n_ties-1)/2 as it is, the other groups are re-ranked on rnk. Without groups (n_groups None) the samples are @samples.
+    if n_groups is None:
+        columns='R.symbol, R.sample AS ' + sample_column
+        source='`__RANK_TABLE__` R'
+        conditions=[gene_filter, 'R.sample IN UNNEST(@samples)']
+        partition='R.symbol'
+        n_groups=1
+    else:
+        columns='G.grp, R.symbol, R.sample AS ' + sample_column
+        source='`__RANK_TABLE__` R\n   INNER JOIN sample_groups G ON R.sample = G.Barcode'
+        conditions=[gene_filter]
+        partition='G.grp, R.symbol'
+    ranks=[]
+    if len(full_groups)>0:
+        ranks.append(('R.rnk + (R.n_ties - 1)/2.0', 'G.grp IN UNNEST(@full_groups)'))
+    if len(full_groups)<n_groups:
+        ranks.append(('(RANK() OVER (PARTITION BY ' + partition + ' ORDER BY R.rnk ASC)) + (COUNT(*) OVER ( PARTITION BY ' + partition +
+                      ', R.rnk) - 1)/2.0', 'G.grp NOT IN UNNEST(@full_groups)'))
+    parameters=[]
+    if len(ranks)>1:
+        parameters.append(bigquery.ArrayQueryParameter("full_groups", "INT64", list(full_groups)))
+    selects=[]
+    for rank, group_condition in ranks:
+        where=conditions + ([group_condition] if len(ranks)>1 else [])
+        selects.append('SELECT ' + columns + ',\n   ' + rank + ' AS rnkdata\n   FROM ' + source + '\n   WHERE ' + ' AND '.join(where))
+    return('    ' + name + ' AS (\n   ' + '\n   UNION ALL\n   '.join(selects) + '\n    )\n', parameters)
+
+
+def _TopKTests(report, fdr_level):
+    # number of tests behind every p value of a top-k report, the pairs dropped by the top-k selection count as tests
+    db_tests=report.drop_duplicates('InactiveDB')[['Inactive', 'n_tests']]
+    if fdr_level=="gene_level":
+        return(report['Inactive'].map(db_tests.groupby('Inactive')['n_tests'].sum()).values)
+    return(np.full(report.shape[0], db_tests['n_tests'].sum()))
+
+
+class QueryMetrics:
+    '''
+    Description: The queries of a DAISY run, filled by the procedures given max_bytes_billed, plan_only or a metrics object.
+    Every record has the stage of the query ("sample selection", "alias lookup" or "main statistic"), the job id, the bytes
+    estimated by the dry run (plan_only) and the bytes processed and billed and the slot milliseconds of the job (actual runs).
+    The bytes the running jobs can still bill are reserved against max_bytes_billed until they are recorded.
+    '''
+    def __init__(self):
+        self.records=[]
+        self._reserved=0
+        self._lock=threading.Lock()
+
+    def Add(self, stage, job_id=None, estimated_bytes=0, bytes_processed=0, bytes_billed=0, slot_ms=0, cache_hit=False):
+        with self._lock:
+            self.records.append({'stage':stage, 'job_id':job_id, 'estimated_bytes':estimated_bytes or 0, 'bytes_processed':bytes_processed or 0,
+                                 'bytes_billed':bytes_billed or 0, 'slot_ms':slot_ms or 0, 'cache_hit':bool(cache_hit)})
+
+    def Table(self):
+        with self._lock:
+            return(pd.DataFrame(self.records, columns=['stage', 'job_id', 'estimated_bytes', 'bytes_processed', 'bytes_billed', 'slot_ms', 'cache_hit']))
+
+    def Summary(self):
+        # the number of queries and the total bytes and slot milliseconds of every stage
+        table=self.Table()
+        summary=table.groupby('stage', sort=False)[['estimated_bytes', 'bytes_processed', 'bytes_billed', 'slot_ms']].sum()
+        summary.insert(0, 'queries', table.groupby('stage', sort=False).size())
+        return(summary)
+
+    def EstimatedBytes(self):
+        return(int(self.Table()['estimated_bytes'].sum()))
+
+    def BilledBytes(self):
+        return(int(self.Table()['bytes_billed'].sum()))
+
+    def Reserve(self, budget, estimated_bytes, max_bytes):
+        # reserves up to max_bytes of what the billed and reserved bytes leave of the budget, 0 when the estimate does not fit
+        with self._lock:
+            left=int(budget)-sum(x['bytes_billed'] for x in self.records)-self._reserved
+            if left<=0 or estimated_bytes>left:
+                return(0)
+            reserved=min(int(max_bytes), left)
+            self._reserved+=reserved
+            return(reserved)
+
+    def Release(self, reserved):
+        with self._lock:
+            self._reserved-=reserved
+
+    def __repr__(self):
+        return(repr(self.Summary()))
+
+
+class MemorySink:
+    '''
+    Description: StageTracer sink keeping the stage records in memory, e.g. to collect the stages of several runs in one table
+    '''
+    def __init__(self):
+        self.records=[]
+        self._lock=threading.Lock()
+
+    def Write(self, record):
+        with self._lock:
+            self.records.append(dict(record))
+
+    def Table(self):
+        with self._lock:
+            return(pd.DataFrame(self.records))
+
+
+class JsonLinesSink:
+    '''
+    Description: StageTracer sink appending every stage record to a JSON lines file as soon as the stage ends
+    Inputs:
+        path:string, the file the records are appended to
+    '''
+    def __init__(self, path):
+        self.path=path
+        self._lock=threading.Lock()
+
+    def Write(self, record):
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record, default=str) + '\n')
+
+
+class LoggingSink:
+    '''
+    Description: StageTracer sink logging one line per stage
+    Inputs:
+        logger:Logger, optional, the logger of the records, the "DAISY" logger by default
+        level:integer, optional, the level of the records
+    '''
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger=logging.getLogger('DAISY') if logger is None else logger
+        self.level=level
+
+    def Write(self, record):
+        self.logger.log(self.level, '%s %s: %.3f s (%.3f s in jobs), %d queries, %d bytes processed, cache hit %s, %s rows',
+                        record['procedure'], record['stage'], record['wall_s'], record['job_wait_s'], record['queries'],
+                        record['bytes_processed'], record['cache_hit'], record['rows'])
+
+
+class StageTracer(QueryMetrics):
+    '''
+    Description: QueryMetrics that also times the stages of the DAISY procedures given it as their metrics: the sample selection
+    (RetrieveSamples), the alias lookup (ProcessGeneAlias), the main statistic (the main query and the download of its results,
+    or the local engine) and the report (FDR adjustment). Every stage gets a record with its procedure, wall time, the time spent
+    waiting for BigQuery jobs, the job ids, bytes processed and billed and cache hit of its queries and the rows it returned,
+    which is written to every sink when the stage ends.
+    Inputs:
+        sinks:list, optional, objects with a Write(record) method, e.g. MemorySink, JsonLinesSink, LoggingSink
+    '''
+    def __init__(self, sinks=None):
+        super().__init__()
+        self.sinks=[] if sinks is None else list(sinks)
+        self.stages=[]
+        self._local=threading.local()
+
+    def _Open(self):
+        # the stages open in the current thread, the innermost last
+        if not hasattr(self._local, 'stages'):
+            self._local.stages=[]
+        return(self._local.stages)
+
+    @contextlib.contextmanager
+    def Stage(self, stage, procedure=None):
+        '''
+        Description: Context manager timing a stage, it yields the record of the stage, whose rows can be set by the caller.
+        Stages can be nested, a nested stage has the procedure of the enclosing one unless given.
+        '''
+        open_stages=self._Open()
+        if procedure is None and len(open_stages)>0:
+            procedure=open_stages[-1]['procedure']
+        record={'procedure':procedure, 'stage':stage, 'start':time.time(), 'wall_s':0.0, 'job_wait_s':0.0, 'queries':0, 'job_id':None,
+                'bytes_processed':0, 'bytes_billed':0, 'cache_hit':None, 'rows':None, 'thread':threading.current_thread().name}
+        open_stages.append(record)
+        started=time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['wall_s']=time.perf_counter()-started
+            open_stages.remove(record)
+            with self._lock:
+                self.stages.append(record)
+            for sink in self.sinks:
+                sink.Write(record)
+
+    def Add(self, stage, job_id=None, estimated_bytes=0, bytes_processed=0, bytes_billed=0, slot_ms=0, cache_hit=False):
+        super().Add(stage, job_id, estimated_bytes, bytes_processed, bytes_billed, slot_ms, cache_hit)
+        # the query belongs to the innermost stage open in this thread
+        open_stages=self._Open()
+        if len(open_stages)>0:
+            record=open_stages[-1]
+            record['queries']+=1
+            if job_id is not None:
+                record['job_id']=str(job_id) if record['job_id'] is None else record['job_id'] + ',' + str(job_id)
+            record['bytes_processed']+=bytes_processed or 0
+            record['bytes_billed']+=bytes_billed or 0
+            record['cache_hit']=bool(cache_hit) if record['cache_hit'] is None else record['cache_hit'] and bool(cache_hit)
+
+    def JobWait(self, seconds):
+        open_stages=self._Open()
+        if len(open_stages)>0:
+            open_stages[-1]['job_wait_s']+=seconds
+
+    def StageTable(self):
+        with self._lock:
+            return(pd.DataFrame(self.stages, columns=['procedure', 'stage', 'start', 'wall_s', 'job_wait_s', 'queries', 'job_id',
+                                                      'bytes_processed', 'bytes_billed', 'cache_hit', 'rows', 'thread']))
+
+    def StageSummary(self):
+        '''
+        Description: The number of calls, total wall time, job wait time, queries, bytes and rows of every stage of every procedure,
+        the wall time of a stage includes the stages nested in it
+        '''
+        table=self.StageTable()
+        table['procedure']=table['procedure'].fillna('')
+        table['cache_hits']=table['cache_hit'].fillna(False).astype(bool)
+        summary=table.groupby(['procedure', 'stage'], sort=False).agg(calls=('stage', 'size'), wall_s=('wall_s', 'sum'),
+                                                                     job_wait_s=('job_wait_s', 'sum'), queries=('queries', 'sum'),
+                                                                     bytes_processed=('bytes_processed', 'sum'), cache_hits=('cache_hits', 'sum'),
+                                                                     rows=('rows', 'sum'))
+        return(summary.round({'wall_s':3, 'job_wait_s':3}))
+
+
+def _Traced(metrics, stage, procedure, function, *args, **kwargs):
+    # calls function as a stage of the procedure, timed when the metrics are a StageTracer
+    if not isinstance(metrics, StageTracer):
+        return(function(*args, **kwargs))
+    with metrics.Stage(stage, procedure) as record:
+        result=function(*args, **kwargs)
+        if isinstance(result, (pd.DataFrame, pd.Series, np.ndarray, list, dict)):
+            record['rows']=len(result)
+    return(result)
+
+
+class _MeteredJob:
+    # query job whose statistics are recorded once its results are ready, its reserved bytes are released then
+
+    def __init__(self, job, metrics, stage, reserved=0):
+        self.job=job
+        self.metrics=metrics
+        self.stage=stage
+        self.reserved=reserved
+
+    def result(self):
+        started=time.perf_counter()
+        try:
+            rows=self.job.result()
+            if isinstance(self.metrics, StageTracer):
+                self.metrics.JobWait(time.perf_counter()-started)
+            self.metrics.Add(self.stage, getattr(self.job, 'job_id', None), bytes_processed=getattr(self.job, 'total_bytes_processed', 0),
+                             bytes_billed=getattr(self.job, 'total_bytes_billed', 0), slot_ms=getattr(self.job, 'slot_millis', 0),
+                             cache_hit=getattr(self.job, 'cache_hit', False))
+        finally:
+            self.metrics.Release(self.reserved)
+            self.reserved=0
+        return(rows)
+
+
+class BudgetExceeded(Exception):
+    # raised instead of submitting a query job when what is left of max_bytes_billed can not cover its estimate
+    pass
+
+
+# BigQuery bills at least 10 MB of every table a query references
+MIN_BILLED_BYTES_PER_TABLE=10*2**20
+
+
+class _StageClient:
+    # BigQuery client of one stage of a procedure. With plan_only every query is a dry run whose estimated bytes are recorded,
+    # its results are empty (with the columns of the query) so the procedure can go on generating its later queries.
+    # Otherwise the jobs are capped to the part of the byte budget they reserve (see QueryMetrics.Reserve) and their statistics are recorded.
+
+    def __init__(self, client, metrics, stage, plan_only=False, max_bytes_billed=None):
+        self.client=client
+        self.metrics=metrics
+        self.stage=stage
+        self.plan_only=plan_only
+        self.max_bytes_billed=max_bytes_billed
+
+    def query(self, sql, job_config=None):
+        if job_config is None:
+            job_config=bigquery.QueryJobConfig()
+        if self.plan_only:
+            job_config.dry_run=True
+            job_config.use_query_cache=False
+            job=self.client.query(sql, job_config=job_config)
+            self.metrics.Add(self.stage, estimated_bytes=job.total_bytes_processed)
+            return(LocalResults(pd.DataFrame(columns=[field.name for field in (job.schema or [])])))
+        if self.max_bytes_billed is None:
+            return(_MeteredJob(self.client.query(sql, job_config=job_config), self.metrics, self.stage))
+        # the jobs running at the same time share the budget: every job reserves what it can bill at most before it is
+        # submitted and is capped to its reservation
+        dry_run=copy.deepcopy(job_config)
+        dry_run.dry_run=True
+        dry_run.use_query_cache=False
+        plan=self.client.query(sql, job_config=dry_run)
+        estimated_bytes=plan.total_bytes_processed or 0
+        max_bytes=estimated_bytes + MIN_BILLED_BYTES_PER_TABLE*max(len(getattr(plan, 'referenced_tables', None) or []), 1)
+        reserved=self.metrics.Reserve(self.max_bytes_billed, estimated_bytes, max_bytes)
+        if reserved==0:
+            raise BudgetExceeded("The " + self.stage + " query would process " + str(round(estimated_bytes/1e9, 2)) + " GB, more than is left of " +
+                                 "max_bytes_billed (" + str(round(int(self.max_bytes_billed)/1e9, 2)) + " GB)")
+        job_config.maximum_bytes_billed=reserved
+        try:
+            job=self.client.query(sql, job_config=job_config)
+        except Exception:
+            self.metrics.Release(reserved)
+            raise
+        return(_MeteredJob(job, self.metrics, self.stage, reserved))
+
+
+def _StageClients(client, metrics, plan_only, max_bytes_billed):
+    # the sample selection, alias lookup and main statistic clients of a procedure, the plain client when nothing is metered
+    stages=['sample selection', 'alias lookup', 'main statistic']
+    if metrics is None:
+        return([client]*len(stages))
+    return([_StageClient(client, metrics, stage, plan_only, max_bytes_billed) for stage in stages])
+
+
+class _CheckedBudget(int):
+    # max_bytes_billed whose plan the caller (DAISYPipeline) already checked, the procedures cap their jobs to it without planning again
+    pass
+
+
+def _WithinBudget(plan, max_bytes_billed):
+    if not isinstance(plan, QueryMetrics):
+        return(False)
+    if plan.EstimatedBytes()>max_bytes_billed:
+        print("The analysis would process " + str(round(plan.EstimatedBytes()/1e9, 2)) + " GB, more than max_bytes_billed (" +
+              str(round(max_bytes_billed/1e9, 2)) + " GB), it is not run.")
+        print(plan.Summary())
+        return(False)
+    return(True)
+
+
+def _CachedResults(result_cache, gene_list, procedure, data_resource, tissue_groups, parameters, tables):
+    # the cached per-gene results of every tissue group and the genes missing from the cache in at least one group, a missing gene
+    # is computed for all the groups so its cached results are dropped
+    cached=[]
+    missing=[]
+    for grp in range(len(tissue_groups)):
+        for gene in pd.unique(np.asarray(gene_list, dtype=object)):
+            results=result_cache.Get(procedure, result_cache.Key(procedure, data_resource, gene, tissue_groups[grp], parameters, tables))
+            if results is None:
+                missing.append(gene)
+            else:
+                results.insert(0, 'grp', grp)
+                cached.append((gene, results))
+    missing=list(pd.unique(np.asarray(missing, dtype=object)))
+    computed=set(missing)
+    return([results for gene, results in cached if gene not in computed], missing)
+
+
+def _StoreResults(result_cache, results, cached, missing, procedure, data_resource, tissue_groups, parameters, tables):
+    # caches the results of the missing genes per (gene, tissue group) and splices them with the cached ones
+    if results is not None and results.shape[0]>0:
+        results=results.copy()
+        results['symbol1']=results['symbol1'].astype(str)
+        by_gene={key:rows for key, rows in results.groupby(['grp', 'symbol1'], sort=False)}
+        empty=results.iloc[:0]
+    elif results is not None and results.shape[1]>0:
+        by_gene={}
+        empty=results
+    else:
+        by_gene={}
+        empty=cached[0].iloc[:0] if len(cached)>0 else None
+    if empty is not None:
+        for grp in range(len(tissue_groups)):
+            for gene in missing:
+                rows=by_gene.get((grp, gene), empty)
+                result_cache.Put(procedure, result_cache.Key(procedure, data_resource, gene, tissue_groups[grp], parameters, tables),
+                                 rows.drop(columns='grp', errors='ignore'))
+    frames=[x for x in cached + [results] if x is not None and x.shape[0]>0]
+    if len(frames)==0:
+        return(pd.DataFrame() if results is None else results)
+    results=pd.concat(frames, ignore_index=True)
+    for col in ('symbol1', 'symbol2'):
+        results[col]=results[col].astype(str)
+    return(results)
+
+
+def _CacheSources(engine, rank_tables, sample_index):
+    # the cache parameters of where the results come from: the local engines average the copy number replicates and
+    # correlate in float32, and the samples of the local sample index may differ from the ones selected in BigQuery
+    while isinstance(sample_index, _SharedLookups):
+        sample_index=sample_index.sample_index
+    return({'engine':engine, 'rank_tables':rank_tables is not None and engine=='bigquery',
+            'sample_index':'bigquery' if sample_index is None else type(sample_index).__name__})
+
+
+def _Tails(SL_or_SDL):
+    # the analyses of one call, "both" runs the SL (low tail) and SDL (high tail) analyses from the same scan of the data
+    if SL_or_SDL=="both":
+        return(['SL', 'SDL'])
+    if SL_or_SDL in ("SL", "SDL"):
+        return([SL_or_SDL])
+    print("SL_or_SDL can be either SL, SDL or both")
+    return(None)
+
+
+def _TailThresholds(threshold, tails):
+    # one threshold per tail, a single value is used for every tail
+    if np.ndim(threshold)==0:
+        return([threshold]*len(tails))
+    if len(threshold)!=len(tails):
+        print("The thresholds need one value, or one value per analysis (SL, SDL) when SL_or_SDL is both")
+        return(None)
+    return(list(threshold))
+
+
+def _TailCondition(column, tails, thresholds):
+    # the WHERE condition of the inactive (SL) or overactive (SDL) rows, the tail column tells the two analyses of "both" apart
+    conditions=[column + (' <' if tails[t]=="SL" else ' >') + str(thresholds[t]) for t in range(len(tails))]
+    if len(tails)==1:
+        return(conditions[0])
+    return('(' + ' OR '.join(['tail = ' + str(t) + ' AND ' + conditions[t] for t in range(len(tails))]) + ')')
+
+
+def _TailSQL(sql, tails, n_columns):
+    # fills the tail placeholders of the SurvivalOfFittest and FunctionalExamination queries, with two tails every row of
+    # table1 is repeated once per tail and the statistics are grouped by tail
+    both=len(tails)>1
+    sql=sql.replace('__TAILS__', 'CROSS JOIN UNNEST([0, 1]) AS tail' if both else '')
+    sql=sql.replace('__TAIL_COLUMN__', 'tail, ' if both else '')
+    sql=sql.replace('__N1_TAIL__', 'n1.tail AS tail, ' if both else '')
+    sql=sql.replace('__MUTATION_TAIL__', '0 AS tail, ' if both else '')
+    sql=sql.replace('__TAIL_ORDINAL__', ',' + str(n_columns+1) if both else '')
+    return(sql)
+
+
+def _TailCachedResults(result_cache, gene_list, cache_args):
+    # _CachedResults of every tail, a gene missing from the cache of one tail is computed for all tails
+    cached=[]
+    missing=[]
+    for args in cache_args:
+        tail_cached, tail_missing=_CachedResults(result_cache, gene_list, *args)
+        cached.append(tail_cached)
+        missing+=tail_missing
+    missing=list(pd.unique(np.asarray(missing, dtype=object)))
+    computed=set(missing)
+    cached=[[x for x in tail_cached if x.shape[0]==0 or x['symbol1'].iloc[0] not in computed] for tail_cached in cached]
+    return(cached, missing)
+
+
+def _TailStoreResults(result_cache, results, cached, missing, cache_args):
+    # _StoreResults of every tail, the rows of the tails are told apart by the tail column
+    if len(cache_args)==1:
+        return(_StoreResults(result_cache, results, cached[0], missing, *cache_args[0]))
+    tail_results=[]
+    for t in range(len(cache_args)):
+        rows=None
+        if results is not None and 'tail' in results.columns:
+            rows=results.loc[results['tail']==t].drop(columns='tail')
+        tail_results.append(_StoreResults(result_cache, rows, cached[t], missing, *cache_args[t]).assign(tail=t))
+    return(pd.concat(tail_results, ignore_index=True))
+
+
+def _TailResults(results, tails, t):
+    # the rows of the t-th tail
+    if len(tails)==1 or 'tail' not in results.columns:
+        return(results)
+    return(results.loc[results['tail']==t].drop(columns='tail'))
+
+
+def _TailReports(reports, tails):
+    # the report of a single analysis, or the dictionary of the SL and SDL reports of "both"
+    if len(tails)==1:
+        return(reports[tails[0]])
+    return(reports)
+
+
+# The gene symbol columns of the DAISY reports, they share one dictionary of symbols
+REPORT_SYMBOL_COLUMNS=['Inactive', 'InactiveDB', 'Overactive', 'OveractiveDB', 'SL_Candidate']
+
+
+def _SharedCategories(reports, columns):
+    # the columns of all the reports as categoricals over one sorted dictionary of their values
+    columns=[col for col in columns if col in reports[0].columns]
+    if len(columns)==0:
+        return(reports)
+    values=[x[col].astype('category').cat.categories for x in reports for col in columns]
+    dtype=pd.CategoricalDtype(values[0].append(values[1:]).unique().sort_values())
+    return([x.astype({col:dtype for col in columns}) for x in reports])
+
+
+def _CompactReport(report):
+    # The symbols as categoricals over a dictionary shared by the symbol columns, the tissues as a categorical, the sample counts
+    # as int32 and the correlations as float32. P values and FDRs stay float64, they can be smaller than the float32 range.
+    report=_SharedCategories([report], REPORT_SYMBOL_COLUMNS)[0]
+    report=report.astype({col:np.int32 for col in ('#Samples', '#InactiveSamples', '#Overactive') if col in report.columns})
+    if 'Correlation' in report.columns:
+        report['Correlation']=report['Correlation'].astype(np.float32)
+    if 'Tissue' in report.columns:
+        report['Tissue']=report['Tissue'].astype('category')
+    return(report)
+
+
+def _ConcatReports(reports):
+    # concatenates compact reports, their categorical columns are recoded to shared dictionaries first so they stay categorical
+    reports=_SharedCategories(reports, REPORT_SYMBOL_COLUMNS)
+    reports=_SharedCategories(reports, ['Tissue'])
+    return(pd.concat(reports, ignore_index=True))
+
+
+def ReportMemory(report, n_pairs=1000000):
+    '''
+    Description: The memory a report takes per n_pairs pairs (a million by default), per column and in total, in MB
+    Inputs:
+        report:dataframe, a DAISY report
+        n_pairs:integer, the number of pairs the memory is scaled to
+    Output:
+        A series of the MB per n_pairs pairs of every column and their total
+    '''
+    memory=report.memory_usage(index=False, deep=True)*n_pairs/max(report.shape[0], 1)/1e6
+    memory['total']=memory.sum()
+    return(memory.round(2))
+
+
+def BenchmarkReportMemory(n_pairs=1000000, n_genes=500, n_candidates=18000, seed=0):
+    '''
+    Description: The memory per million pairs of a synthetic survival of the fittest report, in the compact form of the report
+    builders and with object symbols and float64/int64 statistics as the reports were before. With the defaults (500 input genes,
+    18000 candidates, 10 character symbols) the compact report takes about 34 MB per million pairs against about 312 MB
+    with Python string symbols and tissues.
+    Inputs:
+        n_pairs:integer, the number of pairs of the synthetic report
+        n_genes:integer, the number of input genes
+        n_candidates:integer, the number of SL candidates
+        seed:integer, the seed of the random report
+    Output:
+        A dataframe of the MB per million pairs of every column (and in total) of the 'object' and 'compact' reports
+    '''
+    rng=np.random.default_rng(seed)
+    symbols=np.array(['GENE' + str(x).zfill(6) for x in range(n_candidates)], dtype=object)
+    genes=symbols[rng.integers(0, n_candidates, n_pairs)][np.argsort(rng.integers(0, n_genes, n_pairs), kind='stable')]
+    report=pd.DataFrame({'Inactive':pd.Series(genes, dtype=object), 'InactiveDB':pd.Series(genes, dtype=object),
+                         'SL_Candidate':pd.Series(symbols[rng.integers(0, n_candidates, n_pairs)], dtype=object),
+                         '#InactiveSamples':rng.integers(5, 100, n_pairs), '#Samples':np.full(n_pairs, 1000),
+                         'PValue':rng.random(n_pairs), 'FDR':rng.random(n_pairs),
+                         'Tissue':pd.Series([str(['BRCA', 'LUAD', 'OV'])]*n_pairs, dtype=object)})
+    return(pd.DataFrame({'object':ReportMemory(report), 'compact':ReportMemory(_CompactReport(report))}))
+
+
+def _CoexpressionReport(results, gene_mapping, SL_or_SDL, adj_method, fdr_level, tissues):
+    columns=['symbol1', 'symbol2', 'n', 'correlation', 'pvalue']
+    if 'n_tests' in results.columns:
+        columns.append('n_tests')
+    report=results[columns]
+    report=report.dropna()
+    report.columns=['InactiveDB', 'SL_Candidate', '#Samples', 'Correlation', 'PValue'] + columns[5:]
+    report['Inactive']= report['InactiveDB'].map(gene_mapping)
+    if 'n_tests' in report.columns and fdr_level in ("gene_level", "analysis_level"):
+        groups=report['Inactive'].values if fdr_level=="gene_level" else np.zeros(report.shape[0])
+        report['FDR']=DAISY_local.GroupedMultipleTests(report['PValue'].values, groups, adj_method, _TopKTests(report, fdr_level))
+
+    elif fdr_level=="gene_level":
+        report['FDR']=DAISY_local.GroupedMultipleTests(report['PValue'].values, report['Inactive'].values, adj_method)
+
+    elif fdr_level=="analysis_level":
+       FDR=multipletests(report['PValue'],  method= adj_method, is_sorted=False)[1]
+       report['FDR']=FDR
+    else:
+      print("FDR level can be either gene_level or analysis_level")
+      return()
+ 
+    report['Tissue']=str(tissues)
+    cols=['Inactive', 'InactiveDB', 'SL_Candidate', '#Samples', 'Correlation', 'PValue', 'FDR', 'Tissue']
+    report=report[cols]
+    if SL_or_SDL=="SDL":
+      report.columns= ['Overactive', 'OveractiveDB', 'SL_Candidate', '#Samples', 'Correlation', 'PValue', 'FDR', 'Tissue']
+    return _CompactReport(report)
+
+
+def CoexpressionAnalysis(client, SL_or_SDL, data_resource, input_genes, adj_method, fdr_level, tissues, engine='bigquery', expression_data=None, snapshot=None, gene_index=None, sample_index=None, rank_tables=None, top_k=None, top_by='correlation', max_bytes_billed=None, plan_only=False, metrics=None, result_cache=None):
 
     '''
    Description: "The gene correlation information is used to detect SL pairs."
 
    Inputs:
     client:BigQueryClient, the BigQuery client that will run the function.
-    SL_or_SDL:string, Synthetic lethal or Synthetic Dosage Lethal, valid values: 'SL', 'SDL'
+    SL_or_SDL:string, Synthetic lethal or Synthetic Dosage Lethal, valid values: 'SL', 'SDL', 'both'
+        "both" computes the correlations once and reports them as both SL and SDL pairs
     data_resource: string, The dataresource the analysis will be performed on, 	valid values: "CCLE", "PanCancerAtlas"
     input_genes:list of strings, the list of genes whose SL/SDL partners will be seeked	
     adj_method:	string,	optional, p value correction method,  valid_values:bonferroni,  sidak, holm-sidak , holm, simes-hochberg , hommel, fdr_bh,  fdr_by , fdr_tsbh, fdr_tsbky 
     fdr_level:string, the data that will be considered wile doing p value adjustment, valid values : "gene_level", "analysis_level"
     tissues: The tissues that the analysis will be performed on. 
+    engine:string, optional, where the correlations are computed, valid values: "bigquery", "local"
+        "local" loads the expression matrix once and computes all correlations with numpy
+    expression_data:tuple, optional, the output of LoadExpressionMatrix, reused by the local engine instead of loading the matrix again
+    snapshot:SnapshotStore, optional, the local Parquet snapshots the local engine loads the expression matrix from
+    gene_index:GeneIndex, optional, the local gene index used to map the input genes to their aliases
+    sample_index:SampleAvailability, optional, the local sample availability matrix the samples are selected from
+    rank_tables:RankTables, optional, if given the bigquery engine reads the ranks from the precomputed per-release rank tables
+    top_k:integer, optional, if given only the top_k partners of every input gene are kept, which bounds the size of the
+        genome-wide results. The p values are still adjusted over all the partners of the gene.
+    top_by:string, optional, how the top_k partners are chosen, valid values: "correlation" (largest absolute correlation), "FDR"
+    max_bytes_billed:integer, optional, the byte budget of the analysis. The queries are dry run first and the analysis is not run
+        when their estimated bytes exceed the budget. Every job also reserves the bytes it can bill at most out of what is left of
+        the budget and is capped to them, a job that no longer fits raises BudgetExceeded. With the local engine the jobs are only capped.
+    plan_only:boolean, optional, if True the queries are only dry run and the QueryMetrics with their estimated bytes per stage is returned.
+        The estimates do not depend on the samples and genes, except for the pruning of clustered tables.
+    metrics:QueryMetrics, optional, filled with the stage, bytes processed and billed and slot milliseconds of every query,
+        a StageTracer also times the sample selection, alias lookup, main statistic and report stages
+    result_cache:ResultCache, optional, if given the per-gene results are read from the cache and only the genes missing from it are computed
+
+    Output:
+    A dataframe of SL/SDL pairs, with SL_or_SDL="both" a dictionary of the SL and SDL dataframes keyed by 'SL' and 'SDL'
+        
+    '''
+    return(CoexpressionAnalysisBatch(client, SL_or_SDL, data_resource, input_genes, adj_method, fdr_level, [tissues], engine,
+                                     expression_data, snapshot, gene_index, sample_index, rank_tables, top_k, top_by,
+                                     max_bytes_billed, plan_only, metrics, result_cache))
+
+
+def CoexpressionAnalysisBatch(client, SL_or_SDL, data_resource, input_genes, adj_method, fdr_level, tissue_groups, engine='bigquery', expression_data=None, snapshot=None, gene_index=None, sample_index=None, rank_tables=None, top_k=None, top_by='correlation', max_bytes_billed=None, plan_only=False, metrics=None, result_cache=None):
+
+    '''
+   Description: CoexpressionAnalysis applied on several tissue groups at once. The gene aliases are resolved once, and the ranks
+   and correlations of all groups are computed in a single BigQuery job (or a single local pass), partitioned by tissue group.
+   P values are adjusted within each tissue group.
+
+   Inputs:
+    Same as CoexpressionAnalysis, except
+    tissue_groups:list of lists of strings, every element is the tissues list of one analysis, e.g. [['BRCA'], ['LUAD'], ['BRCA', 'OV']]
 
     Output:
-    A dataframe of SL/SDL pairs
+    A dataframe of SL/SDL pairs of all tissue groups, the Tissue column tells the tissue group of each pair, with SL_or_SDL="both" one such dataframe per analysis
         
     '''
+    tails=_Tails(SL_or_SDL)
+    if tails is None:
+        return()
+    if max_bytes_billed is not None and not plan_only:
+        metrics=QueryMetrics() if metrics is None else metrics
+        # the local engines can not be planned, their jobs are only capped. DAISYPipeline already checked the plan of its procedures
+        if engine=='bigquery' and not isinstance(max_bytes_billed, _CheckedBudget):
+            plan=CoexpressionAnalysisBatch(client, SL_or_SDL, data_resource, input_genes, adj_method, fdr_level, tissue_groups, engine, expression_data,
+                                           snapshot, gene_index, sample_index, rank_tables, top_k, top_by, plan_only=True, result_cache=result_cache)
+            if not _WithinBudget(plan, max_bytes_billed):
+                return()
+    if plan_only:
+        if engine!='bigquery':
+            print("plan_only is available for the bigquery engine")
+            return()
+        metrics=QueryMetrics() if metrics is None else metrics
+    if result_cache is not None and top_k is not None:
+        print("result_cache can not be combined with top_k")
+        return()
+    sample_client, alias_client, query_client=_StageClients(client, metrics, plan_only, max_bytes_billed)
+    procedure_name='coexpression_' + data_resource
   
     if data_resource=='PanCancerAtlas':
         table_name='isb-cgc-bq.pancancer_atlas.Filtered_EBpp_AdjustPANCAN_IlluminaHiSeq_RNASeqV2_genExp'
@@ -236,8 +989,9 @@ def CoexpressionAnalysis(client, SL_or_SDL, data_resource, input_genes, adj_meth
         entrez_col_name='Entrez'
         exp_name='normalized_count'
         sample_barcode='SampleBarcode'
-        selected_samples=RetrieveSamples(client, 'PanCancerAtlas', 'correlation', tissues)
-        gene_mapping=ProcessGeneAlias(client, input_genes, 'PanCancerAtlas')
+        sample_groups=[_Traced(metrics, 'sample selection', procedure_name, RetrieveSamples, sample_client, 'PanCancerAtlas', 'correlation', tissues, sample_index)
+                     for tissues in tissue_groups]
+        gene_mapping=_Traced(metrics, 'alias lookup', procedure_name, ProcessGeneAlias, alias_client, input_genes, 'PanCancerAtlas', gene_index)
 
         
     elif data_resource=='CCLE':
@@ -246,17 +1000,26 @@ def CoexpressionAnalysis(client, SL_or_SDL, data_resource, input_genes, adj_meth
         exp_name='TPM'
         sample_barcode='DepMap_ID'
         entrez_col_name='Entrez_ID'
-        selected_samples=RetrieveSamples(client, 'CCLE','correlation', tissues)
-        gene_mapping=ProcessGeneAlias(client, input_genes, 'DepMap')
+        sample_groups=[_Traced(metrics, 'sample selection', procedure_name, RetrieveSamples, sample_client, 'CCLE','correlation', tissues, sample_index)
+                     for tissues in tissue_groups]
+        gene_mapping=_Traced(metrics, 'alias lookup', procedure_name, ProcessGeneAlias, alias_client, input_genes, 'DepMap', gene_index)
 
     else :
         print("The database name can be either PanCancerAtlas or CCLE")
         return()
 
     min_sample_size=20
-    if len(selected_samples)< (min_sample_size+1):
-        print("Sample size needs to be greater than " +  str(min_sample_size) + ", it is " + str(len(selected_samples)))
+    included_groups=[]
+    for grp in range(len(tissue_groups)):
+        if len(sample_groups[grp])< (min_sample_size+1) and not plan_only:
+            print("Sample size needs to be greater than " +  str(min_sample_size) + ", it is " + str(len(sample_groups[grp])) + " for " + str(tissue_groups[grp]))
+        else:
+            included_groups.append(grp)
+    if len(included_groups)==0:
         return()
+    tissue_groups=[tissue_groups[grp] for grp in included_groups]
+    sample_groups=[sample_groups[grp] for grp in included_groups]
+
     sql_correlation= """ CREATE TEMPORARY FUNCTION tscore_to_p(a FLOAT64, b FLOAT64, c FLOAT64)
      RETURNS FLOAT64
     LANGUAGE js AS
@@ -268,44 +1031,17 @@ def CoexpressionAnalysis(client, SL_or_SDL, data_resource, input_genes, adj_meth
     );
 
     WITH
-    table1 AS (
-    SELECT
-    symbol,
-   (RANK() OVER (PARTITION BY symbol ORDER BY data ASC)) + (COUNT(*) OVER ( PARTITION BY symbol, CAST(data as STRING)) -  1)/2.0 AS rnkdata,
-   ParticipantBarcode
-	FROM (
-   SELECT
-   __GENE_SYMBOL__  symbol,
-      AVG( __EXP_NAME__)  AS data,
-      __SAMPLE_ID__ AS ParticipantBarcode
-   FROM `__TABLE_NAME__`
-   WHERE  __GENE_SYMBOL__   IN (__GENE_LIST__) # labels
-         AND __EXP_NAME__ IS NOT NULL  AND __SAMPLE_ID__ in (__SAMPLE_LIST__)
-   GROUP BY
-      ParticipantBarcode, symbol
-       )
+    sample_groups AS (
+    __SAMPLE_GROUPS__
     )
     ,
-    table2 AS (
-    SELECT
-    symbol,
-   (RANK() OVER (PARTITION BY symbol ORDER BY data ASC)) + (COUNT(*) OVER ( PARTITION BY symbol, CAST(data as STRING)) - 1)/2.0 AS rnkdata,
-   ParticipantBarcode
-    FROM (
-   SELECT
-      __GENE_SYMBOL__    symbol,
-      AVG(__EXP_NAME__)  AS data,
-      __SAMPLE_ID__ AS ParticipantBarcode
-   FROM `__TABLE_NAME__`
-   WHERE  __GENE_SYMBOL__ IS NOT NULL  # labels
-         AND __EXP_NAME__ IS NOT NULL AND __SAMPLE_ID__ in (__SAMPLE_LIST__)
-   GROUP BY
-      ParticipantBarcode, symbol
-       )
-    )
+__TABLE1__
+    ,
+__TABLE2__
 ,
 summ_table AS (
 SELECT
+   n1.grp as grp,
    n1.symbol as symbol1,
    n2.symbol as symbol2,
    COUNT( n1.ParticipantBarcode ) as n,
@@ -317,12 +1053,31 @@ INNER JOIN
    table2 AS n2
 ON
    n1.ParticipantBarcode = n2.ParticipantBarcode
-   AND n2.symbol  NOT IN (__GENE_LIST__)
+   AND n1.grp = n2.grp
+   __PARTNER_FILTER__
 
 GROUP BY
-   symbol1, symbol2
-UNION ALL
+   grp, symbol1, symbol2
+__INPUT_PAIRS__
+)
+,
+pairs AS (
+SELECT *,
+   tscore_to_p( ABS(correlation)*SQRT( (n-2)/((1+correlation)*(1-correlation))) ,n-2, 2) as pvalue
+   #`cgc-05-0042.Auxiliary.significance_level_ttest2`(n-2, ABS(correlation)*SQRT( (n-2)/((1+correlation)*(1-correlation)))) as alpha
+FROM summ_table
+WHERE n > 20
+#AND correlation > __COR_THRESHOLD__
+GROUP BY 1,2,3,4,5,6
+#HAVING pvalue <= __P_THRESHOLD__
+)
+__TOP_K__
+ORDER BY grp ASC, symbol1 ASC, correlation DESC """
+
+    # pairs of input genes are computed once (symbol1 < symbol2) in a self join of table1
+    sql_input_pairs="""UNION ALL
 SELECT
+   n1.grp as grp,
    n1.symbol as symbol1,
    n2.symbol as symbol2,
    COUNT( n1.ParticipantBarcode ) as n,
@@ -334,83 +1089,266 @@ INNER JOIN
    table1 AS n2
 ON
    n1.ParticipantBarcode = n2.ParticipantBarcode
+   AND n1.grp = n2.grp
    AND n1.symbol <  n2.symbol
 GROUP BY
-   symbol1, symbol2
-)
-SELECT *,
-   tscore_to_p( ABS(correlation)*SQRT( (n-2)/((1+correlation)*(1-correlation))) ,n-2, 2) as pvalue
-   #`cgc-05-0042.Auxiliary.significance_level_ttest2`(n-2, ABS(correlation)*SQRT( (n-2)/((1+correlation)*(1-correlation)))) as alpha
-FROM summ_table
-WHERE n > 20
-#AND correlation > __COR_THRESHOLD__
-GROUP BY 1,2,3,4,5
-#HAVING pvalue <= __P_THRESHOLD__
-ORDER BY symbol1 ASC, correlation DESC """
-
-    input_genes = ["'"+ str(x) + "'" for x in input_genes]
-    input_genes_for_query= ','.join(input_genes)
-
-    included_samples=["'"+ str(x) + "'" for x in selected_samples]
-    included_samples= ','.join(included_samples)
-
-    sql_correlation = sql_correlation.replace('__GENE_LIST__', input_genes_for_query)
+   grp, symbol1, symbol2"""
+
+    gene_list=[str(x) for x in input_genes]
+    all_genes=gene_list
+    if result_cache is not None:
+        # cached genes are paired with every gene, so their partners do not depend on the rest of the input genes
+        cache_args=('coexpression', data_resource, tissue_groups, {'min_sample_size':min_sample_size, **_CacheSources(engine, rank_tables, sample_index)},
+                    [table_name])
+        cached, gene_list=_CachedResults(result_cache, gene_list, *cache_args)
+        sql_correlation = sql_correlation.replace('__PARTNER_FILTER__', 'AND n2.symbol != n1.symbol')
+        sql_correlation = sql_correlation.replace('__INPUT_PAIRS__', '')
+    else:
+        sql_correlation = sql_correlation.replace('__PARTNER_FILTER__', 'AND n2.symbol  NOT IN UNNEST(@genes)')
+        sql_correlation = sql_correlation.replace('__INPUT_PAIRS__', sql_input_pairs)
+    job_config = bigquery.QueryJobConfig(
+    query_parameters=[
+            bigquery.ArrayQueryParameter("genes", "STRING", gene_list)
+        ] + _SampleGroupsParameters(sample_groups)
+        )
+
+    rank_table=None
+    if rank_tables is not None and engine=='bigquery':
+        # a plan reads no rank table that does not exist yet, its queries are planned on the source table
+        pancancer_samples=_PancancerSamples(sample_client, data_resource, 'correlation', tissue_groups, sample_groups, sample_index, metrics, procedure_name)
+        rank_table=_Traced(metrics, 'rank tables', procedure_name, rank_tables.Table, table_name, pancancer_samples, query_client)
+    if rank_table is None:
+        sql_table1='''    table1 AS (
+    SELECT
+    grp,
+    symbol,
+   (RANK() OVER (PARTITION BY grp, symbol ORDER BY data ASC)) + (COUNT(*) OVER ( PARTITION BY grp, symbol, CAST(data as STRING)) -  1)/2.0 AS rnkdata,
+   ParticipantBarcode
+	FROM (
+   SELECT
+   G.grp,
+   __GENE_SYMBOL__  symbol,
+      AVG( __EXP_NAME__)  AS data,
+      __SAMPLE_ID__ AS ParticipantBarcode
+   FROM `__TABLE_NAME__` E
+   INNER JOIN sample_groups G
+   ON E.__SAMPLE_ID__ = G.Barcode
+   WHERE  __GENE_SYMBOL__   IN UNNEST(@genes) # labels
+         AND __EXP_NAME__ IS NOT NULL
+   GROUP BY
+      grp, ParticipantBarcode, symbol
+       )
+    )
+'''
+        sql_table2='''    table2 AS (
+    SELECT
+    grp,
+    symbol,
+   (RANK() OVER (PARTITION BY grp, symbol ORDER BY data ASC)) + (COUNT(*) OVER ( PARTITION BY grp, symbol, CAST(data as STRING)) - 1)/2.0 AS rnkdata,
+   ParticipantBarcode
+    FROM (
+   SELECT
+      G.grp,
+      __GENE_SYMBOL__    symbol,
+      AVG(__EXP_NAME__)  AS data,
+      __SAMPLE_ID__ AS ParticipantBarcode
+   FROM `__TABLE_NAME__` E
+   INNER JOIN sample_groups G
+   ON E.__SAMPLE_ID__ = G.Barcode
+   WHERE  __GENE_SYMBOL__ IS NOT NULL  # labels
+         AND __EXP_NAME__ IS NOT NULL
+   GROUP BY
+      grp, ParticipantBarcode, symbol
+       )
+    )
+'''
+    else:
+        full_groups=_FullGroups(sample_groups, pancancer_samples)
+        sql_table1, rank_parameters=_RankTableCTE('table1', 'ParticipantBarcode', 'R.symbol IN UNNEST(@genes)', len(sample_groups), full_groups)
+        sql_table2, _=_RankTableCTE('table2', 'ParticipantBarcode', 'R.symbol IS NOT NULL', len(sample_groups), full_groups)
+        sql_table1=sql_table1.replace('__RANK_TABLE__', rank_table)
+        sql_table2=sql_table2.replace('__RANK_TABLE__', rank_table)
+        job_config.query_parameters=list(job_config.query_parameters) + rank_parameters
+    sql_correlation = sql_correlation.replace('__TABLE1__', sql_table1)
+    sql_correlation = sql_correlation.replace('__TABLE2__', sql_table2)
     sql_correlation = sql_correlation.replace('__TABLE_NAME__', table_name)
     sql_correlation = sql_correlation.replace('__GENE_SYMBOL__', gene_col_name)
     sql_correlation = sql_correlation.replace('__EXP_NAME__', exp_name)
     sql_correlation = sql_correlation.replace('__SAMPLE_ID__', sample_barcode)
-    sql_correlation = sql_correlation.replace('__SAMPLE_LIST__', included_samples)
-
-
-    results= client.query(sql_correlation).result().to_dataframe()
+    sql_correlation = sql_correlation.replace('__SAMPLE_GROUPS__', SAMPLE_GROUPS_SQL)
+
+    if top_k is not None:
+        if top_by=='correlation':
+            top_order='ABS(correlation) DESC'
+        elif top_by=='FDR':
+            top_order='pvalue ASC'
+        else:
+            print("top_by can be either correlation or FDR")
+            return()
+        # NaN correlations (constant ranks) are dropped before the window, they neither take top-k slots nor count as tests
+        sql_top_k='''SELECT * EXCEPT(partner_rank) FROM (
+SELECT *,
+   ROW_NUMBER() OVER (PARTITION BY grp, symbol1 ORDER BY __TOP_ORDER__) AS partner_rank,
+   COUNT(*) OVER (PARTITION BY grp, symbol1) AS n_tests
+FROM pairs
+WHERE NOT IS_NAN(correlation)
+)
+WHERE partner_rank <= @top_k'''
+        sql_correlation=sql_correlation.replace('__TOP_K__', sql_top_k.replace('__TOP_ORDER__', top_order))
+        job_config.query_parameters=list(job_config.query_parameters) + [bigquery.ScalarQueryParameter("top_k", "INT64", int(top_k))]
+    else:
+        sql_correlation=sql_correlation.replace('__TOP_K__', 'SELECT * FROM pairs')
+
+    if result_cache is not None and len(gene_list)==0:
+        results=None
+    elif engine=='local':
+        if expression_data is None:
+            all_samples=list(pd.unique(np.concatenate([np.asarray(x, dtype=object) for x in sample_groups])))
+            expression_data=_Traced(metrics, 'data load', procedure_name, LoadExpressionMatrix, query_client, table_name, gene_col_name, exp_name,
+                                    sample_barcode, all_samples, snapshot)
+        results= _Traced(metrics, 'main statistic', procedure_name, _LocalCoexpression, expression_data, sample_groups, gene_list, top_k, top_by, result_cache is not None)
+    elif engine=='bigquery':
+        results= _Traced(metrics, 'main statistic', procedure_name, ReadResults, query_client, sql_correlation, job_config,
+                         symbol_columns=['symbol1', 'symbol2'], float64_columns=['pvalue'])
+    else:
+        print("Engine can be either bigquery or local")
+        return()
+    if plan_only:
+        return(metrics)
+    if result_cache is not None:
+        results=_StoreResults(result_cache, results, cached, gene_list, *cache_args)
+        if results.shape[0]>0:
+            # the pairs of two input genes are kept once, under the smaller symbol
+            keep=~(results['symbol2'].isin(all_genes) & (results['symbol2']<=results['symbol1']))
+            results=results.loc[keep].sort_values(['grp', 'symbol1', 'correlation'], ascending=[True, True, False], kind='mergesort')
     if results.shape[0]<1:
         print("Coexpression inference procedure applied on " + data_resource + " did not find candidate " + SL_or_SDL + " pairs.")
-        return(results)
-        
-    report=results[['symbol1', 'symbol2', 'n', 'correlation', 'pvalue']]
-    report=report.dropna()
-    report.columns=['InactiveDB', 'SL_Candidate', '#Samples', 'Correlation', 'PValue']
-    report['Inactive']= report['InactiveDB'].map(gene_mapping)
-    if fdr_level=="gene_level":
-        inactive_genes=list(report["Inactive"].unique())
-        for i in range(len(inactive_genes)):
-           report.loc[report["Inactive"]==inactive_genes[i],'FDR']=multipletests(report.loc[report["Inactive"]==inactive_genes[i], 'PValue'], method= adj_method, is_sorted=False)[1]
+        return(_TailReports({tail:results for tail in tails}, tails))
+
+    # the correlations do not depend on the analysis, with SL_or_SDL="both" they are reported under both labels
+    reports={}
+    for tail in tails:
+        tail_reports=[]
+        for grp, group_results in results.groupby('grp', sort=True):
+            report=_Traced(metrics, 'report', procedure_name, _CoexpressionReport, group_results, gene_mapping, tail, adj_method, fdr_level, tissue_groups[grp])
+            if isinstance(report, tuple):
+                return()
+            tail_reports.append(report)
+        reports[tail]=_ConcatReports(tail_reports)
+    return(_TailReports(reports, tails))
+
+def _SurvivalReport(results, gene_mapping, SL_or_SDL, adj_method, fdr_level, tissues):
+  report=results [['symbol1', 'symbol2', 'n1', 'n', 'U1', 'pvalue']]
+  report=report.dropna()
+  report.columns=['InactiveDB', 'SL_Candidate', '#InactiveSamples', '#Samples', 'U1','PValue']
+  report['Inactive']= report['InactiveDB'].map(gene_mapping)
 
-    elif fdr_level=="analysis_level":
-       FDR=multipletests(report['PValue'],  method= adj_method, is_sorted=False)[1]
-       report['FDR']=FDR
-    else:
-      print("FDR level can be either gene_level or analysis_level")
-      return()
+  if fdr_level=="gene_level":
+      report['FDR']=DAISY_local.GroupedMultipleTests(report['PValue'].values, report['Inactive'].values, adj_method)
+
+  elif fdr_level=="analysis_level":
+     FDR=multipletests(report['PValue'],  method= adj_method, is_sorted=False)[1]
+     report['FDR']=FDR
+  else:
+    print("FDR level can be either gene_level or analysis_level")
+    return()
  
-    report['Tissue']=str(tissues)
-    cols=['Inactive', 'InactiveDB', 'SL_Candidate', '#Samples', 'Correlation', 'PValue', 'FDR', 'Tissue']
-    report=report[cols]
-    if SL_or_SDL=="SDL":
-      report.columns= ['Overactive', 'OveractiveDB', 'SL_Candidate', '#Samples', 'Correlation', 'PValue', 'FDR', 'Tissue']
-    return report
+  report['Tissue']=str(tissues)
+  
+  cols=['Inactive', 'InactiveDB', 'SL_Candidate','#InactiveSamples', '#Samples',  'PValue', 'FDR', 'Tissue']
+  report=report[cols]
+  if SL_or_SDL=="SDL":
+      report.columns= ['Overactive', 'OveractiveDB', 'SL_Candidate','#Overactive', '#Samples', 'PValue', 'FDR', 'Tissue']
+  return _CompactReport(report)
+
 
-def SurvivalOfFittest(client, SL_or_SDL, data_source, input_genes, percentile_threshold, cn_threshold, adj_method, fdr_level, tissues, input_mutations='None'):
+def SurvivalOfFittest(client, SL_or_SDL, data_source, input_genes, percentile_threshold, cn_threshold, adj_method, fdr_level, tissues, input_mutations='None', gene_index=None, sample_index=None, engine='bigquery', snapshot=None, cn_data=None, tie_correction=True, rank_tables=None, max_bytes_billed=None, plan_only=False, metrics=None, result_cache=None):
 
   '''
    Description: Gene expression, Copy Number Alteration (CNA), Somatic Mutations are used to decide whether gene is inactive.
    The SL pair detection according to difference in CNA given one gene is inactive vs not-inactive
    Inputs:
     client:BigQueryClient, the BigQuery client that will run the function.
-    SL_or_SDL:string, Synthetic lethal or Synthetic Dosage Lethal, valid values: 'SL', 'SDL'
+    SL_or_SDL:string, Synthetic lethal or Synthetic Dosage Lethal, valid values: 'SL', 'SDL', 'both'
+        "both" selects the inactive (SL) and overactive (SDL) samples from the same scan of the data and tests them in one pass
     data_resource: string, The dataresource the analysis will be performed on, 	valid values: "CCLE", "PanCancerAtlas"
     input_genes:list of strings, the list of genes whose SL/SDL partners will be seeked	
     percentile_threshold:double, the threshold for gene expression (for deciding whether a gene is inactive)
-    cn_threshold:double, the threshold for copy number alteration (for deciding whether a gene is inactive)
+        with SL_or_SDL="both" either one value or a pair of (SL, SDL) thresholds, e.g. (10, 90)
+    cn_threshold:double, the threshold for copy number alteration (for deciding whether a gene is inactive), a pair of (SL, SDL) thresholds
+        is accepted as for percentile_threshold
     adj_method:	string,	optional, p value correction method,  valid_values:bonferroni,  sidak, holm-sidak , holm, simes-hochberg , hommel, fdr_bh,  fdr_by , fdr_tsbh, fdr_tsbky 
     fdr_level:string, the data that will be considered wile doing p value adjustment, valid values : "gene_level", "analysis_level"
     tissues: The tissues that the analysis will be performed on. 
     input_mutations:list of strings, optional, valid values: Missense_Mutation, Nonsense_Mutation,Translation_Start_Site, Frame_Shift_Ins, Splice_Site, In_Frame_DelFrame_Shift_Del, Nonstop_Mutation, In_Frame_Ins
+    gene_index:GeneIndex, optional, the local gene index used to map the input genes to their aliases
+    sample_index:SampleAvailability, optional, the local sample availability matrix the samples are selected from
+    engine:string, optional, where the rank sums are computed, valid values: "bigquery", "local"
+    snapshot:SnapshotStore, optional, the local Parquet snapshots the local engine reads the tables from
+    cn_data:tuple, optional, the copy number matrix as returned by LoadExpressionMatrix, reused by the local engine instead of loading it again
+    tie_correction:boolean, optional, if True (default) the local engine corrects the variance of the rank sums for ties, False reproduces
+        the uncorrected z-scores of the bigquery engine
+    rank_tables:RankTables, optional, if given the bigquery engine reads the ranks from the precomputed per-release rank tables
+    max_bytes_billed:integer, optional, the byte budget of the analysis. The queries are dry run first and the analysis is not run
+        when their estimated bytes exceed the budget. Every job also reserves the bytes it can bill at most out of what is left of
+        the budget and is capped to them, a job that no longer fits raises BudgetExceeded. With the local engine the jobs are only capped.
+    plan_only:boolean, optional, if True the queries are only dry run and the QueryMetrics with their estimated bytes per stage is returned.
+        The estimates do not depend on the samples and genes, except for the pruning of clustered tables.
+    metrics:QueryMetrics, optional, filled with the stage, bytes processed and billed and slot milliseconds of every query,
+        a StageTracer also times the sample selection, alias lookup, main statistic and report stages
+    result_cache:ResultCache, optional, if given the per-gene results are read from the cache and only the genes missing from it are computed
+        
+   Output:
+       A dataframe of SL/SDL  pairs, with SL_or_SDL="both" a dictionary of the SL and SDL dataframes keyed by 'SL' and 'SDL'
+
+  '''
+  return(SurvivalOfFittestBatch(client, SL_or_SDL, data_source, input_genes, percentile_threshold, cn_threshold, adj_method, fdr_level, [tissues],
+                                input_mutations, gene_index, sample_index, engine, snapshot, cn_data, tie_correction, rank_tables,
+                                max_bytes_billed, plan_only, metrics, result_cache))
+
+
+def SurvivalOfFittestBatch(client, SL_or_SDL, data_source, input_genes, percentile_threshold, cn_threshold, adj_method, fdr_level, tissue_groups, input_mutations='None', gene_index=None, sample_index=None, engine='bigquery', snapshot=None, cn_data=None, tie_correction=True, rank_tables=None, max_bytes_billed=None, plan_only=False, metrics=None, result_cache=None):
+
+  '''
+   Description: SurvivalOfFittest applied on several tissue groups at once. The gene aliases are resolved once, and the inactive samples,
+   copy number ranks and rank sums of all groups are computed in a single BigQuery job, partitioned by tissue group.
+   With engine="local" the copy number matrix is loaded once and the rank sums of every group are obtained with a matrix product.
+   P values are adjusted within each tissue group.
+   Inputs:
+    Same as SurvivalOfFittest, except
+    tissue_groups:list of lists of strings, every element is the tissues list of one analysis, e.g. [['BRCA'], ['LUAD'], ['BRCA', 'OV']]
         
    Output:
-       A dataframe of SL/SDL  pairs
+       A dataframe of SL/SDL pairs of all tissue groups, the Tissue column tells the tissue group of each pair, with SL_or_SDL="both" one such dataframe per analysis
 
   '''
+  tails=_Tails(SL_or_SDL)
+  if tails is None:
+      return()
+  percentile_thresholds=_TailThresholds(percentile_threshold, tails)
+  cn_thresholds=_TailThresholds(cn_threshold, tails)
+  if percentile_thresholds is None or cn_thresholds is None:
+      return()
+  if max_bytes_billed is not None and not plan_only:
+      metrics=QueryMetrics() if metrics is None else metrics
+      # the local engines can not be planned, their jobs are only capped. DAISYPipeline already checked the plan of its procedures
+      if engine=='bigquery' and not isinstance(max_bytes_billed, _CheckedBudget):
+          plan=SurvivalOfFittestBatch(client, SL_or_SDL, data_source, input_genes, percentile_threshold, cn_threshold, adj_method, fdr_level, tissue_groups,
+                                      input_mutations, gene_index, sample_index, engine, snapshot, cn_data, tie_correction, rank_tables, plan_only=True,
+                                      result_cache=result_cache)
+          if not _WithinBudget(plan, max_bytes_billed):
+              return()
+  if plan_only:
+      if engine!='bigquery':
+          print("plan_only is available for the bigquery engine")
+          return()
+      metrics=QueryMetrics() if metrics is None else metrics
+  sample_client, alias_client, query_client=_StageClients(client, metrics, plan_only, max_bytes_billed)
+  procedure_name='sof_' + data_source
+  cache_parameters=[{'SL_or_SDL':tails[t], 'percentile_threshold':percentile_thresholds[t], 'cn_threshold':cn_thresholds[t],
+                     'input_mutations':input_mutations, 'tie_correction':tie_correction, **_CacheSources(engine, rank_tables, sample_index)}
+                     for t in range(len(tails))]
+
   if data_source=='PanCancerAtlas':
         gene_exp_table='isb-cgc-bq.pancancer_atlas.Filtered_EBpp_AdjustPANCAN_IlluminaHiSeq_RNASeqV2_genExp'
         mutation_table='isb-cgc-bq.pancancer_atlas.Filtered_MC3_MAF_V5_one_per_tumor_sample'
@@ -424,8 +1362,9 @@ def SurvivalOfFittest(client, SL_or_SDL, data_source, input_genes, percentile_th
         mutation_sample_id='Tumor_SampleBarcode'
         cn_gistic='GISTIC_Calls'
         entrez_id='Entrez'
-        selected_samples= RetrieveSamples(client, 'PanCancerAtlas', 'sof', tissues)
-        gene_mapping=ProcessGeneAlias(client, input_genes, 'PanCancerAtlas')
+        sample_groups= [_Traced(metrics, 'sample selection', procedure_name, RetrieveSamples, sample_client, 'PanCancerAtlas', 'sof', tissues, sample_index)
+                       for tissues in tissue_groups]
+        gene_mapping=_Traced(metrics, 'alias lookup', procedure_name, ProcessGeneAlias, alias_client, input_genes, 'PanCancerAtlas', gene_index)
   elif data_source=='CCLE':
         mutation_table='isb-cgc-bq.DEPMAP.CCLE_mutation_DepMapPublic_current'
         gene_exp_table='isb-cgc-bq.DEPMAP.CCLE_gene_expression_DepMapPublic_current'
@@ -437,73 +1376,81 @@ def SurvivalOfFittest(client, SL_or_SDL, data_source, input_genes, percentile_th
         mutation_gene_name='Hugo_Symbol'
         mutation_sample_id='Tumor_Sample_Barcode'
         cn_gistic='CNA'
-        cn_threshold=np.log2(2**(cn_threshold)+1)
+        cn_thresholds=[np.log2(2**(x)+1) for x in cn_thresholds]
         entrez_id='Entrez_ID'
-        selected_samples= RetrieveSamples(client, 'CCLE', 'sof', tissues)
-        gene_mapping=ProcessGeneAlias(client, input_genes, 'DepMap')
+        sample_groups= [_Traced(metrics, 'sample selection', procedure_name, RetrieveSamples, sample_client, 'CCLE', 'sof', tissues, sample_index)
+                       for tissues in tissue_groups]
+        gene_mapping=_Traced(metrics, 'alias lookup', procedure_name, ProcessGeneAlias, alias_client, input_genes, 'DepMap', gene_index)
 
 
   else :
         print("The data source name can be either PanCancerAtlas or CCLE")
         return()
   min_sample_size=20
-  if len(selected_samples)< (min_sample_size+1):
-        print("Sample size needs to be greater than " +  str(min_sample_size), " it is " + str(len(selected_samples)))
-        return()
+  included_groups=[]
+  for grp in range(len(tissue_groups)):
+      if len(sample_groups[grp])< (min_sample_size+1) and not plan_only:
+          print("Sample size needs to be greater than " +  str(min_sample_size), " it is " + str(len(sample_groups[grp])) + " for " + str(tissue_groups[grp]))
+      else:
+          included_groups.append(grp)
+  if len(included_groups)==0:
+      return()
+  tissue_groups=[tissue_groups[grp] for grp in included_groups]
+  sample_groups=[sample_groups[grp] for grp in included_groups]
 
   sql_without_mutation= '''
     WITH
+    sample_groups AS (
+    __SAMPLE_GROUPS__
+    ),
     table1 AS (
-    (SELECT   symbol, Barcode FROM
-    (SELECT GE.__EXP_GENE_NAME__ AS symbol, GE.__SAMPLE_ID__ AS Barcode ,
-    PERCENT_RANK () over (partition by __EXP_GENE_NAME__ order by __GENE_EXPRESSION__ asc) AS Percentile
+    (SELECT   __TAIL_COLUMN__grp, symbol, Barcode FROM
+    (SELECT G.grp, GE.__EXP_GENE_NAME__ AS symbol, GE.__SAMPLE_ID__ AS Barcode ,
+    PERCENT_RANK () over (partition by G.grp, GE.__EXP_GENE_NAME__ order by GE.__GENE_EXPRESSION__ asc) AS Percentile
     FROM  __GENE_EXP_TABLE__ GE
-    WHERE GE.__EXP_GENE_NAME__ in (__GENELIST__)  AND __SAMPLE_ID__ in (__SAMPLE_LIST__) AND GE.__GENE_EXPRESSION__ is not null
+    INNER JOIN sample_groups G ON GE.__SAMPLE_ID__ = G.Barcode
+    WHERE GE.__EXP_GENE_NAME__ in UNNEST(@genes) AND GE.__GENE_EXPRESSION__ is not null
     )
-    AS NGE
-    WHERE NGE.Percentile  __GENE_CMP_STR__
+    AS NGE __TAILS__
+    WHERE __GENE_CMP_STR__
 
     INTERSECT DISTINCT
 
-    SELECT symbol ,  Barcode FROM
-    (SELECT CN.__CN_GENE_NAME__ AS symbol, CN.__SAMPLE_ID__ AS Barcode,
+    SELECT __TAIL_COLUMN__grp, symbol ,  Barcode FROM
+    (SELECT G.grp, CN.__CN_GENE_NAME__ AS symbol, CN.__SAMPLE_ID__ AS Barcode,
     CN.__CN_GISTIC__ AS NORM_CN
     FROM  __CN_TABLE__ CN
-    WHERE CN.__CN_GENE_NAME__ in (__GENELIST__)  AND __SAMPLE_ID__ in (__SAMPLE_LIST__)  and CN.__CN_GISTIC__ is not null
-    ) AS NC
-    WHERE NC.NORM_CN __CN_CMP_STR__
+    INNER JOIN sample_groups G ON CN.__SAMPLE_ID__ = G.Barcode
+    WHERE CN.__CN_GENE_NAME__ in UNNEST(@genes) and CN.__CN_GISTIC__ is not null
+    ) AS NC __TAILS__
+    WHERE __CN_CMP_STR__
     )'''
 
   if data_source=='CCLE':
         sql_mutation_part='''
 
         UNION DISTINCT
-        SELECT M.__MUTATION_GENE_NAME__  AS symbol , M.__MUTATION_SAMPLE_ID__ AS Barcode
+        SELECT __MUTATION_TAIL__G.grp, M.__MUTATION_GENE_NAME__  AS symbol , M.__MUTATION_SAMPLE_ID__ AS Barcode
         FROM __MUTATION_TABLE__ M
-        WHERE __MUTATION_GENE_NAME__ IN (__GENELIST__) AND
-        M.Variant_Classification IN (__MUTATIONLIST__) AND __MUT_SAMPLE_ID__ in (__SAMPLE_LIST__)
+        INNER JOIN sample_groups G ON M.__MUT_SAMPLE_ID__ = G.Barcode
+        WHERE M.__MUTATION_GENE_NAME__ IN UNNEST(@genes) AND
+        M.Variant_Classification IN UNNEST(@mutations)
         )'''
 
   elif data_source=='PanCancerAtlas':
         sql_mutation_part='''
          UNION DISTINCT
-        SELECT M.__MUTATION_GENE_NAME__  AS symbol , M.__MUTATION_SAMPLE_ID__ AS Barcode
+        SELECT __MUTATION_TAIL__G.grp, M.__MUTATION_GENE_NAME__  AS symbol , M.__MUTATION_SAMPLE_ID__ AS Barcode
         FROM __MUTATION_TABLE__ M
-        WHERE __MUTATION_GENE_NAME__ IN (__GENELIST__) AND
-        M.Variant_Classification IN (__MUTATIONLIST__) AND __MUT_SAMPLE_ID__ in (__SAMPLE_LIST__) AND Filter="PASS"
+        INNER JOIN sample_groups G ON M.__MUT_SAMPLE_ID__ = G.Barcode
+        WHERE M.__MUTATION_GENE_NAME__ IN UNNEST(@genes) AND
+        M.Variant_Classification IN UNNEST(@mutations) AND Filter="PASS"
         )'''
 
   rest_of_the_query= '''
-     , table2 AS (
-    SELECT
-        __SAMPLE_ID__ Barcode,  __CN_GENE_NAME__ symbol,
-        (RANK() OVER (PARTITION BY __CN_GENE_NAME__ ORDER BY __CN_GISTIC__ ASC)) + (COUNT(*) OVER ( PARTITION BY __CN_GENE_NAME__, CAST(__CN_GISTIC__ as STRING)) - 1)/2.0  AS rnkdata
-    FROM
-       __CN_TABLE__
-       where __CN_GENE_NAME__ IS NOT NULL  AND  __SAMPLE_ID__ in (__SAMPLE_LIST__) AND __CN_GISTIC__ is not null 
-       ),
-summ_table AS (
+__TABLE2__summ_table AS (
 SELECT
+   __N1_TAIL__n1.grp as grp,
    n1.symbol as symbol1,
    n2.symbol as symbol2,
    COUNT( n1.Barcode) as n_1,
@@ -514,55 +1461,76 @@ INNER JOIN
    table2 AS n2
 ON
    n1.Barcode = n2.Barcode
+   AND n1.grp = n2.grp
 GROUP BY
-    symbol1, symbol2 ),
+    __TAIL_COLUMN__grp, symbol1, symbol2 ),
 
 statistics AS (
-SELECT symbol1, symbol2, n1, n, U1,
+SELECT __TAIL_COLUMN__grp, symbol1, symbol2, n1, n, U1,
       (n1n2/2.0 - U1)/den as zscore
 
 FROM (
-   SELECT  symbol1, symbol2, n_t as n,
+   SELECT  __TAIL_COLUMN__t1.grp as grp, symbol1, symbol2, n_t as n,
        n_1 as n1,
        sumx_1 - n_1 *(n_1 + 1) / 2.0 as U1,
        n_1 * (n_t - n_1 ) as n1n2,
        SQRT( n_1 * (n_t - n_1 )*(n_t + 1) / 12.0 ) as den
    FROM  summ_table as t1
-   LEFT JOIN ( SELECT symbol, COUNT( Barcode ) as n_t
+   LEFT JOIN ( SELECT grp, symbol, COUNT( Barcode ) as n_t
             FROM table2
-            GROUP BY symbol)  t2
-   ON symbol2 = symbol
+            GROUP BY grp, symbol)  t2
+   ON symbol2 = symbol AND t1.grp = t2.grp
    WHERE n_t > 20 and n_1>5
 )
 WHERE den > 0
 )
-SELECT symbol1, symbol2, n1, n, U1,
+SELECT __TAIL_COLUMN__grp, symbol1, symbol2, n1, n, U1,
     `cgc-05-0042.functions.jstat_normal_cdf`(zscore, 0.0, 1.0 ) as pvalue
 FROM statistics
-GROUP BY 1,2,3,4,5,6
+GROUP BY 1,2,3,4,5,6,7__TAIL_ORDINAL__
 #HAVING pvalue <= 0.01
-ORDER BY pvalue ASC '''
-
-  input_genes = ["'"+ str(x) + "'" for x in input_genes]
-  input_genes_query= ','.join(input_genes)
+ORDER BY grp ASC, pvalue ASC '''
 
-  included_samples=["'"+ str(x) + "'" for x in selected_samples]
-  included_samples= ','.join(included_samples)
+  gene_list=[str(x) for x in input_genes]
+  if result_cache is not None:
+      cache_args=[('sof', data_source, tissue_groups, parameters, [gene_exp_table, cn_table, mutation_table]) for parameters in cache_parameters]
+      cached, gene_list=_TailCachedResults(result_cache, gene_list, cache_args)
+  query_parameters=[bigquery.ArrayQueryParameter("genes", "STRING", gene_list)] + _SampleGroupsParameters(sample_groups)
 
 
-  if SL_or_SDL=='SDL' or input_mutations is None:
+  if 'SL' not in tails or input_mutations is None:
       sql_sof=sql_without_mutation +  ')' +' ' +  rest_of_the_query
   else:
-      mutations_intermediate_representation = ["'"+x+"'" for x in input_mutations]
-      input_mutations_for_query = ','.join(mutations_intermediate_representation)
+      query_parameters.append(bigquery.ArrayQueryParameter("mutations", "STRING", [str(x) for x in input_mutations]))
       sql_sof=sql_without_mutation + ' '+ sql_mutation_part + ' ' +  rest_of_the_query
       sql_sof = sql_sof.replace('__MUTATION_TABLE__', mutation_table)
       sql_sof = sql_sof.replace('__MUTATION_SAMPLE_ID__', mutation_sample_id)
-      sql_sof = sql_sof.replace('__MUTATIONLIST__', input_mutations_for_query)
+  job_config = bigquery.QueryJobConfig(query_parameters=query_parameters)
 
-  sql_sof = sql_sof.replace('__GENELIST__', input_genes_query)
  # sql_sof = sql_sof.replace('__CUTOFFPRC__', str(percentile_threshold/100))
  # sql_sof = sql_sof.replace('__CUTOFFSCNA__', str(cn_threshold))
+  rank_table=None
+  if rank_tables is not None and engine=='bigquery':
+      # a plan reads no rank table that does not exist yet, its queries are planned on the source table
+      pancancer_samples=_PancancerSamples(sample_client, data_source, 'sof', tissue_groups, sample_groups, sample_index, metrics, procedure_name)
+      rank_table=_Traced(metrics, 'rank tables', procedure_name, rank_tables.Table, cn_table, pancancer_samples, query_client)
+  if rank_table is None:
+      sql_table2='''     , table2 AS (
+    SELECT
+        G.grp, CN.__SAMPLE_ID__ Barcode,  CN.__CN_GENE_NAME__ symbol,
+        (RANK() OVER (PARTITION BY G.grp, CN.__CN_GENE_NAME__ ORDER BY CN.__CN_GISTIC__ ASC)) + (COUNT(*) OVER ( PARTITION BY G.grp, CN.__CN_GENE_NAME__, CAST(CN.__CN_GISTIC__ as STRING)) - 1)/2.0  AS rnkdata
+    FROM
+       __CN_TABLE__ CN
+       INNER JOIN sample_groups G ON CN.__SAMPLE_ID__ = G.Barcode
+       where CN.__CN_GENE_NAME__ IS NOT NULL AND CN.__CN_GISTIC__ is not null 
+       ),
+'''
+  else:
+      sql_table2, rank_parameters=_RankTableCTE('table2', 'Barcode', 'R.symbol IS NOT NULL', len(sample_groups), _FullGroups(sample_groups, pancancer_samples))
+      sql_table2='     , ' + sql_table2.strip() + ',\n'
+      sql_table2=sql_table2.replace('__RANK_TABLE__', rank_table)
+      job_config.query_parameters=list(job_config.query_parameters) + rank_parameters
+  sql_sof = sql_sof.replace('__TABLE2__', sql_table2)
   sql_sof = sql_sof.replace('__CN_TABLE__', cn_table)
   sql_sof = sql_sof.replace('__GENE_EXP_TABLE__', gene_exp_table)
   sql_sof = sql_sof.replace('__SAMPLE_ID__', sample_id)
@@ -574,54 +1542,306 @@ ORDER BY pvalue ASC '''
   sql_sof = sql_sof.replace('__EXP_GENE_NAME__', gene_col_name)
   sql_sof = sql_sof.replace('__CN_GENE_NAME__', cn_gene_name)
   sql_sof = sql_sof.replace('__MUTATION_GENE_NAME__', mutation_gene_name)
-  sql_sof= sql_sof.replace('__SAMPLE_LIST__', included_samples)
-
-  if SL_or_SDL=="SL":
-      comp_str="<"+str(cn_threshold)
-      com_gene_th="<"+str(percentile_threshold/100)
+  sql_sof = sql_sof.replace('__SAMPLE_GROUPS__', SAMPLE_GROUPS_SQL)
+
+  # with SL_or_SDL="both" the low (SL) and high (SDL) tails are selected from the same scan and told apart by the tail column
+  sql_sof= sql_sof.replace('__CN_CMP_STR__', _TailCondition('NC.NORM_CN', tails, cn_thresholds))
+  sql_sof= sql_sof.replace('__GENE_CMP_STR__', _TailCondition('NGE.Percentile', tails, [x/100 for x in percentile_thresholds]))
+  sql_sof= _TailSQL(sql_sof, tails, 7)
+
+  if result_cache is not None and len(gene_list)==0:
+      results=None
+  elif engine=='local':
+      tables={'expression':(gene_exp_table, gene_col_name, sample_id, gene_exp),
+              'cn':(cn_table, cn_gene_name, sample_id, cn_gistic),
+              'mutation':(mutation_table, mutation_gene_name, mutation_sample_id)}
+      mutations=input_mutations if 'SL' in tails and input_mutations is not None else None
+      results= _Traced(metrics, 'main statistic', procedure_name, _LocalSurvivalOfFittest, query_client, tables, data_source, tails, gene_list,
+                       sample_groups, percentile_thresholds, cn_thresholds, mutations, snapshot, cn_data, tie_correction)
+  elif engine=='bigquery':
+      results= _Traced(metrics, 'main statistic', procedure_name, ReadResults, query_client, sql_sof, job_config,
+                       symbol_columns=['symbol1', 'symbol2'], float64_columns=['U1', 'pvalue'])
+  else:
+      print("Engine can be either bigquery or local")
+      return()
+  if plan_only:
+      return(metrics)
+  if result_cache is not None:
+      results=_TailStoreResults(result_cache, results, cached, gene_list, cache_args)
+      if results.shape[0]>0:
+          results=results.sort_values(['grp', 'pvalue'], kind='mergesort')
+
+  reports={}
+  for t in range(len(tails)):
+      tail_results=_TailResults(results, tails, t)
+      if tail_results.shape[0]<1:
+          print("SOF inference procedure applied on " + data_source + " did not find candidate " + tails[t] + " pairs.")
+          reports[tails[t]]=tail_results
+          continue
+
+      tail_reports=[]
+      for grp, group_results in tail_results.groupby('grp', sort=True):
+          report=_Traced(metrics, 'report', procedure_name, _SurvivalReport, group_results, gene_mapping, tails[t], adj_method, fdr_level, tissue_groups[grp])
+          if isinstance(report, tuple):
+              return()
+          tail_reports.append(report)
+      reports[tails[t]]=_ConcatReports(tail_reports)
+  return(_TailReports(reports, tails))
 
-  elif SL_or_SDL=="SDL":
-      comp_str=">"+str(cn_threshold)
-      sql_sof= sql_sof.replace('__CN_CMP_STR__', comp_str)
-      com_gene_th=">"+str(percentile_threshold/100)
-      sql_sof= sql_sof.replace('__GENE_CMP_STR__', com_gene_th)
+  
+def _ReadGeneRows(client, snapshot, table_name, gene_col, sample_col, columns, genes, samples):
+    if snapshot is not None:
+        return(snapshot.Read(table_name, columns=columns, genes=genes, filters={sample_col:[str(x) for x in samples]}))
+    sql_rows= '''
+    SELECT __COLUMNS__
+    FROM `__TABLE_NAME__`
+    WHERE __GENE_SYMBOL__ IN UNNEST(@genes) AND __SAMPLE_ID__ IN UNNEST(@samples) '''
+    sql_rows = sql_rows.replace('__COLUMNS__', ', '.join(columns))
+    sql_rows = sql_rows.replace('__TABLE_NAME__', table_name)
+    sql_rows = sql_rows.replace('__GENE_SYMBOL__', gene_col)
+    sql_rows = sql_rows.replace('__SAMPLE_ID__', sample_col)
+    job_config = bigquery.QueryJobConfig(
+    query_parameters=[
+            bigquery.ArrayQueryParameter("genes", "STRING", [str(x) for x in genes]),
+            bigquery.ArrayQueryParameter("samples", "STRING", [str(x) for x in samples])
+        ]
+        )
+    return(ReadResults(client, sql_rows, job_config, symbol_columns=[gene_col, sample_col], float64_columns=columns))
+
+
+def _ReadInactivityData(client, snapshot, tables, data_source, gene_list, samples, input_mutations):
+    # the expression, copy number and mutation rows of the input genes that decide which samples are inactive
+    exp_table, exp_gene_name, exp_sample_id, gene_exp=tables['expression']
+    expression=_ReadGeneRows(client, snapshot, exp_table, exp_gene_name, exp_sample_id, [exp_gene_name, exp_sample_id, gene_exp], gene_list, samples)
+    expression=expression.dropna()
+    expression.columns=['symbol', 'Barcode', 'data']
+    cn_table, cn_gene_name, cn_sample_id, cn_gistic=tables['cn']
+    cn=_ReadGeneRows(client, snapshot, cn_table, cn_gene_name, cn_sample_id, [cn_gene_name, cn_sample_id, cn_gistic], gene_list, samples)
+    cn=cn.dropna()
+    cn.columns=['symbol', 'Barcode', 'data']
+
+    mutation=None
+    if input_mutations is not None:
+        mutation_table, mutation_gene_name, mutation_sample_id=tables['mutation']
+        columns=[mutation_gene_name, mutation_sample_id, 'Variant_Classification']
+        if data_source=='PanCancerAtlas':
+            columns.append('FILTER')
+        mutation=_ReadGeneRows(client, snapshot, mutation_table, mutation_gene_name, mutation_sample_id, columns, gene_list, samples)
+        keep=mutation['Variant_Classification'].isin(list(input_mutations))
+        if data_source=='PanCancerAtlas':
+            keep&=mutation['FILTER']=='PASS'
+        mutation=mutation.loc[keep, [mutation_gene_name, mutation_sample_id, 'Variant_Classification']]
+        mutation.columns=['symbol', 'Barcode', 'Variant_Classification']
+    return(expression, cn, mutation)
+
+
+def _TailMasks(index, row_samples, tails, percentile_thresholds, cn_thresholds, input_mutations):
+    # the inactive (SL) and overactive (SDL) masks of the tails side by side, the mutations only make a gene inactive
+    packed=[]
+    for t in range(len(tails)):
+        mutation_classes=input_mutations if tails[t]=="SL" and input_mutations is not None else None
+        packed.append(index.Inactive(tails[t], percentile_thresholds[t], cn_thresholds[t], mutation_classes))
+    return(index.Mask(np.vstack(packed), row_samples))
+
+
+def _TailColumns(results, input_genes, tails):
+    # maps the mask columns of _TailMasks back to the input gene and, with two tails, the tail of every row
+    column=results['symbol1'].values.astype(np.int64)
+    results['symbol1']=np.asarray(input_genes, dtype=object)[column%len(input_genes)]
+    if len(tails)>1:
+        results.insert(0, 'tail', column//len(input_genes))
+    return(results)
+
+
+def _LocalSurvivalOfFittest(client, tables, data_source, tails, gene_list, sample_groups, percentile_thresholds, cn_thresholds, input_mutations, snapshot, cn_data, tie_correction):
+    all_samples=list(pd.unique(np.concatenate([np.asarray(x, dtype=object) for x in sample_groups])))
+    cn_table, cn_gene_name, sample_id, cn_gistic=tables['cn']
+    if cn_data is None:
+        cn_data=LoadExpressionMatrix(client, cn_table, cn_gene_name, cn_gistic, sample_id, all_samples, snapshot)
+    matrix, samples, genes= cn_data
+    expression, cn, mutation=_ReadInactivityData(client, snapshot, tables, data_source, gene_list, all_samples, input_mutations)
+
+    input_genes=list(pd.unique(np.asarray(gene_list, dtype=object)))
+    sample_rows={samples[i]:i for i in range(len(samples))}
+    # the percentiles depend on the samples of a group, groups of the same samples share their index
+    indexes={}
+    results=[]
+    for grp in range(len(sample_groups)):
+        group_samples=pd.unique(np.asarray(sample_groups[grp], dtype=object))
+        rows=[sample_rows[x] for x in group_samples if x in sample_rows]
+        key=frozenset(group_samples)
+        if key not in indexes:
+            indexes[key]=DAISY_local.InactivityIndex(expression, cn, mutation, group_samples, input_genes)
+        inactive=_TailMasks(indexes[key], [samples[x] for x in rows], tails, percentile_thresholds, cn_thresholds, input_mutations)
+
+        ranks=DAISY_local.RankData(matrix[rows, :])
+        group_results=DAISY_local.MannWhitneyPairs(inactive, ranks, np.arange(inactive.shape[1]), genes, alternative='greater', min_samples=20,
+                                                   min_inactive=5, tie_correction=tie_correction)
+        group_results=_TailColumns(group_results, input_genes, tails)
+        group_results.insert(0, 'grp', grp)
+        results.append(group_results)
+    return(pd.concat(results, ignore_index=True))
+
+
+def _SweepMasks(index, row_samples, SL_or_SDL, percentile_order, cn_order, mutation_classes):
+    # the inactive masks of every threshold pair of a sweep, the column of pair (i, j) and input gene g is (i*len(cn_order)+j)*genes+g.
+    # The index keeps the packed rows of every threshold it was asked for, so a pair is a bitwise and of two of them
+    packed=[index.Inactive(SL_or_SDL, p, c, mutation_classes) for p in percentile_order for c in cn_order]
+    return(index.Mask(np.vstack(packed), row_samples))
+
+
+def _SweepPairs(masks, rank_blocks, input_genes, alternative, tie_correction):
+    # rank sum tests of every threshold pair and input gene against every gene, in one matrix product per block of ranks
+    columns=np.arange(masks.shape[1])
+    results=[]
+    for genes, ranks in rank_blocks:
+        results.append(DAISY_local.MannWhitneyPairs(masks, ranks, columns, genes, alternative=alternative, min_samples=20,
+                                                    min_inactive=5, tie_correction=tie_correction))
+    results=pd.concat(results, ignore_index=True)
+    column=results['symbol1'].values.astype(np.int64)
+    results['pair']=column//len(input_genes)
+    results['symbol1']=np.asarray(input_genes, dtype=object)[column%len(input_genes)]
+    return(results)
+
+
+def _SweepReport(results, percentile_order, cn_order, gene_mapping, SL_or_SDL, adj_method, fdr_level, tissues):
+    # one report per threshold pair, the p values are adjusted within the pair, indexed by (PercentileThreshold, CNThreshold)
+    reports=[]
+    for pair, pair_results in results.groupby('pair', sort=True):
+        report=_SurvivalReport(pair_results.sort_values('pvalue', kind='mergesort'), gene_mapping, SL_or_SDL, adj_method, fdr_level, tissues)
+        if isinstance(report, tuple):
+            return()
+        report.insert(0, 'CNThreshold', cn_order[pair%len(cn_order)])
+        report.insert(0, 'PercentileThreshold', percentile_order[pair//len(cn_order)])
+        reports.append(report)
+    if len(reports)==0:
+        return(pd.DataFrame())
+    report=_ConcatReports(reports).set_index(['PercentileThreshold', 'CNThreshold'])
+    return(report.sort_index(kind='mergesort'))
+
+
+def SurvivalOfFittestSweep(client, SL_or_SDL, data_source, input_genes, percentile_thresholds, cn_thresholds, adj_method, fdr_level, tissues, input_mutations=None, gene_index=None, sample_index=None, snapshot=None, cn_data=None, tie_correction=True):
 
-  sql_sof= sql_sof.replace('__CN_CMP_STR__', comp_str)
-  sql_sof= sql_sof.replace('__GENE_CMP_STR__', com_gene_th)
+  '''
+   Description: SurvivalOfFittest over a grid of thresholds in a single pass. The expression percentiles and copy numbers of the input genes
+   are read once into an InactivityIndex, which packs the samples past every threshold once, so the inactive samples of a threshold
+   pair are a bitwise and of two packed rows. The rank sums of all pairs are obtained with one matrix product (local engine).
+   Inputs:
+    Same as SurvivalOfFittest, except
+    percentile_thresholds:list of doubles, the thresholds for gene expression
+    cn_thresholds:list of doubles, the thresholds for copy number alteration
+   Output:
+       A dataframe of the SL/SDL pairs of every threshold pair, indexed by (PercentileThreshold, CNThreshold),
+       the p values are adjusted within each threshold pair
+  '''
+  if data_source=='PanCancerAtlas':
+      tables={'expression':('isb-cgc-bq.pancancer_atlas.Filtered_EBpp_AdjustPANCAN_IlluminaHiSeq_RNASeqV2_genExp', 'Symbol', 'SampleBarcode', 'normalized_count'),
+              'cn':('isb-cgc-bq.pancancer_atlas.Filtered_all_CNVR_data_by_gene', 'Gene_Symbol', 'SampleBarcode', 'GISTIC_Calls'),
+              'mutation':('isb-cgc-bq.pancancer_atlas.Filtered_MC3_MAF_V5_one_per_tumor_sample', 'Hugo_Symbol', 'Tumor_SampleBarcode')}
+      gene_mapping=ProcessGeneAlias(client, input_genes, 'PanCancerAtlas', gene_index)
+  elif data_source=='CCLE':
+      tables={'expression':('isb-cgc-bq.DEPMAP.CCLE_gene_expression_DepMapPublic_current', 'Hugo_Symbol', 'DepMap_ID', 'TPM'),
+              'cn':('isb-cgc-bq.DEPMAP.CCLE_gene_cn_DepMapPublic_current', 'Hugo_Symbol', 'DepMap_ID', 'CNA'),
+              'mutation':('isb-cgc-bq.DEPMAP.CCLE_mutation_DepMapPublic_current', 'Hugo_Symbol', 'Tumor_Sample_Barcode')}
+      gene_mapping=ProcessGeneAlias(client, input_genes, 'DepMap', gene_index)
+  else :
+      print("The data source name can be either PanCancerAtlas or CCLE")
+      return()
+  sample_group=RetrieveSamples(client, data_source, 'sof', tissues, sample_index)
+  min_sample_size=20
+  if len(sample_group)< (min_sample_size+1):
+      print("Sample size needs to be greater than " +  str(min_sample_size) + ", it is " + str(len(sample_group)))
+      return()
 
+  percentile_order=DAISY_local.SweepOrder(percentile_thresholds, SL_or_SDL)
+  cn_order=DAISY_local.SweepOrder(cn_thresholds, SL_or_SDL)
+  cn_values=np.log2(2**cn_order+1) if data_source=='CCLE' else cn_order
 
-  results= client.query(sql_sof).result().to_dataframe()
+  gene_list=[str(x) for x in input_genes]
+  group_samples=[str(x) for x in pd.unique(np.asarray(sample_group, dtype=object))]
+  cn_table, cn_gene_name, sample_id, cn_gistic=tables['cn']
+  if cn_data is None:
+      cn_data=LoadExpressionMatrix(client, cn_table, cn_gene_name, cn_gistic, sample_id, group_samples, snapshot)
+  matrix, samples, genes= cn_data
+  mutations=input_mutations if SL_or_SDL=='SL' and input_mutations is not None else None
+  expression, cn, mutation=_ReadInactivityData(client, snapshot, tables, data_source, gene_list, group_samples, mutations)
 
-  if results.shape[0]<1:
-      print("SOF inference procedure applied on " + data_resource + " did not find candidate " + SL_or_SDL + " pairs.")
-      return(results)
-  report=results [['symbol1', 'symbol2', 'n1', 'n', 'U1', 'pvalue']]
-  report=report.dropna()
-  report.columns=['InactiveDB', 'SL_Candidate', '#InactiveSamples', '#Samples', 'U1','PValue']
-  report['Inactive']= report['InactiveDB'].map(gene_mapping)
+  input_genes=list(pd.unique(np.asarray(gene_list, dtype=object)))
+  sample_rows={samples[i]:i for i in range(len(samples))}
+  rows=[sample_rows[x] for x in group_samples if x in sample_rows]
+  index=DAISY_local.InactivityIndex(expression, cn, mutation, group_samples, input_genes)
+  masks=_SweepMasks(index, [samples[x] for x in rows], SL_or_SDL, percentile_order, cn_values, mutations)
+  results=_SweepPairs(masks, [(genes, DAISY_local.RankData(matrix[rows, :]))], input_genes, 'greater', tie_correction)
+  return(_SweepReport(results, percentile_order, cn_order, gene_mapping, SL_or_SDL, adj_method, fdr_level, tissues))
 
-  if fdr_level=="gene_level":
-      inactive_genes=list(report["Inactive"].unique())
-      for i in range(len(inactive_genes)):
-         report.loc[report["Inactive"]==inactive_genes[i],'FDR']=multipletests(report.loc[report["Inactive"]==inactive_genes[i], 'PValue'], method= adj_method, is_sorted=False)[1]
 
-  elif fdr_level=="analysis_level":
-     FDR=multipletests(report['PValue'],  method= adj_method, is_sorted=False)[1]
-     report['FDR']=FDR
-  else:
-    print("FDR level can be either gene_level or analysis_level")
-    return()
- 
-  report['Tissue']=str(tissues)
-  
-  cols=['Inactive', 'InactiveDB', 'SL_Candidate','#InactiveSamples', '#Samples',  'PValue', 'FDR', 'Tissue']
-  report=report[cols]
-  if SL_or_SDL=="SDL":
-      report.columns= ['Overactive', 'OveractiveDB', 'SL_Candidate','#Overactive', '#Samples', 'PValue', 'FDR', 'Tissue']
-  return report
+def FunctionalExaminationSweep(client, SL_or_SDL, database, input_genes, percentile_thresholds, cn_thresholds, adj_method, fdr_level, tissues, input_mutations=None, gene_index=None, sample_index=None, snapshot=None, dependency_store=None, tie_correction=True):
 
-  
-def FunctionalExamination(client, SL_or_SDL, database, input_genes, percentile_threshold, cn_threshold, adj_method, fdr_level, tissues,  input_mutations=None):
+    '''
+      Description: FunctionalExamination over a grid of thresholds in a single pass, see SurvivalOfFittestSweep.
+      The dependency scores are ranked once per block of genes and tested for every threshold pair with one matrix product.
+   Inputs:
+    Same as FunctionalExamination, except
+    percentile_thresholds:list of doubles, the thresholds for gene expression
+    cn_thresholds:list of doubles, the thresholds for copy number alteration
+    dependency_store:DependencyStore, the memory-mapped dependency scores, required
+   Output:
+       A dataframe of the SL/SDL pairs of every threshold pair, indexed by (PercentileThreshold, CNThreshold),
+       the p values are adjusted within each threshold pair
+    '''
+    if database not in ('CRISPR', 'shRNA'):
+        print("The database name can be either CRISPR or shRNA")
+        return()
+    if dependency_store is None:
+        print("The sweep needs a DependencyStore")
+        return()
+    selected_samples=RetrieveSamples(client, database, 'func_ex', tissues, sample_index)
+    ccle_samples=selected_samples['DepMap_ID'] if database=='shRNA' else selected_samples
+    ccle_samples=[str(x) for x in pd.unique(np.asarray(ccle_samples, dtype=object))]
+    min_sample_size=20
+    if len(ccle_samples)< (min_sample_size+1):
+        print("Sample size needs to be greater than " +  str(min_sample_size) + ", it is " + str(len(ccle_samples)))
+        return()
+    gene_mapping=ProcessGeneAlias(client, input_genes, 'DepMap', gene_index)
+
+    percentile_order=DAISY_local.SweepOrder(percentile_thresholds, SL_or_SDL)
+    cn_order=DAISY_local.SweepOrder(cn_thresholds, SL_or_SDL)
+    tables={'expression':('isb-cgc-bq.DEPMAP.CCLE_gene_expression_DepMapPublic_current', 'Hugo_Symbol', 'DepMap_ID', 'TPM'),
+            'cn':('isb-cgc-bq.DEPMAP.CCLE_gene_cn_DepMapPublic_current', 'Hugo_Symbol', 'DepMap_ID', 'CNA'),
+            'mutation':('isb-cgc-bq.DEPMAP.CCLE_mutation_DepMapPublic_current', 'Hugo_Symbol', 'DepMap_ID')}
+    gene_list=[str(x) for x in input_genes]
+    mutations=input_mutations if SL_or_SDL=='SL' and input_mutations is not None else None
+    expression, cn, mutation=_ReadInactivityData(client, snapshot, tables, 'CCLE', gene_list, ccle_samples, mutations)
+
+    input_genes=list(pd.unique(np.asarray(gene_list, dtype=object)))
+    rows=dependency_store.Rows(database, ccle_samples)
+    row_samples=list(dependency_store.Samples(database)['DepMap_ID'].values[rows])
+    index=DAISY_local.InactivityIndex(expression, cn, mutation, ccle_samples, input_genes)
+    masks=_SweepMasks(index, row_samples, SL_or_SDL, percentile_order, np.log2(2**cn_order+1), mutations)
+    results=_SweepPairs(masks, dependency_store.IterateRanks(database, rows), input_genes, 'less', tie_correction)
+    return(_SweepReport(results, percentile_order, cn_order, gene_mapping, SL_or_SDL, adj_method, fdr_level, tissues))
+
+
+def _LocalFunctionalExamination(client, tables, database, tails, gene_list, ccle_samples, percentile_thresholds, cn_thresholds, input_mutations, snapshot, dependency_store, tie_correction):
+    ccle_samples=[str(x) for x in pd.unique(np.asarray(ccle_samples, dtype=object))]
+    expression, cn, mutation=_ReadInactivityData(client, snapshot, tables, 'CCLE', gene_list, ccle_samples, input_mutations)
+
+    input_genes=list(pd.unique(np.asarray(gene_list, dtype=object)))
+    rows=dependency_store.Rows(database, ccle_samples)
+    row_samples=dependency_store.Samples(database)['DepMap_ID'].values[rows]
+    index=DAISY_local.InactivityIndex(expression, cn, mutation, ccle_samples, input_genes)
+    inactive=_TailMasks(index, list(row_samples), tails, percentile_thresholds, cn_thresholds, input_mutations)
+
+    # the dependency matrix is ranked and tested one block of genes at a time
+    results=[]
+    for genes, ranks in dependency_store.IterateRanks(database, rows):
+        results.append(DAISY_local.MannWhitneyPairs(inactive, ranks, np.arange(inactive.shape[1]), genes, alternative='less', min_samples=20,
+                                                    min_inactive=5, tie_correction=tie_correction))
+    results=_TailColumns(pd.concat(results, ignore_index=True), input_genes, tails)
+    return(results.sort_values('pvalue', kind='mergesort').reset_index(drop=True))
+
+
+def FunctionalExamination(client, SL_or_SDL, database, input_genes, percentile_threshold, cn_threshold, adj_method, fdr_level, tissues,  input_mutations=None, gene_index=None, sample_index=None, engine='bigquery', snapshot=None, dependency_store=None, tie_correction=True, rank_tables=None, max_bytes_billed=None, plan_only=False, metrics=None, result_cache=None):
 
     '''
       Description: Gene expression, Copy Number Alteration (CNA), Somatic Mutations (optional) are used to decide whether gene is inactive.
@@ -629,20 +1849,65 @@ def FunctionalExamination(client, SL_or_SDL, database, input_genes, percentile_t
 
    Inputs:
     client:BigQueryClient, the BigQuery client that will run the function.
-    SL_or_SDL:string, Synthetic lethal or Synthetic Dosage Lethal, valid values: 'SL', 'SDL'
+    SL_or_SDL:string, Synthetic lethal or Synthetic Dosage Lethal, valid values: 'SL', 'SDL', 'both'
+        "both" selects the inactive (SL) and overactive (SDL) samples from the same scan of the data and tests them in one pass
     database: string, The dataresource the analysis will be performed on, 	valid values: "CRISPR", "shRNA"
     input_genes:list of strings, the list of genes whose SL/SDL partners will be seeked	
     percentile_threshold:double, the threshold for gene expression (for deciding whether a gene is inactive)
-    cn_threshold:double, the threshold for copy number alteration (for deciding whether a gene is inactive)
+        with SL_or_SDL="both" either one value or a pair of (SL, SDL) thresholds, e.g. (10, 90)
+    cn_threshold:double, the threshold for copy number alteration (for deciding whether a gene is inactive), a pair of (SL, SDL) thresholds
+        is accepted as for percentile_threshold
     adj_method:	string,	optional, p value correction method,  valid_values:bonferroni,  sidak, holm-sidak , holm, simes-hochberg , hommel, fdr_bh,  fdr_by , fdr_tsbh, fdr_tsbky 
     fdr_level:string, the data that will be considered wile doing p value adjustment, valid values : "gene_level", "analysis_level"
     tissues: list of strings, the tissues that the analysis will be performed on. 
     input_mutations:list of strings, optional, valid values: "Missense_Mutation", "Nonsense_Mutation","Translation_Start_Site", "Frame_Shift_Ins", "Splice_Site",
     "In_Frame_Del","Frame_Shift_Del", "Nonstop_Mutation", "In_Frame_Ins"
+    gene_index:GeneIndex, optional, the local gene index used to map the input genes to their aliases
+    sample_index:SampleAvailability, optional, the local sample availability matrix the samples are selected from
+    engine:string, optional, where the rank sums are computed, valid values: "bigquery", "local"
+    snapshot:SnapshotStore, optional, the local Parquet snapshots the local engine reads the expression, copy number and mutation rows from
+    dependency_store:DependencyStore, the memory-mapped dependency scores the local engine ranks, required by engine="local"
+    tie_correction:boolean, optional, if True (default) the local engine corrects the variance of the rank sums for ties, False reproduces
+        the uncorrected z-scores of the bigquery engine
+    rank_tables:RankTables, optional, if given the bigquery engine reads the ranks from the precomputed per-release rank tables
+    max_bytes_billed:integer, optional, the byte budget of the analysis. The queries are dry run first and the analysis is not run
+        when their estimated bytes exceed the budget. Every job also reserves the bytes it can bill at most out of what is left of
+        the budget and is capped to them, a job that no longer fits raises BudgetExceeded. With the local engine the jobs are only capped.
+    plan_only:boolean, optional, if True the queries are only dry run and the QueryMetrics with their estimated bytes per stage is returned.
+        The estimates do not depend on the samples and genes, except for the pruning of clustered tables.
+    metrics:QueryMetrics, optional, filled with the stage, bytes processed and billed and slot milliseconds of every query,
+        a StageTracer also times the sample selection, alias lookup, main statistic and report stages
+    result_cache:ResultCache, optional, if given the per-gene results are read from the cache and only the genes missing from it are computed
         
    Output:
-       A dataframe of SL/SDL pairs
+       A dataframe of SL/SDL pairs, with SL_or_SDL="both" a dictionary of the SL and SDL dataframes keyed by 'SL' and 'SDL'
     '''
+    tails=_Tails(SL_or_SDL)
+    if tails is None:
+        return()
+    percentile_thresholds=_TailThresholds(percentile_threshold, tails)
+    cn_thresholds=_TailThresholds(cn_threshold, tails)
+    if percentile_thresholds is None or cn_thresholds is None:
+        return()
+    if max_bytes_billed is not None and not plan_only:
+        metrics=QueryMetrics() if metrics is None else metrics
+        # the local engines can not be planned, their jobs are only capped. DAISYPipeline already checked the plan of its procedures
+        if engine=='bigquery' and not isinstance(max_bytes_billed, _CheckedBudget):
+            plan=FunctionalExamination(client, SL_or_SDL, database, input_genes, percentile_threshold, cn_threshold, adj_method, fdr_level, tissues,
+                                       input_mutations, gene_index, sample_index, engine, snapshot, dependency_store, tie_correction, rank_tables, plan_only=True,
+                                       result_cache=result_cache)
+            if not _WithinBudget(plan, max_bytes_billed):
+                return()
+    if plan_only:
+        if engine!='bigquery':
+            print("plan_only is available for the bigquery engine")
+            return()
+        metrics=QueryMetrics() if metrics is None else metrics
+    sample_client, alias_client, query_client=_StageClients(client, metrics, plan_only, max_bytes_billed)
+    procedure_name='functional_examination_' + database
+    cache_parameters=[{'SL_or_SDL':tails[t], 'percentile_threshold':percentile_thresholds[t], 'cn_threshold':cn_thresholds[t],
+                       'input_mutations':input_mutations, 'tie_correction':tie_correction, **_CacheSources(engine, rank_tables, sample_index)}
+                       for t in range(len(tails))]
 
        
 
@@ -653,7 +1918,7 @@ def FunctionalExamination(client, SL_or_SDL, database, input_genes, percentile_t
         gene_exp='TPM'
         effect='Gene_Effect'
         symbol='Hugo_Symbol'
-        selected_samples= RetrieveSamples(client, 'CRISPR', 'func_ex', tissues)
+        selected_samples= _Traced(metrics, 'sample selection', procedure_name, RetrieveSamples, sample_client, 'CRISPR', 'func_ex', tissues, sample_index)
         ccle_samples=selected_samples
         ccle_sample_id='DepMap_ID'
         cid="DepMap_ID"
@@ -664,7 +1929,7 @@ def FunctionalExamination(client, SL_or_SDL, database, input_genes, percentile_t
         gene_exp='TPM'
         effect='Combined_Gene_Dep_Score'
         symbol='Hugo_Symbol'
-        selected_samples= RetrieveSamples(client, 'shRNA', 'func_ex', tissues)
+        selected_samples= _Traced(metrics, 'sample selection', procedure_name, RetrieveSamples, sample_client, 'shRNA', 'func_ex', tissues, sample_index)
         ccle_samples=selected_samples['DepMap_ID']
         shRNA_samples=selected_samples['CCLE_Name']
         ccle_sample_id='DepMap_ID'
@@ -679,54 +1944,46 @@ def FunctionalExamination(client, SL_or_SDL, database, input_genes, percentile_t
     gene_exp_table='isb-cgc-bq.DEPMAP.CCLE_gene_expression_DepMapPublic_current'
     cn_table='isb-cgc-bq.DEPMAP.CCLE_gene_cn_DepMapPublic_current'
     sample_info_table='isb-cgc-bq.synthetic_lethality.sample_info_TCGAlabels_DepMapPublic_20Q3'
-    cn_threshold=np.log2(2**(cn_threshold)+1)
-    gene_mapping=ProcessGeneAlias(client, input_genes, 'DepMap')
+    cn_thresholds=[np.log2(2**(x)+1) for x in cn_thresholds]
+    gene_mapping=_Traced(metrics, 'alias lookup', procedure_name, ProcessGeneAlias, alias_client, input_genes, 'DepMap', gene_index)
 
     min_sample_size=20
-    if len(selected_samples)< (min_sample_size+1):
+    if len(selected_samples)< (min_sample_size+1) and not plan_only:
         print("Sample size needs to be greater than " +  str(min_sample_size) + ", it is " + str(len(selected_samples)))
         return()
     sql_without_mutation= """
     WITH
     table1 AS (
-    (SELECT   symbol, Barcode FROM
+    (SELECT   __TAIL_COLUMN__symbol, Barcode FROM
     (SELECT GE.__SYMBOL__ AS symbol, GE.__CCLE_SAMPLE_ID__ AS Barcode ,
     PERCENT_RANK () over (partition by __SYMBOL__ order by __GENE_EXPRESSION__ asc) AS Percentile
     FROM  __GENE_EXP_TABLE__ GE
-    WHERE GE.__SYMBOL__ in (__GENELIST__) AND __CCLE_SAMPLE_ID__ in (__SAMPLE_LIST_CCLE__) AND __GENE_EXPRESSION__ is not null ) AS NGE
-    WHERE NGE.Percentile __GENE_CMP_STR__
+    WHERE GE.__SYMBOL__ in UNNEST(@genes) AND __CCLE_SAMPLE_ID__ in UNNEST(@samples) AND __GENE_EXPRESSION__ is not null ) AS NGE __TAILS__
+    WHERE __GENE_CMP_STR__
 
     INTERSECT DISTINCT
 
-    SELECT symbol,  Barcode FROM
+    SELECT __TAIL_COLUMN__symbol,  Barcode FROM
     (SELECT CN.__SYMBOL__ AS symbol, CN.__CCLE_SAMPLE_ID__ AS Barcode,
     CN.CNA AS NORM_CN
     FROM  __CN_TABLE__ CN
-    WHERE CN.__SYMBOL__ in (__GENELIST__) AND __CCLE_SAMPLE_ID__ in (__SAMPLE_LIST_CCLE__) and    CN.CNA is not null) AS NC
-    WHERE NC.NORM_CN __CN_CMP_STR__  )"""
+    WHERE CN.__SYMBOL__ in UNNEST(@genes) AND __CCLE_SAMPLE_ID__ in UNNEST(@samples) and    CN.CNA is not null) AS NC __TAILS__
+    WHERE __CN_CMP_STR__  )"""
 
 
     sql_mutation_part="""  
 
     UNION DISTINCT
-    SELECT M.__SYMBOL__  AS symbol , M.__CCLE_SAMPLE_ID__ AS Barcode
+    SELECT __MUTATION_TAIL__M.__SYMBOL__  AS symbol , M.__CCLE_SAMPLE_ID__ AS Barcode
     FROM __MUTATION_TABLE__ M
-    WHERE __SYMBOL__ IN (__GENELIST__) AND
-    M.Variant_Classification IN (__MUTATIONLIST__) AND __CCLE_SAMPLE_ID__ in (__SAMPLE_LIST_CCLE__))"""
+    WHERE __SYMBOL__ IN UNNEST(@genes) AND
+    M.Variant_Classification IN UNNEST(@mutations) AND __CCLE_SAMPLE_ID__ in UNNEST(@samples))"""
 
 
     rest_of_the_query= """
-     , table2 AS (
-    SELECT
-        S.DepMap_ID Barcode,   __SYMBOL__ symbol,
-        (RANK() OVER (PARTITION BY __SYMBOL__ ORDER BY __EFFECT__ ASC)) + (COUNT(*) OVER ( PARTITION BY __SYMBOL__, CAST(__EFFECT__ as STRING)) - 1)/2.0  AS rnkdata
-    FROM
-       __ACHILLES_TABLE__ A, __SAMPLE_INFO_TABLE__ S  
-       where __SYMBOL__ IS NOT NULL AND __EFFECT__ IS NOT NULL AND  S.__REL_SAMPLE_ID__=A.__SAMPLE_ID__ AND S.DepMap_ID in (__SAMPLE_LIST_CCLE__)
-       ),
-summ_table AS (
+__TABLE2__summ_table AS (
 SELECT
-   n1.symbol as symbol1,
+   __N1_TAIL__n1.symbol as symbol1,
    n2.symbol as symbol2,
    COUNT( n1.Barcode) as n_1,
    SUM( n2.rnkdata )  as sumx_1,
@@ -737,13 +1994,13 @@ INNER JOIN
 ON
    n1.Barcode = n2.Barcode
 GROUP BY
-    symbol1, symbol2 ),
+    __TAIL_COLUMN__symbol1, symbol2 ),
 
 statistics AS (
-SELECT symbol1, symbol2, n1, n, U1,
+SELECT __TAIL_COLUMN__symbol1, symbol2, n1, n, U1,
        (U1 - n1n2/2.0)/den as zscore
 FROM (
-   SELECT  symbol1, symbol2, n_t as n,
+   SELECT  __TAIL_COLUMN__symbol1, symbol2, n_t as n,
        n_1 as n1,
        sumx_1 - n_1 *(n_1 + 1) / 2.0 as U1,
        n_1 * (n_t - n_1 ) as n1n2,
@@ -757,33 +2014,57 @@ FROM (
 )
 WHERE den > 0
 )
-SELECT symbol1, symbol2, n1, n, U1,
+SELECT __TAIL_COLUMN__symbol1, symbol2, n1, n, U1,
     `cgc-05-0042.functions.jstat_normal_cdf`(zscore, 0.0, 1.0 ) as pvalue
 FROM statistics
-GROUP BY 1,2,3,4,5,6
+GROUP BY 1,2,3,4,5,6__TAIL_ORDINAL__
 #HAVING pvalue <= 0.01
 ORDER BY pvalue ASC """
 
-    genes_intermediate_representation = ["'" +str(x)+"'"  for x in input_genes]
-    input_genes_query= ','.join(genes_intermediate_representation)
-    included_samples=["'"+ str(x) + "'" for x in selected_samples]
-    included_samples= ','.join(included_samples)
-    included_samples_ccle=["'"+ str(x) + "'" for x in ccle_samples]
-    included_samples_ccle= ','.join(included_samples_ccle)
+    gene_list=[str(x) for x in input_genes]
+    if result_cache is not None:
+        cache_tables=[dep_score_table, gene_exp_table, cn_table, mutation_table, sample_info_table]
+        cache_args=[('func_ex', database, [tissues], parameters, cache_tables) for parameters in cache_parameters]
+        cached, gene_list=_TailCachedResults(result_cache, gene_list, cache_args)
+    query_parameters=[
+            bigquery.ArrayQueryParameter("genes", "STRING", gene_list),
+            bigquery.ArrayQueryParameter("samples", "STRING", [str(x) for x in ccle_samples])
+        ]
 
 
-    if SL_or_SDL=='SDL' or input_mutations is None:
+    if 'SL' not in tails or input_mutations is None:
         sql_func_ex=sql_without_mutation +  ')' +' ' +  rest_of_the_query
     else:
-        mutations_intermediate_representation = ["'"+x+"'" for x in input_mutations]
-        input_mutations_for_query = ','.join(mutations_intermediate_representation)
+        query_parameters.append(bigquery.ArrayQueryParameter("mutations", "STRING", [str(x) for x in input_mutations]))
         sql_func_ex=sql_without_mutation + ' '+ sql_mutation_part + ' ' +  rest_of_the_query
         sql_func_ex = sql_func_ex.replace('__MUTATION_TABLE__', mutation_table)
-        sql_func_ex = sql_func_ex.replace('__MUTATIONLIST__', input_mutations_for_query)
-
-    sql_func_ex = sql_func_ex.replace('__GENELIST__', input_genes_query)
-    sql_func_ex = sql_func_ex.replace('__CUTOFFPRC__', str(percentile_threshold/100))
-    sql_func_ex = sql_func_ex.replace('__CUTOFFSCNA__', str(cn_threshold))
+    job_config = bigquery.QueryJobConfig(query_parameters=query_parameters)
+
+    rank_table=None
+    if rank_tables is not None and engine=='bigquery':
+        if 'pancancer' in tissues:
+            pancancer_samples=ccle_samples
+        else:
+            pancancer_samples=_Traced(metrics, 'sample selection', procedure_name, RetrieveSamples, sample_client, database, 'func_ex', ['pancancer'], sample_index)
+            if database=='shRNA':
+                pancancer_samples=pancancer_samples['DepMap_ID']
+        # a plan reads no rank table that does not exist yet, its queries are planned on the source table
+        rank_table=_Traced(metrics, 'rank tables', procedure_name, rank_tables.Table, dep_score_table, pancancer_samples, query_client)
+    if rank_table is None:
+        sql_table2="""     , table2 AS (
+    SELECT
+        S.DepMap_ID Barcode,   __SYMBOL__ symbol,
+        (RANK() OVER (PARTITION BY __SYMBOL__ ORDER BY __EFFECT__ ASC)) + (COUNT(*) OVER ( PARTITION BY __SYMBOL__, CAST(__EFFECT__ as STRING)) - 1)/2.0  AS rnkdata
+    FROM
+       __ACHILLES_TABLE__ A, __SAMPLE_INFO_TABLE__ S  
+       where __SYMBOL__ IS NOT NULL AND __EFFECT__ IS NOT NULL AND  S.__REL_SAMPLE_ID__=A.__SAMPLE_ID__ AND S.DepMap_ID in UNNEST(@samples)
+       ),
+"""
+    else:
+        sql_table2, _=_RankTableCTE('table2', 'Barcode', 'R.symbol IS NOT NULL', None, _FullGroups([ccle_samples], pancancer_samples))
+        sql_table2='     , ' + sql_table2.strip() + ',\n'
+        sql_table2=sql_table2.replace('__RANK_TABLE__', rank_table)
+    sql_func_ex = sql_func_ex.replace('__TABLE2__', sql_table2)
     sql_func_ex = sql_func_ex.replace('__CN_TABLE__', cn_table)
     sql_func_ex = sql_func_ex.replace('__GENE_EXP_TABLE__', gene_exp_table)
     sql_func_ex = sql_func_ex.replace('__SAMPLE_ID__', sample_id)
@@ -791,55 +2072,87 @@ ORDER BY pvalue ASC """
     sql_func_ex = sql_func_ex.replace('__ACHILLES_TABLE__', dep_score_table)
     sql_func_ex = sql_func_ex.replace('__GENE_EXPRESSION__', gene_exp)
     sql_func_ex = sql_func_ex.replace('__EFFECT__', effect)
-    sql_func_ex= sql_func_ex.replace('__SAMPLE_LIST__', included_samples)
-    sql_func_ex= sql_func_ex.replace('__SAMPLE_LIST_CCLE__', included_samples_ccle)
     sql_func_ex= sql_func_ex.replace('__SAMPLE_INFO_TABLE__', sample_info_table)
     sql_func_ex = sql_func_ex.replace('__CCLE_SAMPLE_ID__', ccle_sample_id)
     sql_func_ex = sql_func_ex.replace('__REL_SAMPLE_ID__', cid)
 
-    if SL_or_SDL=="SL":
-      comp_str="<"+str(cn_threshold)
-      com_gene_th="<"+str(percentile_threshold/100)
-
-    elif SL_or_SDL=="SDL":
-      comp_str=">"+str(cn_threshold)
-      com_gene_th=">"+str(percentile_threshold/100)
-
-    sql_func_ex= sql_func_ex.replace('__CN_CMP_STR__', comp_str)
-    sql_func_ex= sql_func_ex.replace('__GENE_CMP_STR__', com_gene_th)
-
-    results= client.query(sql_func_ex).result().to_dataframe()
-    if results.shape[0]<1:
-      print("Functional examimation inference procedure applied on " + database + " did not find candidate " + SL_or_SDL + " pairs.")
-      return(results)
-    
-    report=results[['symbol1', 'symbol2', 'n1', 'n' ,'pvalue']]
-    report=report.dropna()
-    report.columns=['InactiveDB', 'SL_Candidate', '#InactiveSamples', '#Samples', 'PValue']
-    report['Inactive']= report['InactiveDB'].map(gene_mapping)
-    
-    if fdr_level=="gene_level":
-       inactive_genes=list(report["Inactive"].unique())
-       for i in range(len(inactive_genes)):
-          report.loc[report["Inactive"]==inactive_genes[i],'FDR']=multipletests(report.loc[report["Inactive"]==inactive_genes[i], 'PValue'], method= adj_method, is_sorted=False)[1]
-
-    elif fdr_level=="analysis_level":
-      FDR=multipletests(report['PValue'],  method= adj_method, is_sorted=False)[1]
-      report['FDR']=FDR
+    # with SL_or_SDL="both" the low (SL) and high (SDL) tails are selected from the same scan and told apart by the tail column
+    sql_func_ex= sql_func_ex.replace('__CN_CMP_STR__', _TailCondition('NC.NORM_CN', tails, cn_thresholds))
+    sql_func_ex= sql_func_ex.replace('__GENE_CMP_STR__', _TailCondition('NGE.Percentile', tails, [x/100 for x in percentile_thresholds]))
+    sql_func_ex= _TailSQL(sql_func_ex, tails, 6)
+
+    if result_cache is not None and len(gene_list)==0:
+        results=None
+    elif engine=='local':
+        if dependency_store is None:
+            print("The local engine needs a DependencyStore")
+            return()
+        tables={'expression':(gene_exp_table, symbol, ccle_sample_id, gene_exp),
+                'cn':(cn_table, symbol, ccle_sample_id, 'CNA'),
+                'mutation':(mutation_table, symbol, ccle_sample_id)}
+        mutations=input_mutations if 'SL' in tails and input_mutations is not None else None
+        results= _Traced(metrics, 'main statistic', procedure_name, _LocalFunctionalExamination, query_client, tables, database, tails, gene_list,
+                         ccle_samples, percentile_thresholds, cn_thresholds, mutations, snapshot, dependency_store, tie_correction)
+    elif engine=='bigquery':
+        results= _Traced(metrics, 'main statistic', procedure_name, ReadResults, query_client, sql_func_ex, job_config,
+                         symbol_columns=['symbol1', 'symbol2'], float64_columns=['U1', 'pvalue'])
     else:
-      print("FDR level can be either gene_level or analysis_level")
-      return()
- 
-    report['Tissue']=str(tissues)
-    cols=['Inactive', 'InactiveDB', 'SL_Candidate','#InactiveSamples', '#Samples', 'PValue', 'FDR', 'Tissue']
-    report=report[cols]
-    if SL_or_SDL=="SDL":
-      report.columns= ['Overactive', 'OveractiveDB', 'SL_Candidate','#Overactive', '#Samples', 'PValue', 'FDR', 'Tissue']
-    return report
+        print("Engine can be either bigquery or local")
+        return()
+    if plan_only:
+        return(metrics)
+    if result_cache is not None:
+        results=_TailStoreResults(result_cache, None if results is None else results.assign(grp=0), cached, gene_list, cache_args)
+        if results.shape[0]>0:
+            results=results.drop(columns='grp').sort_values('pvalue', kind='mergesort')
+    reports={}
+    for t in range(len(tails)):
+        tail_results=_TailResults(results, tails, t)
+        if tail_results.shape[0]<1:
+            print("Functional examimation inference procedure applied on " + database + " did not find candidate " + tails[t] + " pairs.")
+            reports[tails[t]]=tail_results
+            continue
+        report=_Traced(metrics, 'report', procedure_name, _SurvivalReport, tail_results, gene_mapping, tails[t], adj_method, fdr_level, tissues)
+        if isinstance(report, tuple):
+            return()
+        reports[tails[t]]=report
+    return(_TailReports(reports, tails))
+
+def _PairKeys(results, gene_col):
+    # the (gene, SL_Candidate) pairs of every result as int64 keys over one shared sorted dictionary of the symbols,
+    # missing symbols get the code after the last symbol
+    columns=[]
+    for x in results:
+        for col in (gene_col, 'SL_Candidate'):
+            if isinstance(x[col].dtype, pd.CategoricalDtype):
+                columns.append((x[col].cat.codes.values, x[col].cat.categories))
+            else:
+                columns.append(pd.factorize(x[col]))
+    symbols=[pd.Series(uniques) for codes, uniques in columns]
+    dictionary=pd.Index(pd.unique(pd.concat(symbols + [pd.Series([], dtype=object)], ignore_index=True).dropna().values)).sort_values()
+    # the codes of every column are mapped to the dictionary through its (few) distinct symbols
+    codes=[np.append(dictionary.get_indexer(uniques), len(dictionary))[codes] for codes, uniques in columns]
+    base=len(dictionary)+1
+    keys=[codes[2*i].astype(np.int64)*base+codes[2*i+1] for i in range(len(results))]
+    return(keys, dictionary, base)
+
+
+def _MergedPairs(results, gene_col, how):
+    # the gene and SL_Candidate columns of the merged pairs, categoricals over the shared dictionary, and the row of every
+    # result joined to them
+    keys, dictionary, base=_PairKeys(results, gene_col)
+    merged, rows=DAISY_local.MergePairKeys(keys, how)
+    pairs={}
+    for col, codes in ((gene_col, merged//base), ('SL_Candidate', merged%base)):
+        pairs[col]=pd.Categorical.from_codes(np.where(codes<len(dictionary), codes, -1), dtype=pd.CategoricalDtype(dictionary))
+    return(pd.DataFrame(pairs), rows)
+
 
 def UnionResults(results, SL_or_SDL, labels, tissues):
     '''
     Description: This functions merges results from the same inference procedure applied on different datasets.
+    The pairs are encoded as integer keys over one shared dictionary of the gene symbols and joined in one sort-merge pass,
+    the input dataframes are left unchanged. The categorical symbol columns of the reports are encoded through their categories.
     Inputs:
         results: list of dataframes, the output of inference procedure applied on different datasets,
         SL_or_SDL:string, Synthetic lethal or Synthetic Dosage Lethal, valid values: 'SL', 'SDL'
@@ -847,48 +2160,33 @@ def UnionResults(results, SL_or_SDL, labels, tissues):
         tissues: list of strings, the tissues that the analysis will be performed on.
 
     Output:
-         A dataframe o merged results
+         A dataframe o merged results, ordered by pair, with the label column of every non empty result numbered by its position
+         among them (e.g. FDR0, FDR1)
     '''
-    inds=[]
-    for i in range(len(results)):
-        if results[i].shape[0]<1:
-            inds.append(i)
-            
-    indices = sorted(inds, reverse=True)
-    for idx in indices:
-        if idx < len(results):
-            results.pop(idx)
-    for i in range(len(results)):
-        results[i].reset_index(inplace=True, drop=True)
-        results[i].rename(columns = {labels[i]:labels[i]+ str(i)}, inplace = True)
-    
-    combined_results=results[0]
-    for i in range(1,len(results)):
-        if SL_or_SDL=="SL":
-            combined_results =pd.merge(combined_results, results[i], on = ['Inactive',  'SL_Candidate'], how = 'outer')
-        elif SL_or_SDL=="SDL":
-            combined_results =pd.merge(combined_results, results[i], on = ['Overactive',  'SL_Candidate'], how = 'outer')
-
-    rel_cols=combined_results.columns[np.array([x.startswith(labels[i]) for x in combined_results.columns])]
-    p_matrix=combined_results[rel_cols]
-
-    combined_results["Tissue"]=str(tissues)
-    if SL_or_SDL=="SL":
-        inc_cols= ['Inactive', 'SL_Candidate'] +  list(rel_cols) +['Tissue']
-    elif SL_or_SDL=="SDL":
-       inc_cols= ['Overactive', 'SL_Candidate'] +  list(rel_cols) + ['Tissue']
-
+    gene_col='Inactive' if SL_or_SDL=="SL" else 'Overactive'
+    kept=[i for i in range(len(results)) if results[i].shape[0]>0]
+    combined_results, rows=_MergedPairs([results[i] for i in kept], gene_col, 'outer')
+    rel_cols=[]
+    for position in range(len(kept)):
+        label=labels[kept[position]]
+        combined_results[label + str(position)]=pd.api.extensions.take(results[kept[position]][label].array, rows[position], allow_fill=True)
+        rel_cols.append(label + str(position))
+
+    combined_results["Tissue"]=pd.Categorical.from_codes(np.zeros(combined_results.shape[0], dtype=np.int8), [str(tissues)])
+    inc_cols= [gene_col, 'SL_Candidate'] + rel_cols + ['Tissue']
     return(combined_results[inc_cols])
 
 def MergeResults(results, SL_or_SDL, tissues):
     '''
-  Description: This function merges results from SoF, Coexpression and Functional Examination procedures
+  Description: This function merges results from SoF, Coexpression and Functional Examination procedures.
+  The pairs are encoded as integer keys over one shared dictionary of the gene symbols and joined in one sort-merge pass,
+  the input dataframes are left unchanged. The categorical symbol columns of the reports are encoded through their categories.
   Inputs:
     results: list of dataframes, the output of inference procedure applied on different datasets,
     SL_or_SDL:string, Synthetic lethal or Synthetic Dosage Lethal, valid values: 'SL', 'SDL'
     tissues: list of strings, the tissues that the analysis will be performed on.
  Output:
-    A dataframe o merged results
+    A dataframe o merged results, ordered by pair
     '''
       
     inds=[]
@@ -899,25 +2197,376 @@ def MergeResults(results, SL_or_SDL, tissues):
         print("At least one of the inference procedure did not return results")
         print("No SL pairs found by every pipeline")
         return()
-    indices = sorted(inds, reverse=True)
-    for idx in indices:
-        if idx < len(results):
-            results.pop(idx)
-    for i in range(len(results)):
-        results[i].reset_index(inplace=True, drop=True)
 
-    combined_results=results[0]
-    for i in range(1,len(results)):
-        if SL_or_SDL=="SL":
-            combined_results =pd.merge(combined_results, results[i], on = ['Inactive',  'SL_Candidate'], how = 'inner')
-        elif SL_or_SDL=="SDL":
-            combined_results =pd.merge(combined_results, results[i], on = ['Overactive',  'SL_Candidate'], how = 'inner')
-
-    combined_results["Tissue"]=str(tissues)
-
-    if SL_or_SDL=="SL":
-        inc_cols= ['Inactive', 'SL_Candidate'] 
-    elif SL_or_SDL=="SDL":
-        inc_cols= ['Overactive', 'SL_Candidate']
-    return(combined_results[inc_cols])
+    gene_col='Inactive' if SL_or_SDL=="SL" else 'Overactive'
+    return(_MergedPairs(results, gene_col, 'inner')[0])
+
+
+class _SharedLookups:
+    # Gene alias mappings and sample lists shared by the procedures of a DAISYPipeline. Every lookup runs once,
+    # procedures asking for a lookup that is in progress wait for its result instead of querying again.
+    # Used as the gene_index and sample_index of the procedures.
+
+    def __init__(self, client, gene_index=None, sample_index=None, metrics=None, plan_only=False, max_bytes_billed=None):
+        self.sample_client, self.alias_client, _=_StageClients(client, metrics, plan_only, max_bytes_billed)
+        self.gene_index=gene_index
+        self.sample_index=sample_index
+        self._lock=threading.Lock()
+        self._results={}
+
+    def _Get(self, key, function):
+        with self._lock:
+            result=self._results.get(key)
+            owner=result is None
+            if owner:
+                result=Future()
+                self._results[key]=result
+        if owner:
+            try:
+                result.set_result(function())
+            except Exception as e:
+                result.set_exception(e)
+        value=result.result()
+        return value.copy() if isinstance(value, (pd.DataFrame, dict, list)) else value
+
+    def MapGenes(self, database, input_gene_list):
+        return self._Get(('genes', database, tuple(input_gene_list)),
+                         lambda: ProcessGeneAlias(self.alias_client, input_gene_list, database, self.gene_index))
+
+    def Select(self, data_resource, method, tissues):
+        return self._Get(('samples', data_resource, method, tuple(tissues)),
+                         lambda: RetrieveSamples(self.sample_client, data_resource, method, tissues, self.sample_index))
+
+
+def _FilterReport(report, SL_or_SDL, label, cor_threshold, p_threshold):
+    # the significant pairs of a procedure, as selected in the DAISY example workflow
+    if not isinstance(report, pd.DataFrame) or report.shape[0]<1:
+        return(pd.DataFrame())
+    keep=report[label]<p_threshold
+    if 'Correlation' in report.columns:
+        keep&=report['Correlation']>cor_threshold
+    gene_col='Inactive' if SL_or_SDL=="SL" else 'Overactive'
+    return(report.loc[keep].sort_values([gene_col, label], kind='mergesort'))
+
+
+def DAISYPipeline(client, SL_or_SDL, input_genes, percentile_threshold, cn_threshold, cor_threshold, p_threshold, adj_method, fdr_level, tissues, input_mutations=None, max_workers=6, gene_index=None, sample_index=None, max_bytes_billed=None, plan_only=False, metrics=None, result_cache=None):
+    '''
+    Description: Runs the six DAISY procedures (coexpression on PanCancerAtlas and CCLE, survival of the fittest on PanCancerAtlas and CCLE,
+    functional examination on CRISPR and shRNA) concurrently, so the total time is close to the slowest procedure instead of their sum.
+    The gene alias mappings and sample lists are looked up once and shared by the procedures. The significant pairs of each procedure
+    are combined with UnionResults as soon as both datasets of the procedure are done, and the three unions with MergeResults.
+    Inputs:
+        client:BigQueryClient, the BigQuery client that will run the function.
+        SL_or_SDL:string, Synthetic lethal or Synthetic Dosage Lethal, valid values: 'SL', 'SDL', 'both'
+            "both" runs every procedure once for the SL and SDL analyses together
+        input_genes:list of strings, the list of genes whose SL/SDL partners will be seeked
+        percentile_threshold:double, the threshold for gene expression (for deciding whether a gene is inactive), or a pair of (SL, SDL) thresholds
+        cn_threshold:double, the threshold for copy number alteration (for deciding whether a gene is inactive), or a pair of (SL, SDL) thresholds
+        cor_threshold:double, the correlation threshold of the coexpression pairs
+        p_threshold:double, the threshold of the FDR (coexpression, survival of the fittest) and of the p values (functional examination)
+        adj_method:string, p value correction method,  valid_values:bonferroni,  sidak, holm-sidak , holm, simes-hochberg , hommel, fdr_bh,  fdr_by , fdr_tsbh, fdr_tsbky
+        fdr_level:string, the data that will be considered wile doing p value adjustment, valid values : "gene_level", "analysis_level"
+        tissues:list of strings, the tissues that the analysis will be performed on.
+        input_mutations:list of strings, optional, the mutation types that make a gene inactive
+        max_workers:integer, optional, the number of procedures run at the same time
+        gene_index:GeneIndex, optional, the local gene index used to map the input genes to their aliases
+        sample_index:SampleAvailability, optional, the local sample availability matrix the samples are selected from
+        max_bytes_billed:integer, optional, the byte budget of the six procedures together, they are not run when the dry runs of their
+            queries exceed it. The jobs running at the same time reserve their part of the budget, a job that no longer fits raises BudgetExceeded.
+        plan_only:boolean, optional, if True the queries are only dry run and the QueryMetrics with their estimated bytes per stage is returned
+        metrics:QueryMetrics, optional, filled with the stage, bytes processed and billed and slot milliseconds of every query.
+            With a StageTracer the stages of every procedure are timed too and their summary is printed at the end of the run.
+        result_cache:ResultCache, optional, the per-gene result cache of the procedures
+    Output:
+        A dictionary with the full report of every procedure ('coexpression_PanCancerAtlas', 'coexpression_CCLE', 'sof_PanCancerAtlas',
+        'sof_CCLE', 'functional_examination_CRISPR', 'functional_examination_shRNA'), the unions of the significant pairs
+        ('coexpression', 'sof', 'functional_examination') and the pairs found by every procedure ('merged').
+        With SL_or_SDL="both" a dictionary of such dictionaries keyed by 'SL' and 'SDL'
+    '''
+    tails=_Tails(SL_or_SDL)
+    if tails is None:
+        return()
+    if max_bytes_billed is not None and not plan_only:
+        plan=DAISYPipeline(client, SL_or_SDL, input_genes, percentile_threshold, cn_threshold, cor_threshold, p_threshold, adj_method, fdr_level,
+                           tissues, input_mutations, max_workers, gene_index, sample_index, plan_only=True, result_cache=result_cache)
+        if not _WithinBudget(plan, max_bytes_billed):
+            return()
+        metrics=QueryMetrics() if metrics is None else metrics
+    if plan_only:
+        metrics=QueryMetrics() if metrics is None else metrics
+    shared=_SharedLookups(client, gene_index, sample_index, metrics, plan_only, max_bytes_billed)
+    metered={} if metrics is None else {'metrics':metrics, 'plan_only':plan_only}
+    if max_bytes_billed is not None and not plan_only:
+        # the budget was checked on the plan of the whole pipeline, the procedures do not plan again but cap every job
+        # to what the shared metrics leave of it
+        metered['max_bytes_billed']=_CheckedBudget(max_bytes_billed)
+    if result_cache is not None:
+        metered['result_cache']=result_cache
+    procedures={
+        'coexpression_PanCancerAtlas':(CoexpressionAnalysis, (client, SL_or_SDL, 'PanCancerAtlas', input_genes, adj_method, fdr_level, tissues),
+                                       {'gene_index':shared, 'sample_index':shared, **metered}),
+        'coexpression_CCLE':(CoexpressionAnalysis, (client, SL_or_SDL, 'CCLE', input_genes, adj_method, fdr_level, tissues),
+                             {'gene_index':shared, 'sample_index':shared, **metered}),
+        'sof_PanCancerAtlas':(SurvivalOfFittest, (client, SL_or_SDL, 'PanCancerAtlas', input_genes, percentile_threshold, cn_threshold, adj_method,
+                                                  fdr_level, tissues, input_mutations), {'gene_index':shared, 'sample_index':shared, **metered}),
+        'sof_CCLE':(SurvivalOfFittest, (client, SL_or_SDL, 'CCLE', input_genes, percentile_threshold, cn_threshold, adj_method,
+                                        fdr_level, tissues, input_mutations), {'gene_index':shared, 'sample_index':shared, **metered}),
+        'functional_examination_CRISPR':(FunctionalExamination, (client, SL_or_SDL, 'CRISPR', input_genes, percentile_threshold, cn_threshold,
+                                                                 adj_method, fdr_level, tissues, input_mutations), {'gene_index':shared, 'sample_index':shared, **metered}),
+        'functional_examination_shRNA':(FunctionalExamination, (client, SL_or_SDL, 'shRNA', input_genes, percentile_threshold, cn_threshold,
+                                                                adj_method, fdr_level, tissues, input_mutations), {'gene_index':shared, 'sample_index':shared, **metered}),
+    }
+    # the two datasets of every procedure and the column their significance is judged on
+    unions={'coexpression':(['coexpression_PanCancerAtlas', 'coexpression_CCLE'], 'FDR'),
+            'sof':(['sof_CCLE', 'sof_PanCancerAtlas'], 'FDR'),
+            'functional_examination':(['functional_examination_CRISPR', 'functional_examination_shRNA'], 'PValue')}
+
+    if plan_only:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures=[executor.submit(function, *args, **kwargs) for function, args, kwargs in procedures.values()]
+            for future in futures:
+                future.result()
+        return(metrics)
+
+    output={tail:{} for tail in tails}
+    significant={tail:{} for tail in tails}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures={executor.submit(function, *args, **kwargs):name for name, (function, args, kwargs) in procedures.items()}
+        for future in as_completed(futures):
+            name=futures[future]
+            tail_reports=future.result()
+            if len(tails)==1 or not isinstance(tail_reports, dict):
+                tail_reports={tail:tail_reports for tail in tails}
+            for tail in tails:
+                report=tail_reports[tail]
+                output[tail][name]=report if isinstance(report, pd.DataFrame) else pd.DataFrame()
+                for union, (members, label) in unions.items():
+                    if name in members:
+                        significant[tail][name]=_FilterReport(report, tail, label, cor_threshold, p_threshold)
+                        if all(x in significant[tail] for x in members):
+                            reports=[significant[tail][x] for x in members]
+                            if all(x.shape[0]<1 for x in reports):
+                                print("No Result From " + union + " Inference Procedure")
+                                output[tail][union]=pd.DataFrame()
+                            else:
+                                output[tail][union]=_Traced(metrics, 'union', union, UnionResults, reports, tail, [label, label], tissues)
+
+    for tail in tails:
+        merged=_Traced(metrics, 'merge', 'merged', MergeResults, [output[tail][union] for union in unions], tail, tissues)
+        output[tail]['merged']=merged if isinstance(merged, pd.DataFrame) else pd.DataFrame()
+    if isinstance(metrics, StageTracer):
+        print(metrics.StageSummary())
+    return(_TailReports(output, tails))
+
+
+# The procedures a DAISY batch run can be made of, with their kind and data resource, named as in DAISYPipeline
+BATCH_PROCEDURES={
+    'coexpression_PanCancerAtlas':('coexpression', 'PanCancerAtlas'),
+    'coexpression_CCLE':('coexpression', 'CCLE'),
+    'sof_PanCancerAtlas':('sof', 'PanCancerAtlas'),
+    'sof_CCLE':('sof', 'CCLE'),
+    'functional_examination_CRISPR':('functional_examination', 'CRISPR'),
+    'functional_examination_shRNA':('functional_examination', 'shRNA'),
+}
+
+
+def _Blocks(values, size):
+    return([values[i:i+size] for i in range(0, len(values), size)])
+
+
+def _ProcedureOptions(function, options):
+    # the options the procedure function accepts
+    parameters=inspect.signature(function).parameters
+    return({key:value for key, value in options.items() if key in parameters})
+
+
+# the sample selection method of every kind of procedure, see RetrieveSamples
+_BATCH_SAMPLE_METHODS={'coexpression':'correlation', 'sof':'sof', 'functional_examination':'func_ex'}
+
+
+def _RunShard(client, name, genes, tissue_groups, spec, options):
+    # the reports of one shard keyed by analysis (SL, SDL), an exception is left to the caller
+    kind, data_resource=BATCH_PROCEDURES[name]
+    tails=_Tails(spec['SL_or_SDL'])
+    # the tissue groups with too few samples give no report whenever they are run, they are left out here and a shard without
+    # tissue groups is kept as empty. The sample lists are looked up once and shared with the procedures.
+    min_sample_size=20
+    included_groups=[]
+    for tissues in tissue_groups:
+        samples=RetrieveSamples(client, data_resource, _BATCH_SAMPLE_METHODS[kind], tissues, options.get('sample_index'))
+        if len(samples)< (min_sample_size+1):
+            print("Sample size needs to be greater than " +  str(min_sample_size) + ", it is " + str(len(samples)) + " for " + name + " " + str(tissues))
+        else:
+            included_groups.append(tissues)
+    if len(included_groups)==0:
+        return({tail:pd.DataFrame() for tail in tails})
+    tissue_groups=included_groups
+
+    if kind=='coexpression':
+        reports=[CoexpressionAnalysisBatch(client, spec['SL_or_SDL'], data_resource, genes, spec['adj_method'], spec['fdr_level'], tissue_groups,
+                                           **_ProcedureOptions(CoexpressionAnalysisBatch, options))]
+    elif kind=='sof':
+        reports=[SurvivalOfFittestBatch(client, spec['SL_or_SDL'], data_resource, genes, spec['percentile_threshold'], spec['cn_threshold'],
+                                        spec['adj_method'], spec['fdr_level'], tissue_groups, spec.get('input_mutations'),
+                                        **_ProcedureOptions(SurvivalOfFittestBatch, options))]
+    else:
+        reports=[FunctionalExamination(client, spec['SL_or_SDL'], data_resource, genes, spec['percentile_threshold'], spec['cn_threshold'],
+                                       spec['adj_method'], spec['fdr_level'], tissues, spec.get('input_mutations'),
+                                       **_ProcedureOptions(FunctionalExamination, options)) for tissues in tissue_groups]
+    shard={}
+    for tail in tails:
+        frames=[report if len(tails)==1 or not isinstance(report, dict) else report[tail] for report in reports]
+        # a procedure finding no pairs returns an empty dataframe, any other answer (e.g. refused by the budget) fails the shard
+        if not all(isinstance(x, pd.DataFrame) for x in frames):
+            raise RuntimeError(name + " gave no report for " + str(tissue_groups))
+        frames=[x for x in frames if x.shape[0]>0]
+        shard[tail]=_ConcatReports(frames) if len(frames)>0 else pd.DataFrame()
+    return(shard)
+
+
+def _ShardPath(checkpoint_dir, shard, tail):
+    name, tissue_block, gene_block=shard
+    return(os.path.join(checkpoint_dir, name, 't' + str(tissue_block).zfill(3) + '_g' + str(gene_block).zfill(4) + '_' + tail + '.parquet'))
+
+
+def _WriteShard(checkpoint_dir, shard, reports):
+    # every report is written to a temporary file first, a shard is complete once the files of all its analyses exist
+    os.makedirs(os.path.dirname(_ShardPath(checkpoint_dir, shard, 'SL')), exist_ok=True)
+    for tail, report in reports.items():
+        path=_ShardPath(checkpoint_dir, shard, tail)
+        report.to_parquet(path + '.tmp', index=False)
+        os.replace(path + '.tmp', path)
+
+
+def _BatchReport(frames, spec):
+    # the report of one procedure from the reports of its shards, with the analysis level FDR adjusted over all of its shards
+    frames=[x for x in frames if x.shape[0]>0]
+    if len(frames)==0:
+        return(pd.DataFrame())
+    report=_ConcatReports(frames)
+    if spec['fdr_level']=="analysis_level":
+        for tissues, rows in report.groupby('Tissue', sort=False).groups.items():
+            report.loc[rows, 'FDR']=multipletests(report.loc[rows, 'PValue'], method=spec['adj_method'], is_sorted=False)[1]
+    return(report)
+
+
+def _BatchProgress(done, total, resumed, failed, started, metrics):
+    elapsed=max(time.time()-started, 1e-9)
+    run=done-resumed
+    table=metrics.Table()
+    print(str(done) + "/" + str(total) + " shards done (" + str(resumed) + " from checkpoints, " + str(failed) + " failed), " +
+          str(round(run*60/elapsed, 2)) + " shards/min, " + str(round(table['bytes_processed'].sum()/1e9, 3)) + " GB scanned, " +
+          str(round(table['bytes_billed'].sum()/1e9, 3)) + " GB billed")
+    sys.stdout.flush()
+
+
+def DAISYBatchRun(client, job_spec, checkpoint_dir, max_workers=4, progress_interval=30, metrics=None, **options):
+    '''
+    Description: Runs DAISY procedures over a whole gene panel and many tissues as a resumable batch job. The work is split into shards
+    of (procedure, block of tissue groups, block of genes) that run on a pool of max_workers threads. The report of every finished shard
+    is checkpointed to Parquet under checkpoint_dir, so running the same job again skips the finished shards and only runs the ones that
+    were not finished or failed. The tissue groups with too few samples are left out, a shard whose procedure gives no report
+    (e.g. refused by max_bytes_billed) fails and is retried by the next run. Progress, shards per minute and the bytes scanned and
+    billed so far are printed while the job runs.
+    Analysis level FDRs are adjusted again over all the shards of a procedure and tissue group. Gene level FDRs are the ones of the
+    shard of the gene, which for survival of the fittest and functional examination are the same as in one run over all genes.
+    For coexpression they differ for pairs of two input genes of different gene blocks: one run tests such a pair once, under the
+    smaller symbol, while the batch reports it under both genes and counts it in the gene level FDRs of both.
+    Inputs:
+        client:BigQueryClient, the BigQuery client that will run the function.
+        job_spec:dictionary, the job, with the keys
+            genes:list of strings, the gene panel whose SL/SDL partners will be seeked
+            tissues:list, the tissue groups, every element is one analysis, a tissue (e.g. 'BRCA') or a list of tissues (e.g. ['BRCA', 'OV'])
+            procedures:list of strings, optional, the procedures to run, keys of BATCH_PROCEDURES, all of them by default
+            SL_or_SDL:string, valid values: 'SL', 'SDL', 'both'
+            percentile_threshold, cn_threshold:double, the thresholds of survival of the fittest and functional examination
+            adj_method:string, p value correction method
+            fdr_level:string, valid values: "gene_level", "analysis_level"
+            input_mutations:list of strings, optional, the mutation types that make a gene inactive
+            genes_per_shard:integer, optional, the number of genes of a shard, 25 by default
+            tissues_per_shard:integer, optional, the number of tissue groups of a shard, 1 by default
+        checkpoint_dir:string, the directory of the job spec and the shard checkpoints, a directory is used by one job spec only
+        max_workers:integer, optional, the number of shards run at the same time
+        progress_interval:double, optional, the seconds between two progress lines
+        metrics:QueryMetrics, optional, filled with the statistics of every query of the shards run, with a StageTracer the stages
+            of the shards are timed too and their summary is printed at the end of the run
+        options:optional, passed to the procedures that accept them, e.g. engine, snapshot, gene_index, sample_index, rank_tables,
+            dependency_store, result_cache, tie_correction
+    Output:
+        A dictionary with the report of every procedure of the job, made of the reports of its finished shards. With SL_or_SDL="both"
+        a dictionary of such dictionaries keyed by 'SL' and 'SDL'. The reports can be combined with UnionResults and MergeResults.
+    '''
+    spec={'procedures':list(BATCH_PROCEDURES), 'input_mutations':None, 'percentile_threshold':None, 'cn_threshold':None,
+          'genes_per_shard':25, 'tissues_per_shard':1, **job_spec}
+    spec['genes']=[str(x) for x in pd.unique(np.asarray(spec['genes'], dtype=object))]
+    spec['tissues']=[x if isinstance(x, str) else list(x) for x in spec['tissues']]
+    tails=_Tails(spec['SL_or_SDL'])
+    if tails is None:
+        return()
+    unknown=[x for x in spec['procedures'] if x not in BATCH_PROCEDURES]
+    if len(unknown)>0:
+        print("Unknown procedures " + str(unknown) + ", valid values: " + str(list(BATCH_PROCEDURES)))
+        return()
+    if spec['fdr_level'] not in ("gene_level", "analysis_level"):
+        print("FDR level can be either gene_level or analysis_level")
+        return()
+    if spec['fdr_level']=="analysis_level" and options.get('top_k') is not None:
+        print("top_k can not be combined with analysis_level FDRs in a batch run")
+        return()
 
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    spec_path=os.path.join(checkpoint_dir, 'job_spec.json')
+    spec_json=json.dumps(spec, indent=2, sort_keys=True, default=str)
+    if os.path.exists(spec_path):
+        with open(spec_path) as f:
+            if f.read()!=spec_json:
+                print("The checkpoints in " + checkpoint_dir + " belong to another job spec, use a new directory for this job")
+                return()
+    else:
+        with open(spec_path, 'w') as f:
+            f.write(spec_json)
+
+    tissue_groups=[[x] if isinstance(x, str) else x for x in spec['tissues']]
+    tissue_blocks=_Blocks(tissue_groups, int(spec['tissues_per_shard']))
+    gene_blocks=_Blocks(spec['genes'], int(spec['genes_per_shard']))
+    shards=[(name, t, g) for name in spec['procedures'] for t in range(len(tissue_blocks)) for g in range(len(gene_blocks))]
+    finished=[x for x in shards if all(os.path.exists(_ShardPath(checkpoint_dir, x, tail)) for tail in tails)]
+    finished_set=set(finished)
+    pending=[x for x in shards if x not in finished_set]
+
+    metrics=QueryMetrics() if metrics is None else metrics
+    # the sample lists and gene aliases are looked up once for all shards
+    shared=_SharedLookups(client, options.get('gene_index'), options.get('sample_index'), metrics)
+    options={**options, 'gene_index':shared, 'sample_index':shared, 'metrics':metrics}
+    failed={}
+    done=len(finished)
+    started=time.time()
+    last_progress=started
+    print(str(len(shards)) + " shards, " + str(len(finished)) + " already done")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures={executor.submit(_RunShard, client, shard[0], gene_blocks[shard[2]], tissue_blocks[shard[1]], spec, options):shard
+                 for shard in pending}
+        for future in as_completed(futures):
+            shard=futures[future]
+            try:
+                _WriteShard(checkpoint_dir, shard, future.result())
+                done+=1
+            except Exception as e:
+                failed[shard]=e
+            if time.time()-last_progress>=progress_interval:
+                _BatchProgress(done, len(shards), len(finished), len(failed), started, metrics)
+                last_progress=time.time()
+    _BatchProgress(done, len(shards), len(finished), len(failed), started, metrics)
+    for shard, e in failed.items():
+        print("Shard " + str(shard) + " failed: " + repr(e))
+    if len(failed)>0:
+        print("The reports miss the " + str(len(failed)) + " failed shards, run the job again to retry them")
+    if isinstance(metrics, StageTracer):
+        print(metrics.StageSummary())
+
+    output={tail:{} for tail in tails}
+    for tail in tails:
+        for name in spec['procedures']:
+            frames=[pd.read_parquet(_ShardPath(checkpoint_dir, x, tail)) for x in shards if x[0]==name and x not in failed]
+            output[tail][name]=_BatchReport(frames, spec)
+    return(_TailReports(output, tails))
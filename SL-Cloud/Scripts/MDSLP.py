@@ -1,8 +1,15 @@
+import os
+import json
+import shutil
+import hashlib
 from google.cloud import bigquery
 import pandas as pd
 from scipy import stats 
 import statsmodels.stats.multitest as multi
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from helper import ReadResults
 
 ## The GeneSymbol_standardization function will convert all non-standarized gene list to approved gene symbols.###
 def GeneSymbol_standardization(Gene_list,project_id):
@@ -45,7 +52,7 @@ def GeneSymbol_standardization(Gene_list,project_id):
         ]
         )
 
-    Mut_mat = client.query(query1, job_config=job_config).result().to_dataframe()
+    Mut_mat = ReadResults(client, query1, job_config, symbol_columns=['Hugo_Symbol', 'DepMap_ID', 'Variant_Classification'])
     set_gene_CCLE = set(Mut_mat['Hugo_Symbol'])
 
     dic_gene_to_alias = {}
@@ -121,21 +128,176 @@ def get_ccle_mutation_data(project_id):
             select Hugo_Symbol,DepMap_ID,Variant_Classification 
             from `isb-cgc-bq.DEPMAP.CCLE_mutation_DepMapPublic_current`
             '''
-    Mut_mat = client.query(query).result().to_dataframe()
+    Mut_mat = ReadResults(client, query, symbol_columns=['Hugo_Symbol', 'DepMap_ID', 'Variant_Classification'])
     return(Mut_mat)
 
-## Get gene gene knockout effects from CRISPR dataset in Depmap data portal; version (Depmap 20Q3). 
-def get_depmap_crispr_data(project_id):
+## The Depmap data portal files of the knockout/knockdown effects, downloaded once and kept as float32 matrices in the cache directory.
+## A download is checked against the md5 of its entry, or when that is None against the md5 figshare lists for the file in its article.
+DEPMAP_DOWNLOADS = {
+    'crispr_20Q3': {'url': "https://ndownloader.figshare.com/files/24613292", 'article': 12931238, 'md5': None},
+    'demeter2_shRNA': {'url': "https://ndownloader.figshare.com/files/13515395", 'article': 6025238, 'md5': None},
+}
+FIGSHARE_FILE_API = "https://api.figshare.com/v2/articles/{article}/files/{file_id}"
+## The seconds a download waits to connect and between two blocks of data
+DOWNLOAD_TIMEOUT = 60
+DEPMAP_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'SL-Cloud', 'depmap')
+
+
+def _Fetch(source, path, chunk_size=1 << 20):
+    # streams a URL to path, or reads a local file in place, and returns the file and its md5 checksum
+    digest = hashlib.md5()
+    if '://' not in source:
+        with open(source, 'rb') as f:
+            for block in iter(lambda: f.read(chunk_size), b''):
+                digest.update(block)
+        return(source, digest.hexdigest())
+
+    import requests
+    size = 0
+    try:
+        with requests.get(source, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+            if response.status_code != 200:
+                print('Download of ' + source + ' failed with HTTP status ' + str(response.status_code))
+                return()
+            with open(path, 'wb') as f:
+                for block in response.iter_content(chunk_size=chunk_size):
+                    f.write(block)
+                    digest.update(block)
+                    size += len(block)
+            expected = response.headers.get('Content-Length')
+    except requests.RequestException as e:
+        # e.g. no data for DOWNLOAD_TIMEOUT seconds, the partial file is removed with the temporary directory
+        print('Download of ' + source + ' failed: ' + repr(e))
+        return()
+    if expected is not None and int(expected) != size and response.headers.get('Content-Encoding') is None:
+        print('Download of ' + source + ' is incomplete: ' + str(size) + ' of ' + expected + ' bytes')
+        os.remove(path)
+        return()
+    return(path, digest.hexdigest())
+
+
+def _Figshare_md5(download):
+    # the md5 checksum figshare keeps for a file of DEPMAP_DOWNLOADS, None when it can not be read
     import requests
-    from io import StringIO
+    file_id = download['url'].rstrip('/').split('/')[-1]
+    api = FIGSHARE_FILE_API.format(article=download['article'], file_id=file_id)
+    try:
+        response = requests.get(api, timeout=DOWNLOAD_TIMEOUT)
+    except requests.RequestException as e:
+        print('The checksum of ' + download['url'] + ' could not be read from ' + api + ': ' + repr(e) + ', pass md5 to check the download')
+        return(None)
+    if response.status_code != 200:
+        print('The checksum of ' + download['url'] + ' could not be read from ' + api + ', HTTP status ' + str(response.status_code) +
+              ', pass md5 to check the download')
+        return(None)
+    record = response.json()
+    return(record.get('supplied_md5') or record.get('computed_md5') or None)
+
+
+def _Build_depmap_cache(path, source, md5, chunk_size=2048):
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    try:
+        fetched = _Fetch(source, os.path.join(tmp_path, 'download.csv'))
+        if len(fetched) == 0:
+            return()
+        csv_path, checksum = fetched
+        if md5 is not None and checksum != md5:
+            print('Checksum of ' + source + ' is ' + checksum + ', expected ' + md5)
+            return()
+
+        # the csv is parsed block by block of rows, only the float32 copy of the effects is kept
+        rows = []
+        blocks = []
+        for chunk in pd.read_csv(csv_path, index_col=0, chunksize=chunk_size):
+            rows.extend(chunk.index.astype(str))
+            blocks.append(chunk.to_numpy(dtype=np.float32))
+            columns = list(chunk.columns)
+            index_name = chunk.index.name
+        if len(blocks) == 0:
+            print(source + ' has no rows')
+            return()
+        values = np.lib.format.open_memmap(os.path.join(tmp_path, 'values.npy'), mode='w+', dtype=np.float32,
+                                           shape=(len(rows), len(columns)))
+        start = 0
+        for block in blocks:
+            values[start:start + block.shape[0]] = block
+            start += block.shape[0]
+        values.flush()
+        del values, blocks
+        np.save(os.path.join(tmp_path, 'rows.npy'), np.asarray(rows, dtype=str))
+        np.save(os.path.join(tmp_path, 'columns.npy'), np.asarray(columns, dtype=str))
+        if csv_path != source:
+            os.remove(csv_path)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump({'source': source, 'md5': checksum, 'index_name': index_name}, f, indent=2, sort_keys=True)
+
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        return(path)
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def Load_depmap_matrix(name, source=None, cache_dir=None, md5=None):
+    """
+    Description: The matrix of a Depmap data portal csv file, downloaded and converted to float32 only once. The download is streamed 
+    to the disk, checked against its md5 checksum, and converted to a .npy matrix with the row and column labels in the cache directory.
+    The Depmap portal files of DEPMAP_DOWNLOADS are always checked, against md5 when given, else against the checksum of
+    DEPMAP_DOWNLOADS or, until it is set, the one of the figshare record of the file. Other sources are checked when md5 is given.
+    Later calls memory-map the cached matrix, the pages are read from the disk as they are used and changes to the dataframe are not 
+    written back. The cache is rebuilt when the source or md5 changes.
+
+    Input:
+    name: the name of the matrix in the cache directory, a key of DEPMAP_DOWNLOADS for the Depmap portal files
+    source: optional, URL or local path of the csv file, the url of DEPMAP_DOWNLOADS[name] by default
+    cache_dir: optional, the cache directory, DEPMAP_CACHE_DIR by default
+    md5: optional, the expected md5 checksum of the csv file, the one of DEPMAP_DOWNLOADS[name] by default for its url
+
+    Output: 
+    A float32 dataframe of the csv file, indexed by its first column
+    """
+    download = DEPMAP_DOWNLOADS.get(name)
+    if source is None:
+        if download is None:
+            print(name + ' is not a Depmap portal file, valid values: ' + str(list(DEPMAP_DOWNLOADS)) + ', or give its source')
+            return()
+        source = download['url']
+    # the checksum of a Depmap portal file is known whenever it is downloaded from its url
+    portal_file = download is not None and source == download['url']
+    if md5 is None and portal_file:
+        md5 = download['md5']
+    path = os.path.join(DEPMAP_CACHE_DIR if cache_dir is None else cache_dir, name)
+    meta = None
+    if os.path.exists(os.path.join(path, 'meta.json')):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+    if meta is None or meta['source'] != source or (md5 is not None and meta['md5'] != md5):
+        if md5 is None and portal_file:
+            md5 = _Figshare_md5(download)
+            if md5 is None:
+                return()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if len(_Build_depmap_cache(path, source, md5)) == 0:
+            return()
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+
+    values = np.load(os.path.join(path, 'values.npy'), mmap_mode='c')
+    rows = pd.Index(np.load(os.path.join(path, 'rows.npy')).tolist(), name=meta['index_name'])
+    columns = np.load(os.path.join(path, 'columns.npy')).tolist()
+    return(pd.DataFrame(values, index=rows, columns=columns, copy=False))
 
-    url = "https://ndownloader.figshare.com/files/24613292"
-    req = requests.get(url)
-    data = StringIO(req.text)
 
-    Depmap_matrix = pd.read_csv(data )
-    Depmap_matrix.index = Depmap_matrix['DepMap_ID']
-    Depmap_matrix = Depmap_matrix.drop(['DepMap_ID'], axis=1)
+## Get gene gene knockout effects from CRISPR dataset in Depmap data portal; version (Depmap 20Q3). 
+def get_depmap_crispr_data(project_id, source=None, cache_dir=None, md5=None):
+    """
+    The source, cache_dir and md5 arguments are passed to Load_depmap_matrix, the file is downloaded only on the first call.
+    """
+    Depmap_matrix = Load_depmap_matrix('crispr_20Q3', source, cache_dir, md5)
+    if len(Depmap_matrix) == 0:
+        return()
     
     gene_names_old = list(Depmap_matrix.columns.values)
     gene_names_new = []
@@ -147,17 +309,16 @@ def get_depmap_crispr_data(project_id):
     return(Depmap_matrix)
 
 ## Get gene gene down effects from shRNA dataset in Depmap data portal; version (Demeter). 
-def get_demeter_shRNA_data(project_id):
-    import requests
-    from io import StringIO
-    url = "https://ndownloader.figshare.com/files/13515395"
-    req = requests.get(url)
-    data = StringIO(req.text)
-    
-    Depmap_matrix = pd.read_csv(data )
+def get_demeter_shRNA_data(project_id, source=None, cache_dir=None, md5=None):
+    """
+    The source, cache_dir and md5 arguments are passed to Load_depmap_matrix, the file is downloaded only on the first call.
+    """
+    Depmap_matrix = Load_depmap_matrix('demeter2_shRNA', source, cache_dir, md5)
+    if len(Depmap_matrix) == 0:
+        return()
     
     gene_names_new = []
-    for item in list(Depmap_matrix['Unnamed: 0']):
+    for item in list(Depmap_matrix.index):
         name = item.split(' (')[0]
         gene_names_new.append(name)
     Depmap_matrix.index = gene_names_new
@@ -186,7 +347,101 @@ def get_demeter_shRNA_data(project_id):
     Depmap_matrix_sele = Depmap_matrix_sele.transpose()
     return(Depmap_matrix_sele)
 
-def Mutational_based_SL_pipeline(tumor_type, mut_gene, Mut_mat, Depmap_matrix, datatype,project_id ):
+def Knockdown_ttests(effects, not_nan, mut_counts, wt_mask, chunk_size=2048):
+    """
+    Description: The t-tests and effect sizes (Cohen's distance) of the knockout/knockdown effects of all the knockdown genes between 
+    the mutated and the wild type cell lines, computed at once with matrix products over blocks of chunk_size genes. 
+    Gives the same results as stats.ttest_ind and Cohen's distance applied gene by gene on the effects that are not NaN.
+
+    Input:
+    effects: cell lines x knockdown genes array of the effects, with the NaN effects replaced by 0
+    not_nan: cell lines x knockdown genes boolean array, False where the effect is NaN
+    mut_counts: the number of times every cell line is in the mutated group (a cell line with two mutations of the gene counts twice)
+    wt_mask: boolean array, True for the cell lines of the wild type group
+    chunk_size: the number of knockdown genes tested together
+
+    Output: 
+    The number of mutated cell lines, the p value and the effect size of every knockdown gene
+    """
+    weights = np.vstack([np.asarray(mut_counts, dtype=np.float64), np.asarray(wt_mask, dtype=np.float64)])
+    n_genes = effects.shape[1]
+    n = np.empty((2, n_genes))
+    means = np.empty((2, n_genes))
+    ss = np.empty((2, n_genes))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for start in range(0, n_genes, chunk_size):
+            cols = slice(start, min(start + chunk_size, n_genes))
+            valid = not_nan[:, cols]
+            n[:, cols] = weights @ valid
+            means[:, cols] = (weights @ effects[:, cols]) / n[:, cols]
+            for g in range(2):
+                deviations = (effects[:, cols] - means[g, cols]) * valid
+                ss[g, cols] = weights[g] @ (deviations * deviations)
+
+        # the t-test uses the variances with one degree of freedom, Cohen's distance the standard deviations of the samples
+        var = ss / (n - 1)
+        pvalues = stats.ttest_ind_from_stats(means[0], np.sqrt(var[0]), n[0], means[1], np.sqrt(var[1]), n[1])[1]
+        std = np.sqrt(ss / n)
+        s = np.sqrt(((n[0] - 1)*std[0]*std[0] + (n[1] - 1)*std[1]*std[1]) / (n[0] + n[1] - 2))
+        es = (means[0] - means[1]) / s
+    return(n[0].astype(np.int64), pvalues, es)
+
+def _Gene_ttests(effects, not_nan, mut_counts):
+    # the knockdown genes tested for one mutated gene (more than 5 mutated cell lines, defined p value) and their results
+    n_mut, pvalues, es = Knockdown_ttests(effects, not_nan, mut_counts, mut_counts == 0)
+    tested = np.flatnonzero((n_mut > 5) & ~np.isnan(pvalues))
+    return(tested, n_mut[tested], pvalues[tested], es[tested])
+
+
+# the effects and their NaN mask in the shared memory of the pool, attached once per worker process
+_shared_arrays = {}
+
+
+def _To_shared(array):
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    return(block)
+
+
+def _Attach_shared(blocks):
+    for key, (name, shape, dtype) in blocks.items():
+        # the workers share the resource tracker of the parent, which unlinks the blocks once
+        block = shared_memory.SharedMemory(name=name)
+        _shared_arrays[key] = (block, np.ndarray(shape, dtype=dtype, buffer=block.buf))
+
+
+def _Shared_gene_ttests(mut_counts):
+    return(_Gene_ttests(_shared_arrays['effects'][1], _shared_arrays['not_nan'][1], mut_counts))
+
+
+def Parallel_gene_ttests(effects, not_nan, mut_counts_list, processes):
+    """
+    Description: The tests of several mutated genes on a pool of processes. The effects and their NaN mask are copied once into 
+    shared memory that the processes read without copies, only the mutated group counts of every gene and the results of its 
+    tested knockdown genes are sent between processes.
+
+    Input:
+    effects: cell lines x knockdown genes array of the effects, with the NaN effects replaced by 0
+    not_nan: cell lines x knockdown genes boolean array, False where the effect is NaN
+    mut_counts_list: list of the mutated group counts of every mutated gene, as in Knockdown_ttests
+    processes: the number of processes
+
+    Output: 
+    The tested knockdown genes, mutated cell line counts, p values and effect sizes of every mutated gene, in the order of mut_counts_list
+    """
+    blocks = {}
+    try:
+        for key, array in (('effects', effects), ('not_nan', not_nan)):
+            blocks[key] = _To_shared(np.ascontiguousarray(array))
+        names = {key: (blocks[key].name, array.shape, array.dtype) for key, array in (('effects', effects), ('not_nan', not_nan))}
+        with ProcessPoolExecutor(max_workers=processes, initializer=_Attach_shared, initargs=(names,)) as executor:
+            return(list(executor.map(_Shared_gene_ttests, mut_counts_list)))
+    finally:
+        for block in blocks.values():
+            block.close()
+            block.unlink()
+
+def Mutational_based_SL_pipeline(tumor_type, mut_gene, Mut_mat, Depmap_matrix, datatype,project_id, processes=None):
     """
     Description: The mutation-dependent synthetic lethality prediction (MDSLP) workflow is based on the rationale that, 
     for tumors with mutations that have an impact on protein expression or structure (functional mutation), 
@@ -208,13 +463,13 @@ def Mutational_based_SL_pipeline(tumor_type, mut_gene, Mut_mat, Depmap_matrix, d
     For the CRISPR data-based pipeline, we used CCLE mutation, Achilles gene effect, and sample_info data from DepMap (version 20Q3).
     After selecting tumor types, or the pan-cancer analysis option, for each selected mutated gene, we grouped the cell lines into 
     either the mutated or the wild-type group, then tested whether the knockout effects or the gene dependency scores for the two groups
-    show statistically significant differences using a t-test, followed by Benjamini-Hochberg (BH) adjustment. Effect size (Cohen_dist function) was used to 
+    show statistically significant differences using a t-test, followed by Benjamini-Hochberg (BH) adjustment. Effect size (Cohen's distance) was used to 
     measure the  difference between the two groups. For each measurement, only the sample size for each group larger than five was considered. 
 
     For the shRNA data-based pipeline, cancer cell line gene dependency scores derived from DEMETER2 (version 6) from a combined dataset of 
     Achilles, DRIVE [45], and shRNA screen in breast cancer cell lines were used. The mutation data and sample annotation were for the DepMap 
     20Q3 dataset. Significant differences are defined for gene pairs with BH-adjusted P value smaller than 0.05. 
-    Significant gene pairs with effect size (Cohen_dist function) smaller than 0 are predicted to be SLIs.
+    Significant gene pairs with effect size (Cohen's distance) smaller than 0 are predicted to be SLIs.
 
     Input:  
     tumor_type: A list of tumor types 
@@ -222,20 +477,13 @@ def Mutational_based_SL_pipeline(tumor_type, mut_gene, Mut_mat, Depmap_matrix, d
     Mut_mat: The mutation matrix from CCLE data set
     Depmap_matrix: The shRNA or CRISPR dataset 
     datatype: "shRNA" or "Crispr"
+    processes: optional, the number of processes the mutated genes are tested on, the effect matrix is shared between them.
+        Serial by default. Setting OMP_NUM_THREADS=1 (or the thread count of the BLAS library) avoids oversubscribing the cores.
 
     Output: 
     A dataframe that describe the potential synthetic lethality interactions.
 
     """    
-    def Cohen_dist(x,y):
-
-        n1 = len(x)
-        n2 = len(y)
-        s = np.sqrt(((n1 - 1)*(np.std(x))*(np.std(x)) + (n2 - 1) * (np.std(y)) * (np.std(y))) / (n1 + n2 -2))
-        d = (np.mean(x) - np.mean(y)) / s
-        return(d)
-    
-    
     #selection of cancer cell lines in certain tumor types  
     client = bigquery.Client(project_id)
     #query = ''' 
@@ -342,7 +590,7 @@ def Mutational_based_SL_pipeline(tumor_type, mut_gene, Mut_mat, Depmap_matrix, d
     Mut_mat_sele2 = Mut_mat_sele1.loc[Mut_mat_sele1['Variant_Classification'].isin(selected_variants)]
     
     Mut_mat_sele3 = Mut_mat_sele2.loc[Mut_mat_sele2['Hugo_Symbol'].isin(mut_gene),['Hugo_Symbol','DepMap_ID']]
-    Depmap_matrix_sele = Depmap_matrix.loc[Samples_with_mut_kd,:].transpose()
+    Depmap_matrix_sele = Depmap_matrix.loc[sorted(Samples_with_mut_kd),:]
 
     Gene_mut_list = []
     Gene_kd_list = []
@@ -352,40 +600,34 @@ def Mutational_based_SL_pipeline(tumor_type, mut_gene, Mut_mat, Depmap_matrix, d
     FDR_List = []
     result = pd.DataFrame()
 
+    # the effects of all knockdown genes (columns) in all cell lines (rows), tested at once for every mutated gene
+    Gene_kd_all = list(Depmap_matrix_sele.columns.values)
+    effects = Depmap_matrix_sele.values.astype(np.float64)
+    not_nan = ~np.isnan(effects)
+    effects[~not_nan] = 0
+    cell_lines = pd.Index(Depmap_matrix_sele.index)
+
+    mut_counts_list = []
     for Gene in mut_gene:
         print("Gene mutated: " + Gene)
-        p_list_curr = []
         Mut_group = list(Mut_mat_sele3.loc[Mut_mat_sele3['Hugo_Symbol'] == Gene]['DepMap_ID'].values)
-        WT_group = list(set(Samples_with_mut_kd) - set(Mut_group))
+        mut_counts_list.append(np.bincount(cell_lines.get_indexer(Mut_group), minlength=len(cell_lines)))
         print("Number of samples with mutation: " + str(len(Mut_group)))
-        
-        for Gene_kd in list(Depmap_matrix_sele.index.values):
-            D_mut_new = Depmap_matrix_sele.loc[Gene_kd,Mut_group].values
-            D_wt_new = Depmap_matrix_sele.loc[Gene_kd,WT_group].values
-
-            nan_array = np.isnan(D_mut_new)
-            not_nan_array = ~ nan_array
-            D_mut_new = D_mut_new[not_nan_array]
 
-            nan_array = np.isnan(D_wt_new)
-            not_nan_array = ~ nan_array
-            D_wt_new = D_wt_new[not_nan_array]
-            
-
-            # T-test is used to test the significance of difference of the gene knockout/knockdown effects between the mutated group and wt-group.
-            # Cohen's distance was used to measure the different between the two groups. 
-            # genes that with mutation in more than 5 cell lines are taken into consideration. 
-        
-            if len(D_mut_new) > 5:
-                Sci_test = stats.ttest_ind(D_mut_new, D_wt_new, nan_policy = 'omit')
-                pvalue = Sci_test[1]
-                if np.isnan(pvalue) == False:
-                    size_mut.append(len(D_mut_new))              #Number of cell lines with mutation of the gene being tested. 
-                    p_list_curr.append(pvalue)                   # p_value from the t-test
-                    Size_effect =Cohen_dist(D_mut_new, D_wt_new) # The difference of gene knockout/knockdown effects between the mutated group and the wild type group
-                    es_list.append(Size_effect)
-                    Gene_mut_list.append(Gene)                   # The gene being mutated
-                    Gene_kd_list.append(Gene_kd)                 # The gene being knockout/knockdown
+    # T-test is used to test the significance of difference of the gene knockout/knockdown effects between the mutated group and wt-group.
+    # Cohen's distance was used to measure the different between the two groups. 
+    # genes that with mutation in more than 5 cell lines are taken into consideration. 
+    if processes is not None and processes > 1 and len(mut_gene) > 1:
+        gene_tests = Parallel_gene_ttests(effects, not_nan, mut_counts_list, processes)
+    else:
+        gene_tests = (_Gene_ttests(effects, not_nan, mut_counts) for mut_counts in mut_counts_list)
+
+    for Gene, (tested, n_mut, pvalues, es) in zip(mut_gene, gene_tests):
+        size_mut.extend(n_mut.tolist())                        #Number of cell lines with mutation of the gene being tested. 
+        p_list_curr = list(pvalues)                            # p_value from the t-test
+        es_list.extend(es)                                     # The difference of gene knockout/knockdown effects between the mutated group and the wild type group
+        Gene_mut_list.extend([Gene]*len(tested))               # The gene being mutated
+        Gene_kd_list.extend([Gene_kd_all[i] for i in tested])  # The gene being knockout/knockdown
 
         if len(p_list_curr) > 0:
 
@@ -0,0 +1,826 @@
+import os
+import re
+import json
+import hashlib
+import shutil
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from google.cloud import bigquery
+from google.api_core.exceptions import NotFound
+import DAISY_local
+
+# The columns DAISY reads from every source table and the gene symbol column the snapshot is partitioned by.
+DAISY_TABLES={
+    'isb-cgc-bq.pancancer_atlas.Filtered_EBpp_AdjustPANCAN_IlluminaHiSeq_RNASeqV2_genExp':
+        {'gene_col':'Symbol', 'columns':['Symbol', 'Entrez', 'SampleBarcode', 'SampleType', 'Study', 'normalized_count']},
+    'isb-cgc-bq.pancancer_atlas.Filtered_all_CNVR_data_by_gene':
+        {'gene_col':'Gene_Symbol', 'columns':['Gene_Symbol', 'SampleBarcode', 'SampleType', 'Study', 'GISTIC_Calls']},
+    'isb-cgc-bq.pancancer_atlas.Filtered_MC3_MAF_V5_one_per_tumor_sample':
+        {'gene_col':'Hugo_Symbol', 'columns':['Hugo_Symbol', 'Tumor_SampleBarcode', 'Study', 'Variant_Classification', 'FILTER']},
+    'isb-cgc-bq.DEPMAP.CCLE_gene_expression_DepMapPublic_current':
+        {'gene_col':'Hugo_Symbol', 'columns':['Hugo_Symbol', 'Entrez_ID', 'DepMap_ID', 'TPM']},
+    'isb-cgc-bq.DEPMAP.CCLE_gene_cn_DepMapPublic_current':
+        {'gene_col':'Hugo_Symbol', 'columns':['Hugo_Symbol', 'DepMap_ID', 'CNA']},
+    'isb-cgc-bq.DEPMAP.CCLE_mutation_DepMapPublic_current':
+        {'gene_col':'Hugo_Symbol', 'columns':['Hugo_Symbol', 'DepMap_ID', 'Tumor_Sample_Barcode', 'Variant_Classification']},
+    'isb-cgc-bq.DEPMAP.Achilles_gene_effect_DepMapPublic_current':
+        {'gene_col':'Hugo_Symbol', 'columns':['Hugo_Symbol', 'DepMap_ID', 'Gene_Effect']},
+    'isb-cgc-bq.DEPMAP.Combined_gene_dep_score_DEMETER2_current':
+        {'gene_col':'Hugo_Symbol', 'columns':['Hugo_Symbol', 'CCLE_ID', 'Combined_Gene_Dep_Score']},
+    'isb-cgc-bq.synthetic_lethality.sample_info_TCGAlabels_DepMapPublic_20Q3':
+        {'gene_col':None, 'columns':['DepMap_ID', 'CCLE_Name', 'primary_disease', 'TCGA_subtype']},
+}
+
+PARTITION_COL='symbol_prefix'
+
+# The tables whose gene symbols make up the gene universe of each database, as in ProcessGeneAlias.
+GENE_UNIVERSE_TABLES={
+    'PanCancerAtlas':[('isb-cgc-bq.pancancer_atlas.Filtered_all_CNVR_data_by_gene', 'Gene_Symbol'),
+                      ('isb-cgc-bq.pancancer_atlas.Filtered_EBpp_AdjustPANCAN_IlluminaHiSeq_RNASeqV2_genExp', 'Symbol'),
+                      ('isb-cgc-bq.pancancer_atlas.Filtered_MC3_MAF_V5_one_per_tumor_sample', 'Hugo_Symbol')],
+    'DepMap':[('isb-cgc-bq.DEPMAP.CCLE_gene_cn_DepMapPublic_current', 'Hugo_Symbol'),
+              ('isb-cgc-bq.DEPMAP.CCLE_gene_expression_DepMapPublic_current', 'Hugo_Symbol'),
+              ('isb-cgc-bq.DEPMAP.CCLE_mutation_DepMapPublic_current', 'Hugo_Symbol')],
+}
+
+GENE_INFO_TABLE='isb-cgc-bq.annotations.gene_info_human_NCBI_current'
+
+SAMPLE_INFO_TABLE='isb-cgc-bq.synthetic_lethality.sample_info_TCGAlabels_DepMapPublic_20Q3'
+EXCLUDED_DISEASES="('Non-Cancerous','Unknown','Engineered','Immortalized')"
+
+# Bit flags of the sample availability matrix, one per data modality
+EXPRESSION=1
+COPY_NUMBER=2
+MUTATION=4
+ACHILLES=8
+DEMETER2=16
+
+# For each data resource: the sample id column, the label column, and per modality the query returning the samples that have it
+SAMPLE_MODALITY_QUERIES={
+    'PanCancerAtlas':{'sample_col':'SampleBarcode', 'label_col':'Study', 'modalities':{
+        EXPRESSION:('isb-cgc-bq.pancancer_atlas.Filtered_EBpp_AdjustPANCAN_IlluminaHiSeq_RNASeqV2_genExp',
+                    "SELECT DISTINCT SampleBarcode, Study FROM `__TABLE__` WHERE SampleType not like '%Normal%' and Study is not null"),
+        COPY_NUMBER:('isb-cgc-bq.pancancer_atlas.Filtered_all_CNVR_data_by_gene',
+                     "SELECT DISTINCT SampleBarcode, Study FROM `__TABLE__` WHERE SampleType not like '%Normal%' and Study is not null"),
+        MUTATION:('isb-cgc-bq.pancancer_atlas.Filtered_MC3_MAF_V5_one_per_tumor_sample',
+                  "SELECT DISTINCT Tumor_SampleBarcode AS SampleBarcode, Study FROM `__TABLE__` WHERE Study is not null")}},
+    'CCLE':{'sample_col':'DepMap_ID', 'label_col':'TCGA_subtype', 'modalities':{
+        EXPRESSION:('isb-cgc-bq.DEPMAP.CCLE_gene_expression_DepMapPublic_current', "SELECT DISTINCT DepMap_ID FROM `__TABLE__`"),
+        COPY_NUMBER:('isb-cgc-bq.DEPMAP.CCLE_gene_cn_DepMapPublic_current', "SELECT DISTINCT DepMap_ID FROM `__TABLE__`"),
+        MUTATION:('isb-cgc-bq.DEPMAP.CCLE_mutation_DepMapPublic_current', "SELECT DISTINCT DepMap_ID FROM `__TABLE__`"),
+        ACHILLES:('isb-cgc-bq.DEPMAP.Achilles_gene_effect_DepMapPublic_current', "SELECT DISTINCT DepMap_ID FROM `__TABLE__`"),
+        DEMETER2:('isb-cgc-bq.DEPMAP.Combined_gene_dep_score_DEMETER2_current', "SELECT DISTINCT CCLE_ID AS CCLE_Name FROM `__TABLE__`")}},
+}
+
+# The modalities every (data_resource, method) combination of RetrieveSamples requires, and the resource of its samples
+SAMPLE_SELECTIONS={
+    ('PanCancerAtlas', 'correlation'):('PanCancerAtlas', EXPRESSION),
+    ('PanCancerAtlas', 'sof'):('PanCancerAtlas', EXPRESSION | COPY_NUMBER | MUTATION),
+    ('CCLE', 'correlation'):('CCLE', EXPRESSION),
+    ('CCLE', 'sof'):('CCLE', EXPRESSION | COPY_NUMBER | MUTATION),
+    ('CRISPR', 'func_ex'):('CCLE', EXPRESSION | COPY_NUMBER | MUTATION | ACHILLES),
+    ('shRNA', 'func_ex'):('CCLE', EXPRESSION | COPY_NUMBER | MUTATION | DEMETER2),
+}
+
+# The dependency score tables of FunctionalExamination: the sample column, the sample_info column it joins on and the score column
+DEPENDENCY_TABLES={
+    'CRISPR':{'table':'isb-cgc-bq.DEPMAP.Achilles_gene_effect_DepMapPublic_current',
+              'sample_col':'DepMap_ID', 'info_col':'DepMap_ID', 'value_col':'Gene_Effect'},
+    'shRNA':{'table':'isb-cgc-bq.DEPMAP.Combined_gene_dep_score_DEMETER2_current',
+             'sample_col':'CCLE_ID', 'info_col':'CCLE_Name', 'value_col':'Combined_Gene_Dep_Score'},
+}
+
+# The tables whose per gene ranks DAISY reads and the rows each is ranked on, the same as in the DAISY query the rank table replaces:
+# the expression replicates of a (gene, sample) are averaged, the copy number and dependency rows are ranked as they are.
+# The dependency scores are joined to sample_info so that their samples are DepMap_IDs, @samples restricts the rows to the selection.
+RANK_SOURCES={
+    'isb-cgc-bq.pancancer_atlas.Filtered_EBpp_AdjustPANCAN_IlluminaHiSeq_RNASeqV2_genExp':
+        """SELECT Symbol AS symbol, SampleBarcode AS sample, AVG(normalized_count) AS data FROM `__TABLE__`
+        WHERE Symbol IS NOT NULL AND normalized_count IS NOT NULL AND SampleBarcode IN UNNEST(@samples)
+        GROUP BY symbol, sample""",
+    'isb-cgc-bq.pancancer_atlas.Filtered_all_CNVR_data_by_gene':
+        """SELECT Gene_Symbol AS symbol, SampleBarcode AS sample, GISTIC_Calls AS data FROM `__TABLE__`
+        WHERE Gene_Symbol IS NOT NULL AND GISTIC_Calls IS NOT NULL AND SampleBarcode IN UNNEST(@samples)""",
+    'isb-cgc-bq.DEPMAP.CCLE_gene_expression_DepMapPublic_current':
+        """SELECT Hugo_Symbol AS symbol, DepMap_ID AS sample, AVG(TPM) AS data FROM `__TABLE__`
+        WHERE Hugo_Symbol IS NOT NULL AND TPM IS NOT NULL AND DepMap_ID IN UNNEST(@samples)
+        GROUP BY symbol, sample""",
+    'isb-cgc-bq.DEPMAP.CCLE_gene_cn_DepMapPublic_current':
+        """SELECT Hugo_Symbol AS symbol, DepMap_ID AS sample, CNA AS data FROM `__TABLE__`
+        WHERE Hugo_Symbol IS NOT NULL AND CNA IS NOT NULL AND DepMap_ID IN UNNEST(@samples)""",
+    'isb-cgc-bq.DEPMAP.Achilles_gene_effect_DepMapPublic_current':
+        """SELECT A.Hugo_Symbol AS symbol, S.DepMap_ID AS sample, A.Gene_Effect AS data FROM `__TABLE__` A, `__SAMPLE_INFO_TABLE__` S
+        WHERE A.Hugo_Symbol IS NOT NULL AND A.Gene_Effect IS NOT NULL AND S.DepMap_ID=A.DepMap_ID AND S.DepMap_ID IN UNNEST(@samples)""",
+    'isb-cgc-bq.DEPMAP.Combined_gene_dep_score_DEMETER2_current':
+        """SELECT A.Hugo_Symbol AS symbol, S.DepMap_ID AS sample, A.Combined_Gene_Dep_Score AS data FROM `__TABLE__` A, `__SAMPLE_INFO_TABLE__` S
+        WHERE A.Hugo_Symbol IS NOT NULL AND A.Combined_Gene_Dep_Score IS NOT NULL AND S.CCLE_Name=A.CCLE_ID AND S.DepMap_ID IN UNNEST(@samples)""",
+}
+
+
+def SymbolPrefix(symbol):
+    '''
+    Description: The partition key of a gene symbol, its first character in upper case, "_" if it is not alphanumeric.
+    '''
+    if symbol is None or len(str(symbol))==0:
+        return '_'
+    first=str(symbol)[0].upper()
+    return first if first.isalnum() else '_'
+
+
+def ResolveRelease(client, table_name):
+    '''
+    Description: Resolves a table name to a release tag. For views (e.g. the *_current tables) the tag is
+    the name of the table the view reads from, for tables it is the table name, both followed by the last modification time.
+    Inputs:
+        client:BigQueryClient, the BigQuery client that will run the function.
+        table_name:string, the full table name, e.g. isb-cgc-bq.DEPMAP.CCLE_gene_cn_DepMapPublic_current
+    Output:
+        The release tag as a string
+    '''
+    table=client.get_table(table_name)
+    if table.table_type=='VIEW' and table.view_query:
+        sources=re.findall(r'`([\w\-]+\.[\w\-]+\.[\w\-]+)`', table.view_query)
+        if len(sources)>0:
+            table=client.get_table(sources[0])
+    return '{}_{}'.format(table.table_id, table.modified.strftime('%Y%m%dT%H%M%S'))
+
+
+class SnapshotStore:
+    '''
+    Description: Local Parquet copies of the BigQuery tables DAISY reads. Every table is kept per release tag under
+       root/<table name>/<release>/symbol_prefix=<first letter>/part-0.parquet
+    sorted by gene symbol, so reads only open the partitions and row groups of the requested genes.
+    Inputs:
+        root:string, the directory of the store
+        client:BigQueryClient, optional, used to resolve releases and to materialize missing snapshots.
+            Without a client the store works offline on the latest local release of each table.
+        row_group_size:integer, the number of rows per Parquet row group
+    '''
+
+    def __init__(self, root, client=None, row_group_size=131072):
+        self.root=root
+        self.client=client
+        self.row_group_size=row_group_size
+        self._releases={}
+        os.makedirs(root, exist_ok=True)
+
+    def _ManifestPath(self):
+        return os.path.join(self.root, 'manifest.json')
+
+    def Manifest(self):
+        '''
+        Description: Returns the manifest of the store, a dictionary of table name -> {'current': release, 'releases': {release: info}}
+        '''
+        if not os.path.exists(self._ManifestPath()):
+            return {}
+        with open(self._ManifestPath()) as f:
+            return json.load(f)
+
+    def _WriteManifest(self, manifest):
+        tmp_path=self._ManifestPath()+'.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self._ManifestPath())
+
+    def Release(self, table_name):
+        '''
+        Description: The release of table_name that the store uses, resolved once per store with the client,
+        or the latest local release when the store has no client.
+        '''
+        if table_name not in self._releases:
+            if self.client is not None:
+                self._releases[table_name]=ResolveRelease(self.client, table_name)
+            else:
+                entry=self.Manifest().get(table_name)
+                if entry is None:
+                    raise KeyError('No local snapshot of ' + table_name + ' and no client to create it')
+                self._releases[table_name]=entry['current']
+        return self._releases[table_name]
+
+    def TablePath(self, table_name, release=None):
+        if release is None:
+            release=self.Release(table_name)
+        return os.path.join(self.root, table_name, release)
+
+    def HasSnapshot(self, table_name, release=None):
+        if release is None:
+            release=self.Release(table_name)
+        entry=self.Manifest().get(table_name, {})
+        return release in entry.get('releases', {})
+
+    def Materialize(self, table_name, release=None, columns=None):
+        '''
+        Description: Downloads the DAISY columns of table_name into the store, unless the release is already there.
+        Inputs:
+            table_name:string, the full table name
+            release:string, optional, the release tag, resolved with the client if not given
+            columns:list of strings, optional, the columns to keep, defaults to the columns in DAISY_TABLES
+        Output:
+            The path of the snapshot
+        '''
+        if release is None:
+            release=self.Release(table_name)
+        if self.HasSnapshot(table_name, release):
+            return self.TablePath(table_name, release)
+        if self.client is None:
+            raise KeyError('A client is needed to materialize ' + table_name)
+
+        spec=DAISY_TABLES.get(table_name, {'gene_col':None, 'columns':None})
+        if columns is None:
+            columns=spec['columns']
+        gene_col=spec['gene_col']
+        select_cols='*' if columns is None else ', '.join(columns)
+        sql='SELECT ' + select_cols + ' FROM `' + table_name + '`'
+
+        final_path=self.TablePath(table_name, release)
+        staging_path=final_path+'.staging'
+        shutil.rmtree(staging_path, ignore_errors=True)
+
+        rows=0
+        result=self.client.query(sql).result()
+        for chunk_id, chunk in enumerate(_IterateChunks(result)):
+            if gene_col is not None:
+                chunk[PARTITION_COL]=[SymbolPrefix(x) for x in chunk[gene_col]]
+            rows+=chunk.shape[0]
+            _WriteChunk(chunk, staging_path, chunk_id, gene_col is not None)
+
+        # one file per partition, sorted by gene symbol so that row group statistics prune reads
+        shutil.rmtree(final_path, ignore_errors=True)
+        os.makedirs(final_path)
+        if os.path.isdir(staging_path):
+            for partition in sorted(os.listdir(staging_path)):
+                source=os.path.join(staging_path, partition)
+                if not os.path.isdir(source):
+                    continue
+                table=ds.dataset(source, format='parquet').to_table()
+                if gene_col is not None:
+                    table=table.take(pc.sort_indices(table, sort_keys=[(gene_col, 'ascending')]))
+                os.makedirs(os.path.join(final_path, partition))
+                pq.write_table(table, os.path.join(final_path, partition, 'part-0.parquet'), row_group_size=self.row_group_size)
+            shutil.rmtree(staging_path)
+
+        manifest=self.Manifest()
+        entry=manifest.setdefault(table_name, {'releases':{}})
+        entry['releases'][release]={'columns':columns, 'gene_col':gene_col, 'rows':rows,
+                                    'created':pd.Timestamp.now(tz='UTC').isoformat()}
+        entry['current']=release
+        self._WriteManifest(manifest)
+        return final_path
+
+    def Read(self, table_name, columns=None, genes=None, filters=None, release=None):
+        '''
+        Description: Reads a snapshot with column and predicate pushdown, materializing it first if needed.
+        Inputs:
+            table_name:string, the full table name
+            columns:list of strings, optional, the columns to read, all columns if not given
+            genes:list of strings, optional, only the rows of these gene symbols are read
+            filters:dictionary, optional, column name -> list of accepted values
+            release:string, optional, the release tag, defaults to the release used by the store
+        Output:
+            A dataframe
+        '''
+        path=self.Materialize(table_name, release)
+        if release is None:
+            release=self.Release(table_name)
+        gene_col=self.Manifest()[table_name]['releases'][release]['gene_col']
+        partitioning=_Partitioning() if gene_col is not None else None
+        dataset=ds.dataset(path, format='parquet', partitioning=partitioning)
+
+        expression=None
+        if genes is not None and gene_col is not None:
+            genes=[str(x) for x in genes]
+            prefixes=sorted(set(SymbolPrefix(x) for x in genes))
+            expression=ds.field(PARTITION_COL).isin(prefixes) & ds.field(gene_col).isin(genes)
+        if filters is not None:
+            for col, values in filters.items():
+                condition=ds.field(col).isin(list(values))
+                expression=condition if expression is None else expression & condition
+
+        if columns is None:
+            columns=[x for x in dataset.schema.names if x!=PARTITION_COL]
+        return dataset.to_table(columns=list(columns), filter=expression).to_pandas()
+
+    def Drop(self, table_name, release):
+        '''
+        Description: Removes a release of a table from the store.
+        '''
+        shutil.rmtree(self.TablePath(table_name, release), ignore_errors=True)
+        manifest=self.Manifest()
+        entry=manifest.get(table_name)
+        if entry is not None and release in entry['releases']:
+            del entry['releases'][release]
+            if entry.get('current')==release:
+                entry['current']=sorted(entry['releases'])[-1] if len(entry['releases'])>0 else None
+            self._WriteManifest(manifest)
+        self._releases.pop(table_name, None)
+
+
+class _VersionedIndex:
+    # Local files derived from BigQuery tables, rebuilt when the release of one of the tables changes.
+
+    def __init__(self, root, client=None, check_updates=True):
+        self.root=root
+        self.client=client
+        self.check_updates=check_updates and client is not None
+        os.makedirs(root, exist_ok=True)
+
+    def _VersionsPath(self):
+        return os.path.join(self.root, 'versions.json')
+
+    def _Versions(self):
+        if not os.path.exists(self._VersionsPath()):
+            return {}
+        with open(self._VersionsPath()) as f:
+            return json.load(f)
+
+    def _SaveVersion(self, key, versions):
+        all_versions=self._Versions()
+        all_versions[key]=versions
+        tmp_path=self._VersionsPath()+'.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(all_versions, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self._VersionsPath())
+
+    def _IsStale(self, key, path, tables):
+        # returns whether path needs to be (re)built, and the current releases of tables if they were resolved
+        if not os.path.exists(path):
+            if self.client is None:
+                raise KeyError('No local index at ' + path + ' and no client to build it')
+            return True, {table:ResolveRelease(self.client, table) for table in tables}
+        if not self.check_updates:
+            return False, None
+        versions={table:ResolveRelease(self.client, table) for table in tables}
+        return versions!=self._Versions().get(key), versions
+
+
+class GeneIndex(_VersionedIndex):
+    '''
+    Description: On-disk index of the gene symbols of each DAISY database and of the NCBI gene -> alias pairs,
+    used by ProcessGeneAlias instead of scanning the source tables on every call.
+       root/<database>_universe.npy: the sorted gene symbols of the database
+       root/aliases.npz: the (Gene, Alias) pairs of gene_info_human_NCBI_current sorted by Gene
+       root/versions.json: the releases (see ResolveRelease) of the source tables the files were built from
+    A part of the index is rebuilt when one of its source tables is modified.
+    Inputs:
+        root:string, the directory of the index
+        client:BigQueryClient, optional, used to build the index and to check the source tables for modifications.
+            Without a client the index works offline on the files in root.
+        check_updates:boolean, whether the source tables are checked for modifications, once per GeneIndex object
+    '''
+
+    def __init__(self, root, client=None, check_updates=True):
+        _VersionedIndex.__init__(self, root, client, check_updates)
+        self._universe={}
+        self._universe_set={}
+        self._aliases=None
+
+    def Universe(self, database):
+        '''
+        Description: The sorted array of gene symbols in database, valid values: "PanCancerAtlas", "DepMap"
+        '''
+        if database not in self._universe:
+            tables=[table for table, col in GENE_UNIVERSE_TABLES[database]]
+            path=os.path.join(self.root, database + '_universe.npy')
+            stale, versions=self._IsStale(database, path, tables)
+            if stale:
+                sql='\nUNION DISTINCT\n'.join(['SELECT DISTINCT ' + col + ' AS symbol FROM `' + table + '`'
+                                               for table, col in GENE_UNIVERSE_TABLES[database]])
+                symbols=self.client.query(sql).result().to_dataframe()['symbol'].dropna()
+                universe=np.unique(symbols.to_numpy(dtype=str))
+                np.save(path, universe)
+                self._SaveVersion(database, versions)
+            else:
+                universe=np.load(path)
+            self._universe[database]=universe
+            self._universe_set[database]=set(universe.tolist())
+        return self._universe[database]
+
+    def Contains(self, database, genes):
+        '''
+        Description: A boolean array telling which of the genes are in database
+        '''
+        universe_set=self._universe_set.get(database)
+        if universe_set is None:
+            self.Universe(database)
+            universe_set=self._universe_set[database]
+        return np.array([str(x) in universe_set for x in genes], dtype=bool)
+
+    def Aliases(self):
+        '''
+        Description: The gene -> aliases multimap as a dictionary of gene symbol -> list of aliases
+        '''
+        if self._aliases is None:
+            path=os.path.join(self.root, 'aliases.npz')
+            stale, versions=self._IsStale('aliases', path, [GENE_INFO_TABLE])
+            if stale:
+                sql='SELECT DISTINCT Gene, Alias FROM `' + GENE_INFO_TABLE + '` WHERE Gene IS NOT NULL AND Alias IS NOT NULL'
+                pairs=self.client.query(sql).result().to_dataframe()
+                genes=pairs['Gene'].to_numpy(dtype=str)
+                aliases=pairs['Alias'].to_numpy(dtype=str)
+                order=np.lexsort((aliases, genes))
+                genes, aliases=genes[order], aliases[order]
+                np.savez(path, genes=genes, aliases=aliases)
+                self._SaveVersion('aliases', versions)
+            else:
+                stored=np.load(path)
+                genes, aliases=stored['genes'], stored['aliases']
+            keys, starts=np.unique(genes, return_index=True)
+            ends=np.append(starts[1:], len(genes))
+            alias_list=aliases.tolist()
+            self._aliases={key:alias_list[start:end] for key, start, end in zip(keys.tolist(), starts, ends)}
+        return self._aliases
+
+    def MapGenes(self, database, input_gene_list):
+        '''
+        Description: Local equivalent of ProcessGeneAlias, maps the gene symbols of database to the input genes.
+        Input genes found in the database map to themselves, the others through their aliases that are in the database.
+        Output:
+            A dictionary that maps gene symbols in the given database to the input gene list
+        '''
+        found=self.Contains(database, input_gene_list)
+        mapping={}
+        for gene, in_database in zip(input_gene_list, found):
+            if in_database:
+                mapping[gene]=gene
+        missing=[gene for gene, in_database in zip(input_gene_list, found) if not in_database]
+        if len(missing)>0:
+            aliases=self.Aliases()
+            universe_set=self._universe_set[database]
+            for gene in missing:
+                for alias in aliases.get(str(gene), []):
+                    if alias in universe_set:
+                        mapping[alias]=gene
+        return mapping
+
+
+class SampleAvailability(_VersionedIndex):
+    '''
+    Description: Precomputed sample x modality availability bitmap with the tissue labels (Study for PanCancerAtlas,
+    TCGA_subtype for CCLE), used by RetrieveSamples instead of intersecting the source tables on every call.
+       root/sample_availability_<resource>.parquet: one row per (sample, label) with the bit flags of its modalities
+    The bitmap of a resource is rebuilt when one of its source tables is modified.
+    Inputs:
+        root:string, the directory of the bitmaps
+        client:BigQueryClient, optional, used to build the bitmaps and to check the source tables for modifications.
+            Without a client the bitmaps in root are used offline.
+        check_updates:boolean, whether the source tables are checked for modifications, once per resource and object
+    '''
+
+    def __init__(self, root, client=None, check_updates=True):
+        _VersionedIndex.__init__(self, root, client, check_updates)
+        self._matrices={}
+        self._selections={}
+
+    def Matrix(self, resource):
+        '''
+        Description: The availability matrix of resource ("PanCancerAtlas" or "CCLE") as a dataframe with
+        the sample id, label and 'modalities' bit flag columns (and CCLE_Name for CCLE)
+        '''
+        if resource not in self._matrices:
+            spec=SAMPLE_MODALITY_QUERIES[resource]
+            tables=[table for table, sql in spec['modalities'].values()]
+            if resource=='CCLE':
+                tables=[SAMPLE_INFO_TABLE]+tables
+            path=os.path.join(self.root, 'sample_availability_' + resource + '.parquet')
+            stale, versions=self._IsStale('samples_' + resource, path, tables)
+            if stale:
+                matrix=self._Build(resource)
+                matrix.to_parquet(path, index=False)
+                self._SaveVersion('samples_' + resource, versions)
+            else:
+                matrix=pd.read_parquet(path)
+            self._matrices[resource]=matrix
+        return self._matrices[resource]
+
+    def _Build(self, resource):
+        spec=SAMPLE_MODALITY_QUERIES[resource]
+        sample_col, label_col=spec['sample_col'], spec['label_col']
+
+        if resource=='PanCancerAtlas':
+            # samples are (SampleBarcode, Study) pairs, as in the INTERSECT DISTINCT of RetrieveSamples
+            parts=[]
+            for flag, (table, sql) in spec['modalities'].items():
+                part=self.client.query(sql.replace('__TABLE__', table)).result().to_dataframe()
+                part['modalities']=flag
+                parts.append(part)
+            matrix=pd.concat(parts, ignore_index=True)
+            # every pair appears at most once per modality, so the sum of the flags is their bitwise or
+            matrix=matrix.groupby([sample_col, label_col], as_index=False)['modalities'].sum()
+        else:
+            sql='SELECT DISTINCT DepMap_ID, CCLE_Name, TCGA_subtype FROM `' + SAMPLE_INFO_TABLE + '` WHERE primary_disease not in ' + EXCLUDED_DISEASES
+            matrix=self.client.query(sql).result().to_dataframe()
+            matrix['modalities']=0
+            for flag, (table, sql) in spec['modalities'].items():
+                part=self.client.query(sql.replace('__TABLE__', table)).result().to_dataframe()
+                key=part.columns[0]
+                matrix.loc[matrix[key].isin(part[key]), 'modalities']|=flag
+        matrix['modalities']=matrix['modalities'].astype(np.uint8)
+        return matrix
+
+    def Select(self, data_resource, method, tissues):
+        '''
+        Description: Local equivalent of RetrieveSamples, the samples that have every modality needed by method,
+        restricted to the given tissues unless tissues contains 'pancancer'.
+        Output:
+            A list of sample ids, or a dataframe of CCLE_Name and DepMap_ID for shRNA
+        '''
+        key=(data_resource, method, tuple(tissues))
+        if key not in self._selections:
+            resource, required=SAMPLE_SELECTIONS[(data_resource, method)]
+            matrix=self.Matrix(resource)
+            spec=SAMPLE_MODALITY_QUERIES[resource]
+            keep=(matrix['modalities'].to_numpy() & required)==required
+            if tissues.count('pancancer')==0:
+                keep&=matrix[spec['label_col']].isin(tissues).to_numpy()
+            selected=matrix.loc[keep]
+
+            if data_resource=='shRNA':
+                self._selections[key]=selected[['CCLE_Name', 'DepMap_ID']].reset_index(drop=True)
+            elif method=='correlation':
+                self._selections[key]=list(pd.unique(selected[spec['sample_col']]))
+            else:
+                self._selections[key]=list(selected[spec['sample_col']])
+        selection=self._selections[key]
+        return selection.copy() if isinstance(selection, pd.DataFrame) else list(selection)
+
+
+class DependencyStore(_VersionedIndex):
+    '''
+    Description: Memory-mapped cell line x gene matrices of the CRISPR (Gene_Effect) and shRNA (Combined_Gene_Dep_Score) scores,
+    used by the local engine of FunctionalExamination instead of ranking the dependency tables in BigQuery on every call.
+       root/dependency_<database>/values.npy: float32 cell lines x genes scores, missing scores are nan
+       root/dependency_<database>/order.npy: int32 per gene sort order of the cell lines by score, missing scores last
+       root/dependency_<database>/samples.npy, ccle_names.npy, genes.npy: the DepMap_ID and CCLE_Name of the rows, the symbols of the columns
+    Rows are keyed by DepMap_ID for both databases, the shRNA CCLE_ID -> DepMap_ID mapping of the sample_info table is applied once at build time.
+    A matrix is rebuilt when its dependency table or the sample_info table is modified.
+    Inputs:
+        root:string, the directory of the matrices
+        client:BigQueryClient, optional, used to build the matrices and to check the source tables for modifications.
+            Without a client the matrices in root are used offline.
+        check_updates:boolean, whether the source tables are checked for modifications, once per database and object
+        snapshot:SnapshotStore, optional, if given the matrices are built from the local snapshots instead of BigQuery
+    '''
+
+    def __init__(self, root, client=None, check_updates=True, snapshot=None):
+        _VersionedIndex.__init__(self, root, client, check_updates)
+        self.snapshot=snapshot
+        self._stores={}
+
+    def _Load(self, database):
+        if database not in self._stores:
+            spec=DEPENDENCY_TABLES[database]
+            path=os.path.join(self.root, 'dependency_' + database)
+            stale, versions=self._IsStale('dependency_' + database, os.path.join(path, 'order.npy'), [spec['table'], SAMPLE_INFO_TABLE])
+            if stale:
+                self._Build(database, path)
+                self._SaveVersion('dependency_' + database, versions)
+            samples=np.load(os.path.join(path, 'samples.npy')).tolist()
+            self._stores[database]={'values':np.load(os.path.join(path, 'values.npy'), mmap_mode='r'),
+                                    'order':np.load(os.path.join(path, 'order.npy'), mmap_mode='r'),
+                                    'samples':samples,
+                                    'ccle_names':np.load(os.path.join(path, 'ccle_names.npy')).tolist(),
+                                    'genes':np.load(os.path.join(path, 'genes.npy')).tolist(),
+                                    'rows':{samples[i]:i for i in range(len(samples))}}
+        return self._stores[database]
+
+    def _Build(self, database, path):
+        spec=DEPENDENCY_TABLES[database]
+        if self.snapshot is not None:
+            scores=self.snapshot.Read(spec['table'], columns=['Hugo_Symbol', spec['sample_col'], spec['value_col']])
+            info=self.snapshot.Read(SAMPLE_INFO_TABLE, columns=['DepMap_ID', 'CCLE_Name']).drop_duplicates()
+            scores=scores.merge(info, left_on=spec['sample_col'], right_on=spec['info_col'])
+            scores=scores[['DepMap_ID', 'CCLE_Name', 'Hugo_Symbol', spec['value_col']]].dropna()
+            scores.columns=['DepMap_ID', 'CCLE_Name', 'symbol', 'data']
+            scores=scores.groupby(['DepMap_ID', 'CCLE_Name', 'symbol'], as_index=False, observed=True)['data'].mean()
+        else:
+            sql='''SELECT S.DepMap_ID, S.CCLE_Name, A.Hugo_Symbol AS symbol, AVG(A.__VALUE__) AS data
+            FROM `__TABLE__` A INNER JOIN (SELECT DISTINCT DepMap_ID, CCLE_Name FROM `__SAMPLE_INFO_TABLE__`) S
+            ON S.__INFO_COL__ = A.__SAMPLE_COL__
+            WHERE A.Hugo_Symbol IS NOT NULL AND A.__VALUE__ IS NOT NULL
+            GROUP BY S.DepMap_ID, S.CCLE_Name, symbol'''
+            sql=sql.replace('__VALUE__', spec['value_col']).replace('__TABLE__', spec['table'])
+            sql=sql.replace('__SAMPLE_INFO_TABLE__', SAMPLE_INFO_TABLE).replace('__INFO_COL__', spec['info_col'])
+            sql=sql.replace('__SAMPLE_COL__', spec['sample_col'])
+            scores=self.client.query(sql).result().to_dataframe()
+
+        samples=pd.Categorical(scores['DepMap_ID'])
+        genes=pd.Categorical(scores['symbol'])
+        names=scores.drop_duplicates('DepMap_ID').set_index('DepMap_ID')['CCLE_Name']
+
+        tmp_path=path + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        shape=(len(samples.categories), len(genes.categories))
+        values=np.lib.format.open_memmap(os.path.join(tmp_path, 'values.npy'), mode='w+', dtype=np.float32, shape=shape)
+        values[:]=np.nan
+        values[samples.codes, genes.codes]=scores['data'].to_numpy(dtype=np.float32)
+        order=np.lib.format.open_memmap(os.path.join(tmp_path, 'order.npy'), mode='w+', dtype=np.int32, shape=shape)
+        for start in range(0, shape[1], 2048):
+            order[:, start:start+2048]=np.argsort(values[:, start:start+2048], axis=0, kind='mergesort')
+        values.flush()
+        order.flush()
+        del values, order
+        np.save(os.path.join(tmp_path, 'samples.npy'), np.asarray(samples.categories, dtype=str))
+        np.save(os.path.join(tmp_path, 'ccle_names.npy'), names.loc[list(samples.categories)].to_numpy(dtype=str))
+        np.save(os.path.join(tmp_path, 'genes.npy'), np.asarray(genes.categories, dtype=str))
+
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+
+    def Samples(self, database):
+        '''
+        Description: The cell lines of the matrix of database ("CRISPR" or "shRNA") as a dataframe of DepMap_ID and CCLE_Name, in row order
+        '''
+        store=self._Load(database)
+        return pd.DataFrame({'DepMap_ID':store['samples'], 'CCLE_Name':store['ccle_names']})
+
+    def Genes(self, database):
+        '''
+        Description: The gene symbols of the columns of the matrix of database
+        '''
+        return list(self._Load(database)['genes'])
+
+    def Rows(self, database, samples):
+        '''
+        Description: The sorted row positions of the given DepMap_IDs, samples without scores are left out
+        '''
+        rows=self._Load(database)['rows']
+        return np.array(sorted(set(rows[str(x)] for x in samples if str(x) in rows)), dtype=np.int64)
+
+    def IterateRanks(self, database, rows, chunk_size=2048):
+        '''
+        Description: Yields the ranks of the given rows (output of Rows) column block by column block, so that only
+        one block of the matrix is in memory. The ranks within rows are read along the stored sort order of the genes,
+        so no cell line subset is sorted again.
+        Output:
+            Tuples of (list of gene symbols, float32 len(rows) x genes ranks)
+        '''
+        store=self._Load(database)
+        genes=store['genes']
+        for start in range(0, len(genes), chunk_size):
+            ranks=DAISY_local.SubsetRanks(store['values'][:, start:start+chunk_size], store['order'][:, start:start+chunk_size], rows)
+            yield genes[start:start+chunk_size], ranks
+
+
+class RankTables:
+    '''
+    Description: Per release rank tables (symbol, sample, data, rnk, n_ties) of the tables in RANK_SOURCES, rnk being the RANK() of the
+    value within its gene over the samples of the table and n_ties the number of its rows sharing the value.
+    A rank table is built over the samples of the pancancer selection of the procedure that reads it, so the ranks of that selection
+    are rnk + (n_ties - 1)/2 and need no window at all. Since rnk orders the rows of a gene like their values, the tie-averaged
+    rank within any other sample subset is
+       RANK() OVER (PARTITION BY symbol ORDER BY rnk) + (COUNT(*) OVER (PARTITION BY symbol, rnk) - 1)/2
+    which the DAISY queries compute on the small integer column instead of sorting and string casting the values.
+    The tables are <dataset>.<release>_<samples digest>_ranks, clustered by symbol and created on first use.
+    Inputs:
+        client:BigQueryClient, used to resolve releases and to check whether a rank table exists
+        dataset:string, the "project.dataset" the rank tables are written to
+    '''
+
+    def __init__(self, client, dataset):
+        if dataset is None:
+            raise ValueError('RankTables needs the "project.dataset" the rank tables are written to')
+        self.client=client
+        self.dataset=dataset
+        self._tables={}
+
+    def Table(self, table_name, samples, client=None):
+        '''
+        Description: The full name of the rank table of the current release of table_name over samples, created if it does not exist yet
+        Inputs:
+            table_name:string, the full table name, one of RANK_SOURCES
+            samples:list of strings, the samples of the rank table, the pancancer selection of the procedure (DepMap_IDs for CCLE)
+            client:optional, the client the CREATE TABLE job runs on, e.g. the metered client of the procedure, the client of the
+                RankTables by default. When the client only plans (dry runs) its queries, the CREATE TABLE of a missing table is planned
+                and the table is not created.
+        Output:
+            The full name of the rank table, None when the table does not exist and the client only plans, the queries reading it
+            are then planned on the source table
+        '''
+        samples=sorted(set(str(x) for x in samples))
+        digest=hashlib.sha256('\n'.join(samples).encode('utf-8')).hexdigest()[:12]
+        key=(table_name, digest)
+        if key not in self._tables:
+            rank_table=self.dataset + '.' + re.sub(r'[^\w]', '_', ResolveRelease(self.client, table_name)) + '_' + digest + '_ranks'
+            try:
+                self.client.get_table(rank_table)
+                self._tables[key]=rank_table
+                return rank_table
+            except NotFound:
+                pass
+            sql='''CREATE TABLE IF NOT EXISTS `__RANK_TABLE__`
+            CLUSTER BY symbol AS
+            SELECT symbol, sample, data,
+               RANK() OVER (PARTITION BY symbol ORDER BY data ASC) AS rnk,
+               COUNT(*) OVER (PARTITION BY symbol, CAST(data as STRING)) AS n_ties
+            FROM (
+            __ROWS__)'''
+            sql=sql.replace('__ROWS__', RANK_SOURCES[table_name]).replace('__RANK_TABLE__', rank_table)
+            sql=sql.replace('__TABLE__', table_name).replace('__SAMPLE_INFO_TABLE__', SAMPLE_INFO_TABLE)
+            job_config=bigquery.QueryJobConfig(query_parameters=[bigquery.ArrayQueryParameter("samples", "STRING", samples)])
+            client=self.client if client is None else client
+            client.query(sql, job_config=job_config).result()
+            if getattr(client, 'plan_only', False):
+                return None
+            self._tables[key]=rank_table
+        return self._tables[key]
+
+
+class ResultCache:
+    '''
+    Description: Content-addressed cache of the per-gene results of the DAISY procedures, before the p value adjustment.
+    An entry holds the partners of one gene and is keyed by the sha256 of (procedure, data resource, gene, tissue set,
+    thresholds and result sources (engine, rank tables, sample index), releases of the tables the procedure reads), so a new release,
+    threshold or engine never reuses old results.
+    The entries are kept as root/<procedure>/<first 2 hex digits of the key>/<key>.parquet.
+    Inputs:
+        root:string, the directory of the cache
+        client:BigQueryClient, optional, used to resolve the releases of the tables
+        snapshot:SnapshotStore, optional, if given the releases are the ones of the local snapshots (for the local engine)
+    '''
+
+    def __init__(self, root, client=None, snapshot=None):
+        self.root=root
+        self.client=client
+        self.snapshot=snapshot
+        self._releases={}
+        os.makedirs(root, exist_ok=True)
+
+    def _Release(self, table_name):
+        if table_name not in self._releases:
+            if self.snapshot is not None:
+                self._releases[table_name]=self.snapshot.Release(table_name)
+            else:
+                self._releases[table_name]=ResolveRelease(self.client, table_name)
+        return self._releases[table_name]
+
+    def Key(self, procedure, data_resource, gene, tissues, parameters, tables):
+        '''
+        Description: The key of the results of one gene
+        Inputs:
+            procedure:string, e.g. "coexpression", "sof", "func_ex"
+            data_resource:string, e.g. "PanCancerAtlas", "CCLE", "CRISPR", "shRNA"
+            gene:string, the input gene
+            tissues:list of strings, the tissue set, its order does not matter
+            parameters:dictionary, the thresholds and options the results depend on
+            tables:list of strings, the tables the procedure reads, their releases are part of the key
+        Output:
+            The key as a hexadecimal string
+        '''
+        content=json.dumps({'procedure':procedure, 'data_resource':data_resource, 'gene':str(gene),
+                            'tissues':sorted(set(str(x) for x in tissues)), 'parameters':parameters,
+                            'releases':{table:self._Release(table) for table in tables}}, sort_keys=True, default=str)
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def _Path(self, procedure, key):
+        return os.path.join(self.root, procedure, key[:2], key + '.parquet')
+
+    def Get(self, procedure, key):
+        '''
+        Description: The cached results of a key, None if they are not cached
+        '''
+        path=self._Path(procedure, key)
+        if not os.path.exists(path):
+            return None
+        return pd.read_parquet(path)
+
+    def Put(self, procedure, key, results):
+        '''
+        Description: Caches the results of a key, genes without partners are cached as empty tables
+        '''
+        path=self._Path(procedure, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path=path + '.tmp'
+        results=results.reset_index(drop=True)
+        for col in results.columns:
+            if isinstance(results[col].dtype, pd.CategoricalDtype):
+                results[col]=results[col].cat.remove_unused_categories()
+        results.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+
+
+def _IterateChunks(result):
+    if hasattr(result, 'to_dataframe_iterable'):
+        for chunk in result.to_dataframe_iterable():
+            yield chunk
+    else:
+        yield result.to_dataframe()
+
+
+def _Partitioning():
+    return ds.partitioning(pa.schema([(PARTITION_COL, pa.string())]), flavor='hive')
+
+
+def _WriteChunk(chunk, staging_path, chunk_id, partitioned):
+    table=pa.Table.from_pandas(chunk, preserve_index=False)
+    if partitioned:
+        ds.write_dataset(table, staging_path, format='parquet', partitioning=_Partitioning(),
+                         basename_template='chunk' + str(chunk_id) + '-{i}.parquet',
+                         existing_data_behavior='overwrite_or_ignore')
+    else:
+        os.makedirs(os.path.join(staging_path, 'all'), exist_ok=True)
+        pq.write_table(table, os.path.join(staging_path, 'all', 'chunk' + str(chunk_id) + '.parquet'))
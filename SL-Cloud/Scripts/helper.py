@@ -1,6 +1,10 @@
 
+import threading
 from google.cloud import bigquery
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+from pandas.api.types import union_categoricals
 
 def ConvertGene(client, input_vector, input_type, output_type):
     '''
@@ -15,24 +19,22 @@ def ConvertGene(client, input_vector, input_type, output_type):
     SELECT DISTINCT __IN_TYPE__,  __OUT_TYPE__
    
     FROM  `isb-cgc-bq.annotations.gene_info_human_NCBI_current`
-    where  __IN_TYPE__  in (__IN_VECTOR__)
+    where  __IN_TYPE__  in UNNEST(@input_vector)
     '''
 
     if input_type=='EntrezID':
-        intermediate_representation = [str(x) for x in input_vector]
+        input_vector_parameter = bigquery.ArrayQueryParameter("input_vector", "INT64", [int(x) for x in input_vector])
     else:
-        intermediate_representation = ["'"+str(x)+"'" for x in input_vector]
-
-    input_vector_query= ','.join(intermediate_representation)
+        input_vector_parameter = bigquery.ArrayQueryParameter("input_vector", "STRING", [str(x) for x in input_vector])
+    job_config = bigquery.QueryJobConfig(query_parameters=[input_vector_parameter])
 
     out_type_intermediate_representation = [str(x) for x in output_type]
     output_type_for_query= ','.join(out_type_intermediate_representation)
 
     sql=sql.replace('__OUT_TYPE__', output_type_for_query)
     sql=sql.replace('__IN_TYPE__', input_type)
-    sql=sql.replace('__IN_VECTOR__', input_vector_query)
 
-    result= client.query(sql).result().to_dataframe()
+    result= client.query(sql, job_config=job_config).result().to_dataframe()
     return(result)
 
 
@@ -49,5 +51,125 @@ def WriteToExcel(excel_file, data_to_write, excel_tab_names):
     '''
     with pd.ExcelWriter(excel_file) as writer:
         for i in range(len(excel_tab_names)):
-            data_to_write[i].to_excel(writer, sheet_name=excel_tab_names[i], index=False)
+            _ExcelFrame(data_to_write[i]).to_excel(writer, sheet_name=excel_tab_names[i], index=False)
+
+
+def _ExcelFrame(frame):
+    # categorical columns are written as their values, float32 columns as their shortest decimal form (0.1 instead of 0.10000000149)
+    columns={}
+    for col in frame.columns:
+        if isinstance(frame[col].dtype, pd.CategoricalDtype):
+            columns[col]=frame[col].astype(object)
+        elif frame[col].dtype==np.float32:
+            columns[col]=frame[col].astype(str).astype(np.float64)
+    if len(columns)==0:
+        return(frame)
+    frame=frame.copy()
+    for col, values in columns.items():
+        frame[col]=values
+    return(frame)
+
+
+# the client of the BigQuery Storage Read API, created on the first query and shared by all the queries and threads,
+# False until then and None when the API can not be used
+_bqstorage_client=False
+_bqstorage_lock=threading.Lock()
+
+
+def _BigQueryStorageClient():
+    # the BigQuery Storage Read API is optional, without it (or without application default credentials) the pages of the results
+    # are read through the REST API
+    global _bqstorage_client
+    with _bqstorage_lock:
+        if _bqstorage_client is False:
+            _bqstorage_client=None
+            try:
+                from google.cloud import bigquery_storage
+                import google.auth.exceptions
+            except ImportError:
+                return(None)
+            try:
+                _bqstorage_client=bigquery_storage.BigQueryReadClient()
+            except google.auth.exceptions.DefaultCredentialsError:
+                pass
+        return(_bqstorage_client)
+
+
+class LocalResults:
+    '''
+    Description: Local stand-in for the results of a BigQuery job, it serves a dataframe as Arrow record batches
+    the way RowIterator.to_arrow_iterable does. A test client can return it from query() to exercise ReadResults.
+    Inputs:
+        data:dataframe, the rows of the results
+        batch_size:integer, the number of rows per record batch
+    '''
+    def __init__(self, data, batch_size=65536):
+        self.data=data
+        self.batch_size=batch_size
+        self.schema=pa.Schema.from_pandas(data, preserve_index=False)
+
+    def result(self):
+        return(self)
 
+    def to_arrow_iterable(self, bqstorage_client=None):
+        table=pa.Table.from_pandas(self.data, preserve_index=False)
+        return(iter(table.to_batches(max_chunksize=self.batch_size)))
+
+    def to_dataframe(self):
+        return(self.data.copy())
+
+
+def _CompactBatch(frame, symbol_columns, float64_columns):
+    for col in frame.columns:
+        if col in symbol_columns:
+            frame[col]=frame[col].astype('category')
+        elif col not in float64_columns and frame[col].dtype==np.float64:
+            frame[col]=frame[col].astype(np.float32)
+    return(frame)
+
+
+def ReadResults(client, sql, job_config=None, symbol_columns=(), float64_columns=(), batch_callback=None, bqstorage_client=None):
+    '''
+    Description: Runs a query and reads its results as Arrow record batches, through the BigQuery Storage Read API
+    when google-cloud-bigquery-storage is installed. Every batch is converted to a compact dataframe, the symbol columns
+    become categoricals and the other float columns float32.
+    Inputs:
+        client:BigQueryClient, the Bigquery client that will run the query
+        sql:string, the query
+        job_config:QueryJobConfig, optional, the configuration of the query, e.g. its parameters
+        symbol_columns:list of strings, the columns converted to categoricals (gene symbols, sample ids, tissues)
+        float64_columns:list of strings, the float columns kept in float64, e.g. p values that can be smaller than the float32 range
+        batch_callback:function, optional, called with the dataframe of every batch as soon as it is read,
+            so the filtering of the results can start before the download finishes
+        bqstorage_client:BigQueryReadClient, optional, the client of the Storage Read API. By default one client with the application
+            default credentials is created on the first query and shared by all of them.
+    Output:
+        A dataframe of all the results
+    '''
+    rows=client.query(sql, job_config=job_config).result()
+    if hasattr(rows, 'to_arrow_iterable'):
+        if bqstorage_client is None and not isinstance(rows, LocalResults):
+            bqstorage_client=_BigQueryStorageClient()
+        batches=(batch.to_pandas() for batch in rows.to_arrow_iterable(bqstorage_client=bqstorage_client))
+    else:
+        batches=iter([rows.to_dataframe()])
+
+    frames=[]
+    for frame in batches:
+        frame=_CompactBatch(frame, symbol_columns, float64_columns)
+        if batch_callback is not None:
+            batch_callback(frame)
+        frames.append(frame)
+    if len(frames)==0:
+        schema=getattr(rows, 'schema', None) or []
+        return(pd.DataFrame(columns=[field.name for field in schema]))
+    if len(frames)==1:
+        return(frames[0])
+
+    # the batches have their own categories, they are unified before concatenating
+    symbols={col:union_categoricals([frame[col] for frame in frames], sort_categories=True)
+             for col in frames[0].columns if col in symbol_columns}
+    result=pd.concat(frames, ignore_index=True)
+    for col, values in symbols.items():
+        result[col]=values
+    return(result)